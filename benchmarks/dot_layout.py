@@ -0,0 +1,57 @@
+#!/usr/bin/env python3
+"""Measure dot layout time as a function of the graph size.
+
+The results are meant to guide the choice of the --max-nodes and --max-edges
+caps: pick the largest size whose layout time is still acceptable.  The caps
+have no default, as layout time depends on the Graphviz version and the
+machine, so this needs to be run where dot is installed.
+
+    python3 benchmarks/dot_layout.py [--dot PATH] [--format svg] [--sizes 100,200,...]
+"""
+
+import io
+import os
+import optparse
+import subprocess
+import sys
+import time
+
+from generators import gprof2dot, synthetic_profile
+
+
+def main():
+    optparser = optparse.OptionParser()
+    optparser.add_option('--dot', default='dot', help="dot executable [default: %default]")
+    optparser.add_option('--format', default='svg', help="dot output format [default: %default]")
+    optparser.add_option('--sizes', default='50,100,200,400,800,1600', help="node counts [default: %default]")
+    optparser.add_option('--edges-per-node', type='float', default=2.0, help="[default: %default]")
+    optparser.add_option('--timeout', type='float', default=600.0, help="seconds per run [default: %default]")
+    options, args = optparser.parse_args()
+
+    sys.stdout.write('%8s %8s %10s %10s\n' % ('nodes', 'edges', 'dot bytes', 'seconds'))
+    for nodes in [int(size) for size in options.sizes.split(',')]:
+        edges = int(nodes * options.edges_per_node)
+        profile = synthetic_profile(nodes, edges)
+        profile.prune(0.0, 0.0, None, False)
+
+        fp = io.StringIO()
+        gprof2dot.DotWriter(fp).graph(profile, gprof2dot.TEMPERATURE_COLORMAP)
+        data = fp.getvalue().encode('UTF-8')
+
+        start = time.perf_counter()
+        try:
+            subprocess.run([options.dot, '-T' + options.format, '-o', os.devnull],
+                           input=data, check=True, timeout=options.timeout)
+        except subprocess.TimeoutExpired:
+            sys.stdout.write('%8u %8u %10u %10s\n' % (nodes, edges, len(data), 'timeout'))
+            break
+        except OSError as e:
+            sys.stderr.write('error: failed to run %s: %s\n' % (options.dot, e))
+            sys.exit(1)
+        elapsed = time.perf_counter() - start
+        sys.stdout.write('%8u %8u %10u %10.3f\n' % (nodes, edges, len(data), elapsed))
+        sys.stdout.flush()
+
+
+if __name__ == '__main__':
+    main()
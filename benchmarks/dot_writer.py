@@ -0,0 +1,75 @@
+#!/usr/bin/env python3
+"""Measure DotWriter throughput and output size on large graphs.
+
+Both node identifier schemes are measured: the short generated ids (n0, n1,
+...) and the escaped function ids.  When --dot is given, the time dot takes
+to parse each output (with the layout-free canon format) is measured too.
+
+    python3 benchmarks/dot_writer.py [--nodes 50000] [--edges 150000] [--name-length 200] [--color-resolution 4096] [--dot dot]
+"""
+
+import io
+import optparse
+import subprocess
+import sys
+import time
+
+from generators import gprof2dot, synthetic_profile
+
+
+class NullFile:
+    """Output file that only counts what is written to it."""
+
+    def __init__(self):
+        self.size = 0
+
+    def write(self, s):
+        self.size += len(s)
+
+
+def write_graph(profile, fp, short_ids):
+    writer = gprof2dot.DotWriter(fp)
+    writer.short_ids = short_ids
+    writer.graph(profile, gprof2dot.TEMPERATURE_COLORMAP)
+
+
+def main():
+    optparser = optparse.OptionParser()
+    optparser.add_option('--nodes', type='int', default=50000, help="[default: %default]")
+    optparser.add_option('--edges', type='int', default=150000, help="[default: %default]")
+    optparser.add_option('--name-length', type='int', default=0, help="pad function names to this length, as with long C++ or PHP names [default: %default]")
+    optparser.add_option('--color-resolution', type='int', default=0, help="theme lookup table resolution [default: %default]")
+    optparser.add_option('--repeat', type='int', default=3, help="[default: %default]")
+    optparser.add_option('--dot', help="dot executable used to measure parse time")
+    options, args = optparser.parse_args()
+    gprof2dot.TEMPERATURE_COLORMAP.resolution = options.color_resolution
+
+    profile = synthetic_profile(options.nodes, options.edges, name_length=options.name_length)
+    profile.prune(0.0, 0.0, None, False)
+
+    for short_ids in (True, False):
+        best = None
+        for _ in range(options.repeat):
+            fp = NullFile()
+            start = time.perf_counter()
+            write_graph(profile, fp, short_ids)
+            elapsed = time.perf_counter() - start
+            if best is None or elapsed < best:
+                best = elapsed
+
+        sys.stdout.write('%s ids: %u nodes, %u edges, %u chars in %.3f s: %.1f MB/s, %.0f edges/s\n' % (
+            short_ids and 'short' or 'function', options.nodes, options.edges, fp.size, best,
+            fp.size / best / 1e6, options.edges / best))
+
+        if options.dot:
+            fp = io.StringIO()
+            write_graph(profile, fp, short_ids)
+            data = fp.getvalue().encode('UTF-8')
+            start = time.perf_counter()
+            subprocess.run([options.dot, '-Tcanon'], input=data, stdout=subprocess.DEVNULL, check=True)
+            sys.stdout.write('    dot parse time %.3f s\n' % (time.perf_counter() - start))
+        sys.stdout.flush()
+
+
+if __name__ == '__main__':
+    main()
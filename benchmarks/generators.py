@@ -0,0 +1,409 @@
+"""Deterministic synthetic profile generators for the benchmarks."""
+
+import json
+import os
+import random
+import sys
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir, 'library'))
+
+import gprof2dot
+
+
+def function_name(i, name_length=0):
+    name = 'ns%u::Class%u::method%u' % (i % 17, i % 251, i)
+    return name.ljust(name_length, '_')
+
+
+def synthetic_profile(functions, edges, seed=0, name_length=0):
+    """Build an already integrated profile with the given graph size.
+
+    Function 0 is the root.  Every other function gets one caller with a
+    lower index, so that the whole graph is reachable from the root, and the
+    remaining edges are spread randomly.  As with callgrind input, functions
+    are identified by their names, padded to name_length.
+    """
+
+    rng = random.Random(seed)
+    profile = gprof2dot.Profile()
+    names = [function_name(i, name_length) for i in range(functions)]
+    for name in names:
+        function = gprof2dot.Function(name, name)
+        function[gprof2dot.TIME_RATIO] = rng.random() / functions
+        profile.add_function(function)
+
+    pairs = set()
+    for callee_id in range(1, functions):
+        pairs.add((rng.randrange(callee_id), callee_id))
+    while len(pairs) < min(edges, functions * (functions - 1)):
+        caller_id = rng.randrange(functions)
+        callee_id = rng.randrange(functions)
+        if caller_id != callee_id:
+            pairs.add((caller_id, callee_id))
+
+    for caller, callee in sorted(pairs):
+        call = gprof2dot.Call(names[callee])
+        call[gprof2dot.CALLS] = rng.randint(1, 1000)
+        profile.functions[names[caller]].add_call(call)
+
+    # Inclusive weights decay with the distance from the root
+    for i, name in enumerate(names):
+        function = profile.functions[name]
+        ratio = 1.0 / (1.0 + i) ** 0.5
+        function[gprof2dot.TOTAL_TIME_RATIO] = ratio
+        for call in function.calls.values():
+            call[gprof2dot.TOTAL_TIME_RATIO] = ratio / (1 + len(function.calls))
+    profile[gprof2dot.TOTAL_TIME_RATIO] = 1.0
+    return profile
+
+
+def call_graph(functions, edges, cycles=0, cycle_length=3, seed=0):
+    """Return a sorted list of (caller, callee) function index pairs.
+
+    Function 0 is the root.  Every other function gets one caller with a
+    lower index, so that the whole graph is reachable from the root, and the
+    remaining edges point from lower to higher indices.  On top of that,
+    each of the given number of cycles links cycle_length consecutive
+    functions in a ring, so that find_cycles has strongly connected
+    components to collapse.
+    """
+
+    rng = random.Random(seed)
+    pairs = set()
+    for callee in range(1, functions):
+        pairs.add((rng.randrange(callee), callee))
+    while len(pairs) < min(edges, functions * (functions - 1) // 2):
+        caller = rng.randrange(functions - 1)
+        pairs.add((caller, rng.randrange(caller + 1, functions)))
+    for first in rng.sample(range(1, max(functions - cycle_length, 1)), min(cycles, max(functions - cycle_length - 1, 0))):
+        ring = list(range(first, first + cycle_length))
+        for caller, callee in zip(ring, ring[1:] + ring[:1]):
+            pairs.add((caller, callee))
+    return sorted(pairs)
+
+
+def random_stacks(samples, functions, depth, seed=0):
+    """Generate call stacks of function indices, leaf first.
+
+    Stacks are drawn from a fixed population of distinct stacks with a
+    skewed distribution, as hot paths repeat in real recordings.
+    """
+
+    rng = random.Random(seed)
+    population = []
+    for _ in range(max(samples // 10, 1)):
+        stack = [0]
+        for _ in range(rng.randint(1, depth)):
+            stack.append(rng.randrange(functions))
+        stack.reverse()
+        population.append(stack)
+    for _ in range(samples):
+        yield population[min(int(rng.paretovariate(1.2)) - 1, len(population) - 1)]
+
+
+def perf_script(fp, samples, functions, depth=16, seed=0):
+    """Write `perf script` output."""
+
+    for stack in random_stacks(samples, functions, depth, seed):
+        fp.write('prog 4242 [003] 1234.567890: 250000 cycles:\n')
+        for i in stack:
+            fp.write('\t    %12x %s+0x%x (/usr/lib/libmod%u.so)\n' % (
+                0x7f0000000000 + i * 64, function_name(i), i % 64, i % 7))
+        fp.write('\n')
+
+
+def xperf_csv(fp, rows, functions, depth=16, seed=0):
+    """Write a CSV export of sampled stacks, as produced by XPerf."""
+
+    fp.write('Process Name, Thread ID, Module, Function, Address, Line Number, Weight, Count, '
+             'TimeStamp, CPU, Stack\r\n')
+    rng = random.Random(seed)
+    for stack in random_stacks(rows, functions, depth, seed):
+        frames = ['mod%u.dll!%s' % (i % 7, function_name(i)) for i in reversed(stack)]
+        leaf = stack[0]
+        fp.write('app.exe (4242), %u, mod%u.dll, %s, 0x%x, %u, %u, %u, %u, %u, %s\r\n' % (
+            rng.randrange(8), leaf % 7, function_name(leaf), 0x10000 + leaf, leaf,
+            rng.randint(1, 3), 1, rng.randrange(10**9), rng.randrange(64),
+            '/'.join(['[Root]'] + frames)))
+
+
+def sysprof_xml(fp, nodes, functions, seed=0):
+    """Write a sysprof 1.x XML capture with the given number of tree nodes.
+
+    The first objects are the fake ones sysprof emits for the process,
+    module and "[Everything]" entries; they carry no self samples.
+    """
+
+    rng = random.Random(seed)
+    fakes = 3
+    names = ['"[Everything]"', '"app"', '"libmod.so"'] + [
+        '"%s"' % function_name(i) for i in range(functions)]
+    objects = len(names)
+
+    tree = []
+    for id in range(1, nodes + 1):
+        if id <= fakes:
+            tree.append((id, id - 1, 0))
+        else:
+            parent = rng.randint(fakes, id - 1)
+            tree.append((rng.randint(fakes + 1, objects), parent, rng.randint(1, 20)))
+
+    self_samples = [0] * (objects + 1)
+    for object, parent, samples in tree:
+        self_samples[object] += samples
+    total = sum(self_samples)
+
+    fp.write('<profile>\n <size>%u</size>\n <objects>\n' % total)
+    for id, name in enumerate(names, 1):
+        fp.write('  <object id="%u">\n   <name>%s</name>\n   <total>%u</total>\n'
+                 '   <self>%u</self>\n  </object>\n' % (id, name, self_samples[id], self_samples[id]))
+    fp.write(' </objects>\n <nodes>\n')
+    for id, (object, parent, samples) in enumerate(tree, 1):
+        fp.write('  <node id="%u">\n   <object>%u</object>\n   <parent>%u</parent>\n'
+                 '   <self>%u</self>\n   <total>%u</total>\n   <toplevel>%u</toplevel>\n  </node>\n' % (
+                     id, object, parent, samples, samples, id == 1))
+    fp.write(' </nodes>\n</profile>\n')
+
+
+def sleepy_zip(filename, samples, functions, depth=16, seed=0):
+    """Write a Very Sleepy capture, with one callstack line per sample."""
+
+    import zipfile
+
+    with zipfile.ZipFile(filename, 'w', zipfile.ZIP_DEFLATED) as database:
+        database.writestr('Symbols.txt', ''.join([
+            'sym%u "mod%u" "%s" "file%u.cpp" %u\r\n' % (i, i % 7, function_name(i), i % 100, i)
+            for i in range(functions)]))
+        rng = random.Random(seed)
+        database.writestr('Callstacks.txt', ''.join([
+            '%u %s\r\n' % (rng.randint(1, 3), ' '.join(['sym%u' % i for i in stack]))
+            for stack in random_stacks(samples, functions, depth, seed)]))
+
+
+def pstats_file(filename, functions, seed=0):
+    """Write a cProfile dump, as saved by pstats.Stats.dump_stats.
+
+    The functions and their callers are the same for every seed, as in the
+    dumps of the workers of one service; only the counts and times vary.
+    """
+
+    import marshal
+
+    graph = random.Random(0)
+    rng = random.Random(seed)
+    keys = [('/srv/app/mod%u.py' % (i % 50), i, function_name(i)) for i in range(functions)]
+    stats = {}
+    for i, key in enumerate(keys):
+        callers = {}
+        for _ in range(graph.randint(0, 4) if i else 0):
+            nc = rng.randint(1, 100)
+            tt = rng.random() * 1e-3
+            callers[keys[graph.randrange(i)]] = (nc, nc, tt, tt * rng.randint(1, 10))
+        nc = sum([value[0] for value in callers.values()]) or 1
+        tt = rng.random() * 1e-2
+        stats[key] = (nc, nc, tt, tt * rng.randint(1, 10), callers)
+    with open(filename, 'wb') as fp:
+        marshal.dump(stats, fp)
+
+
+def cxx_function_name(i):
+    """Return a demangled C++ name, of the length seen in template heavy code."""
+
+    return 'ns%u::Class%u<std::vector<int, std::allocator<int> >, %u>::method%u(std::string const&, unsigned long) const' % (
+        i % 17, i % 251, i % 5, i)
+
+
+def gprof_report(fp, functions, edges_per_function=4, seed=0):
+    """Write the call graph part of a GNU gprof report."""
+
+    rng = random.Random(seed)
+    children = [[] for _ in range(functions)]
+    parents = [[] for _ in range(functions)]
+    for caller in range(functions - 1):
+        for callee in set([rng.randrange(caller + 1, functions) for _ in range(edges_per_function)]):
+            calls = rng.randint(1, 10000)
+            children[caller].append((callee, calls))
+            parents[callee].append((caller, calls))
+
+    fp.write('\t\t     Call graph (explanation follows)\n\n\n'
+             'granularity: each sample hit covers 2 byte(s) for 0.01% of 100.00 seconds\n\n'
+             'index % time    self  children    called     name\n')
+    for i in range(functions):
+        called = sum([calls for caller, calls in parents[i]])
+        if not parents[i]:
+            fp.write('                                                 <spontaneous>\n')
+        for caller, calls in parents[i]:
+            fp.write('                %4.2f    %4.2f %7u/%-7u        %s [%u]\n' % (
+                rng.random(), rng.random(), calls, called, cxx_function_name(caller), caller + 1))
+        fp.write('%-6s %5.1f %7.2f %7.2f %7s         %s [%u]\n' % (
+            '[%u]' % (i + 1), rng.random() * 100, rng.random(), rng.random(), called or '',
+            cxx_function_name(i), i + 1))
+        for callee, calls in children[i]:
+            total = sum([count for caller, count in parents[callee]])
+            fp.write('                %4.2f    %4.2f %7u/%-7u        %s [%u]\n' % (
+                rng.random(), rng.random(), calls, total, cxx_function_name(callee), callee + 1))
+        fp.write('-----------------------------------------------\n')
+    fp.write('\014\n')
+
+
+def hprof_text(fp, traces, functions, depth=16, sampled=0.1, seed=0):
+    """Write a HPROF cpu=samples report, where only a fraction of the traces
+    were ever sampled, as is usual for long running JVMs."""
+
+    rng = random.Random(seed)
+    fp.write('JAVA PROFILE 1.0.1, created Mon Jan  1 00:00:00 2024\n\n'
+             'Copyright (c) 2003, 2005, Oracle and/or its affiliates. All rights reserved.\n\n'
+             '--------\n\n')
+    for id, stack in enumerate(random_stacks(traces, functions, depth, seed)):
+        fp.write('TRACE %u:\n' % (300000 + id))
+        for i in stack:
+            fp.write('\tcom.example.pkg%u.Class%u.%s(Class%u.java:%u)\n' % (
+                i % 13, i % 97, function_name(i), i % 97, i))
+    ids = rng.sample(range(traces), max(1, int(traces * sampled)))
+    counts = [rng.randint(1, 1000) for id in ids]
+    total = sum(counts)
+    fp.write('CPU SAMPLES BEGIN (total = %u) Mon Jan  1 00:10:00 2024\n'
+             'rank   self  accum   count trace method\n' % total)
+    accum = 0
+    for rank, (count, id) in enumerate(sorted(zip(counts, ids), reverse=True)):
+        accum += count
+        fp.write('%4u %5.2f%% %5.2f%% %7u %u com.example.Unknown.method\n' % (
+            rank + 1, 100.0 * count / total, 100.0 * accum / total, count, 300000 + id))
+    fp.write('CPU SAMPLES END\n')
+
+
+def json_profile(fp, events, functions, depth=16, seed=0):
+    """Write a profile in the JSON format of schema.json, one event per
+    sample."""
+
+    fp.write('{"version": 0, "functions": [')
+    fp.write(', '.join([
+        json.dumps({'name': function_name(i), 'module': 'mod%u' % (i % 7)})
+        for i in range(functions)]))
+    fp.write('], "events": [')
+    rng = random.Random(seed)
+    separator = ''
+    for stack in random_stacks(events, functions, depth, seed):
+        fp.write('%s{"callchain": [%s], "cost": [%u]}' % (
+            separator, ', '.join(['%u' % i for i in stack]), rng.randint(1, 3)))
+        separator = ', '
+    fp.write(']}\n')
+
+
+def php_function_name(i):
+    return 'App\\Ns%u\\Class%u->method%u' % (i % 17, i % 251, i)
+
+
+def callgrind_out(fp, functions, edges, cycles=0, cycle_length=3, compress=True, seed=0):
+    """Write a callgrind profile as Xdebug does.
+
+    With compress, file and function names are written in full only on
+    their first occurrence, as "(id) name", and as "(id)" afterwards.
+    Callees are written before their callers, and {main} comes last.
+    """
+
+    rng = random.Random(seed)
+    calls = [[] for _ in range(functions)]
+    for caller, callee in call_graph(functions, edges, cycles, cycle_length, seed):
+        calls[caller].append(callee)
+
+    names = ['{main}'] + [php_function_name(i) for i in range(1, functions)]
+    files = ['/srv/app/index.php'] + ['/srv/app/src/Ns%u/Class%u.php' % (i % 17, i % 251) for i in range(1, functions)]
+    # File and function names are numbered separately
+    tables = {'fl': {}, 'fn': {}}
+
+    def ref(kind, name):
+        if not compress:
+            return name
+        table = tables[kind]
+        try:
+            return '(%u)' % table[name]
+        except KeyError:
+            id = table[name] = len(table) + 1
+            return '(%u) %s' % (id, name)
+
+    fp.write('version: 1\ncreator: xdebug 3.2.0 (PHP 8.2.0)\ncmd: /srv/app/index.php\n'
+             'part: 1\npositions: line\n\nevents: Time_(10ns) Memory_(bytes)\n\n')
+    total = 0
+    for i in reversed(range(functions)):
+        cost = rng.randint(1, 1000)
+        total += cost
+        fp.write('fl=%s\nfn=%s\n%u %u %u\n' % (ref('fl', files[i]), ref('fn', names[i]), i, cost, rng.randint(0, 4096)))
+        for callee in calls[i]:
+            fp.write('cfl=%s\ncfn=%s\ncalls=%u 0 0\n%u %u %u\n' % (
+                ref('fl', files[callee]), ref('fn', names[callee]), rng.randint(1, 100),
+                i, rng.randint(1, 10000), rng.randint(0, 4096)))
+        fp.write('\n')
+    fp.write('summary: %u %u\n' % (total, 0))
+
+
+def callgrind_trace(fp, calls, functions, fanout=4, recursion=0.05, max_depth=12, seed=0):
+    """Write a callgrind profile of a simulated run, whose call costs are
+    exact inclusive costs, as with Xdebug.
+
+    Each function calls up to fanout others, mostly with higher indices; a
+    recursion fraction of the edges goes back to lower indices, which makes
+    recursion cycles.  The run starts at {main} and stops after about the
+    given number of calls.  Return the exact inclusive cost of every
+    function, by name, counting each activation that is not nested in
+    another of the same function, and the total cost.
+    """
+
+    rng = random.Random(seed)
+    graph = []
+    for i in range(functions):
+        callees = []
+        for _ in range(rng.randint(1, fanout)):
+            if rng.random() < recursion:
+                callees.append(rng.randint(0, i))
+            elif i < functions - 1:
+                callees.append(rng.randint(i + 1, functions - 1))
+        graph.append(sorted(set(callees)))
+
+    self_costs = [0] * functions
+    edges = {}
+    active = [0] * functions
+    inclusive = [0] * functions
+    budget = [calls]
+
+    def run(function, depth):
+        cost = rng.randint(1, 1000)
+        self_costs[function] += cost
+        total = cost
+        active[function] += 1
+        if depth < max_depth:
+            for callee in graph[function]:
+                for _ in range(rng.randint(0, 2)):
+                    if budget[0] <= 0:
+                        break
+                    budget[0] -= 1
+                    subtotal = run(callee, depth + 1)
+                    edge = edges.setdefault((function, callee), [0, 0])
+                    edge[0] += 1
+                    edge[1] += subtotal
+                    total += subtotal
+        active[function] -= 1
+        if not active[function]:
+            inclusive[function] += total
+        return total
+
+    grand_total = 0
+    while budget[0] > 0:
+        grand_total += run(0, 0)
+
+    names = ['{main}'] + [php_function_name(i) for i in range(1, functions)]
+    fp.write('version: 1\ncreator: xdebug 3.2.0 (PHP 8.2.0)\ncmd: /srv/app/index.php\n'
+             'part: 1\npositions: line\n\nevents: Time_(10ns)\n\n')
+    callees = [[] for _ in range(functions)]
+    for (caller, callee), edge in sorted(edges.items()):
+        callees[caller].append((callee, edge))
+    for i in reversed(range(functions)):
+        if not self_costs[i]:
+            continue
+        fp.write('fl=/srv/app/src/Class%u.php\nfn=%s\n%u %u\n' % (i, names[i], i, self_costs[i]))
+        for callee, (count, cost) in callees[i]:
+            fp.write('cfl=/srv/app/src/Class%u.php\ncfn=%s\ncalls=%u 0 0\n%u %u\n' % (callee, names[callee], count, i, cost))
+        fp.write('\n')
+    fp.write('summary: %u\n' % grand_total)
+
+    return dict([(names[i], inclusive[i]) for i in range(functions) if self_costs[i]]), grand_total
@@ -0,0 +1,35 @@
+#!/usr/bin/env python3
+"""Measure GprofParser throughput on a synthetic call graph report.
+
+    python3 benchmarks/gprof_parse.py [--functions 20000] [--edges-per-function 4]
+"""
+
+import io
+import optparse
+import sys
+import time
+
+from generators import gprof2dot, gprof_report
+
+
+def main():
+    optparser = optparse.OptionParser()
+    optparser.add_option('--functions', type='int', default=20000, help="[default: %default]")
+    optparser.add_option('--edges-per-function', type='int', default=4, help="[default: %default]")
+    options, args = optparser.parse_args()
+
+    fp = io.StringIO()
+    gprof_report(fp, options.functions, options.edges_per_function)
+    data = fp.getvalue()
+    lines = data.count('\n')
+
+    start = time.perf_counter()
+    gprof2dot.GprofParser(io.StringIO(data)).parse()
+    elapsed = time.perf_counter() - start
+
+    sys.stdout.write('%u lines, %.1f MB in %.3f s: %.0f lines/s\n' % (
+        lines, len(data) / 1e6, elapsed, lines / elapsed))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,63 @@
+#!/usr/bin/env python3
+"""Measure HProfParser throughput and peak memory on a synthetic report.
+
+    python3 benchmarks/hprof_parse.py [--traces 200000] [--functions 500] [--sampled 0.1]
+
+Both the seekable file path and the sequential path used for pipes are
+measured.  Peak memory is the tracemalloc peak while parsing, measured in a
+second run so that tracing does not skew the timing.
+"""
+
+import io
+import optparse
+import os
+import sys
+import tempfile
+import time
+import tracemalloc
+
+from generators import gprof2dot, hprof_text
+
+
+def measure(open_stream):
+    start = time.perf_counter()
+    gprof2dot.HProfParser(open_stream()).parse()
+    elapsed = time.perf_counter() - start
+
+    tracemalloc.start()
+    gprof2dot.HProfParser(open_stream()).parse()
+    current, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    return elapsed, peak
+
+
+def main():
+    optparser = optparse.OptionParser()
+    optparser.add_option('--traces', type='int', default=200000, help="[default: %default]")
+    optparser.add_option('--functions', type='int', default=500, help="[default: %default]")
+    optparser.add_option('--depth', type='int', default=16, help="[default: %default]")
+    optparser.add_option('--sampled', type='float', default=0.1, help="fraction of sampled traces [default: %default]")
+    options, args = optparser.parse_args()
+
+    fd, filename = tempfile.mkstemp(suffix='.hprof.txt')
+    os.close(fd)
+    try:
+        with open(filename, 'wt') as fp:
+            hprof_text(fp, options.traces, options.functions, options.depth, options.sampled)
+        with open(filename, 'rt') as fp:
+            text = fp.read()
+
+        for label, open_stream in [
+            ('file', lambda: open(filename, 'rt')),
+            # StringIO has no binary buffer, like a pipe with no seek support
+            ('sequential', lambda: io.StringIO(text)),
+        ]:
+            elapsed, peak = measure(open_stream)
+            sys.stdout.write('%-10s %u traces in %.3f s: %.0f traces/s, peak %.1f MB\n' % (
+                label, options.traces, elapsed, options.traces / elapsed, peak / 1e6))
+    finally:
+        os.unlink(filename)
+
+
+if __name__ == '__main__':
+    main()
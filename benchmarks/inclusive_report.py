@@ -0,0 +1,107 @@
+#!/usr/bin/env python3
+"""Compare the callgrind total time methods: the call ratio heuristic
+(--total=callratios) and the inclusive call costs (--total=inclusive),
+which are exact outside cycles of mutually recursive functions.
+
+    python3 benchmarks/inclusive_report.py [--calls 200000] [--functions 300] [--recursion 0.05] [--top 10]
+    python3 benchmarks/inclusive_report.py cachegrind.out ...
+
+Without arguments a simulated run is profiled, for which the exact total of
+every function is known, and the error of both methods is reported along
+with how they differ.  Given callgrind files, only their difference is.
+The time taken by the derived data phases of each method is reported too.
+"""
+
+import io
+import optparse
+import sys
+import time
+
+from generators import gprof2dot, callgrind_trace
+
+
+METHODS = ['callratios', 'inclusive']
+
+
+class PhaseTimer:
+    """Phase listener that adds up the time of the phases."""
+
+    def __init__(self):
+        self.stack = []
+        self.times = {}
+
+    def enter(self, name):
+        self.stack.append((name, time.perf_counter()))
+
+    def leave(self):
+        name, start = self.stack.pop()
+        self.times[name] = self.times.get(name, 0.0) + time.perf_counter() - start
+
+
+def load(text, method):
+    """Parse the profile with the method, and return the total ratio of
+    every function by name, and the time of the derived data phases."""
+
+    timer = PhaseTimer()
+    gprof2dot.phase_listeners.append(timer)
+    try:
+        profile = gprof2dot.load_profile(io.StringIO(text), 'callgrind', gprof2dot.Options(totalMethod=method))
+    finally:
+        gprof2dot.phase_listeners.remove(timer)
+    totals = dict([(function.name, function[gprof2dot.TOTAL_TIME_RATIO]) for function in profile.functions.values()])
+    return totals, timer.times
+
+
+def report(title, text, truth, options):
+    sys.stdout.write('%s\n\n' % title)
+    totals = {}
+    for method in METHODS:
+        totals[method], times = load(text, method)
+        sys.stdout.write('%-12s %8.3f s  (%s)\n' % (
+            method, sum(times.values()),
+            ', '.join(['%s %.3f' % (name, times[name]) for name in sorted(times)])))
+    sys.stdout.write('\n')
+
+    names = sorted(totals[METHODS[0]])
+    columns = [(method, totals[method]) for method in METHODS]
+    if truth is not None:
+        columns.append(('exact', truth))
+        for method in METHODS:
+            errors = [abs(totals[method][name] - truth[name]) * 100.0 for name in names]
+            sys.stdout.write('%-12s error: max %6.2f%%  mean %6.3f%%  over 1%%: %u of %u\n' % (
+                method, max(errors), sum(errors) / len(errors), len([error for error in errors if error > 1.0]), len(errors)))
+    differences = [abs(totals['inclusive'][name] - totals['callratios'][name]) * 100.0 for name in names]
+    sys.stdout.write('%-12s max %6.2f%%  mean %6.3f%%  over 1%%: %u of %u\n\n' % (
+        'difference:', max(differences), sum(differences) / len(differences),
+        len([difference for difference in differences if difference > 1.0]), len(differences)))
+
+    sys.stdout.write('%-40s' % 'function' + ''.join(['%12s' % name for name, _ in columns]) + '\n')
+    ranked = sorted(zip(differences, names), reverse=True)[:options.top]
+    for _, name in ranked:
+        sys.stdout.write('%-40s' % name[:40] + ''.join(['%11.2f%%' % (values[name] * 100.0) for _, values in columns]) + '\n')
+    sys.stdout.write('\n')
+
+
+def main():
+    optparser = optparse.OptionParser(usage="\n\t%prog [options] [cachegrind.out ...]")
+    optparser.add_option('--calls', type='int', default=200000, help="calls in the simulated run [default: %default]")
+    optparser.add_option('--functions', type='int', default=300, help="[default: %default]")
+    optparser.add_option('--recursion', type='float', default=0.05, help="fraction of the calls that go back up the call graph [default: %default]")
+    optparser.add_option('--seed', type='int', default=0, help="[default: %default]")
+    optparser.add_option('--top', type='int', default=10, help="functions listed, by decreasing difference [default: %default]")
+    options, args = optparser.parse_args()
+
+    if not args:
+        fp = io.StringIO()
+        truth, total = callgrind_trace(fp, options.calls, options.functions, recursion=options.recursion, seed=options.seed)
+        truth = dict([(name, float(cost) / total) for name, cost in truth.items()])
+        report('simulated run: %u calls, %u functions, recursion %g' % (options.calls, options.functions, options.recursion),
+               fp.getvalue(), truth, options)
+    for filename in args:
+        with open(filename, 'rt', encoding='UTF-8') as fp:
+            text = fp.read()
+        report(filename, text, None, options)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,61 @@
+#!/usr/bin/env python3
+"""Measure JsonParser throughput and peak memory on a synthetic profile.
+
+    python3 benchmarks/json_parse.py [--events 1000000] [--functions 500] [--depth 16]
+
+Each parse runs in a fresh process, which reports its peak resident set
+size, so that the memory taken by the decoder is measured as the operating
+system sees it.  Unix only.
+"""
+
+import optparse
+import os
+import resource
+import subprocess
+import sys
+import tempfile
+import time
+
+from generators import gprof2dot, json_profile
+
+
+def child(filename):
+    start = time.perf_counter()
+    with open(filename, 'rt') as fp:
+        gprof2dot.JsonParser(fp).parse()
+    elapsed = time.perf_counter() - start
+    # ru_maxrss is in kilobytes on Linux
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+    sys.stdout.write('%r %r\n' % (elapsed, peak))
+
+
+def main():
+    optparser = optparse.OptionParser()
+    optparser.add_option('--events', type='int', default=1000000, help="[default: %default]")
+    optparser.add_option('--functions', type='int', default=500, help="[default: %default]")
+    optparser.add_option('--depth', type='int', default=16, help="[default: %default]")
+    optparser.add_option('--child', metavar='FILE', help=optparse.SUPPRESS_HELP)
+    options, args = optparser.parse_args()
+
+    if options.child:
+        child(options.child)
+        return
+
+    fd, filename = tempfile.mkstemp(suffix='.json')
+    os.close(fd)
+    try:
+        with open(filename, 'wt') as fp:
+            json_profile(fp, options.events, options.functions, options.depth)
+        size = os.path.getsize(filename)
+
+        output = subprocess.check_output([sys.executable, os.path.abspath(__file__), '--child', filename])
+        elapsed, peak = [float(field) for field in output.split()]
+    finally:
+        os.unlink(filename)
+
+    sys.stdout.write('%u events (%.1f MB) in %.3f s: %.0f events/s, peak RSS %.1f MB\n' % (
+        options.events, size / 1e6, elapsed, options.events / elapsed, peak / 1e6))
+
+
+if __name__ == '__main__':
+    main()
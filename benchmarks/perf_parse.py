@@ -0,0 +1,42 @@
+#!/usr/bin/env python3
+"""Measure PerfParser throughput in call frames per second.
+
+    python3 benchmarks/perf_parse.py [--samples 200000] [--functions 5000] [--depth 16]
+"""
+
+import io
+import optparse
+import sys
+import time
+
+from generators import gprof2dot, perf_script
+
+
+def main():
+    optparser = optparse.OptionParser()
+    optparser.add_option('--samples', type='int', default=200000, help="[default: %default]")
+    optparser.add_option('--functions', type='int', default=5000, help="[default: %default]")
+    optparser.add_option('--depth', type='int', default=16, help="[default: %default]")
+    options, args = optparser.parse_args()
+
+    fp = io.StringIO()
+    perf_script(fp, options.samples, options.functions, options.depth)
+    data = fp.getvalue()
+    frames = data.count('\t')
+
+    parser = gprof2dot.PerfParser(io.StringIO(data))
+    start = time.perf_counter()
+    parser.readline()
+    parser.profile[gprof2dot.SAMPLES] = 0
+    while not parser.eof():
+        parser.parse_event()
+    if hasattr(parser, 'aggregator'):
+        parser.aggregator.flush()
+    elapsed = time.perf_counter() - start
+
+    sys.stdout.write('%u samples, %u frames, %.1f MB in %.3f s: %.0f frames/s\n' % (
+        options.samples, frames, len(data) / 1e6, elapsed, frames / elapsed))
+
+
+if __name__ == '__main__':
+    main()
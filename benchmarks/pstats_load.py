@@ -0,0 +1,60 @@
+#!/usr/bin/env python3
+"""Measure loading and merging many pstats files, as dumped by each worker of
+a multi-process service.
+
+    python3 benchmarks/pstats_load.py [--files 10,100,1000] [--functions 2000]
+
+Compares pstats.Stats, which loads and merges the files one at a time, with
+PstatsParser in a single process and with its process pool.
+"""
+
+import optparse
+import os
+import shutil
+import sys
+import tempfile
+import time
+
+from generators import gprof2dot, pstats_file
+
+
+def measure(function):
+    start = time.perf_counter()
+    function()
+    return time.perf_counter() - start
+
+
+def main():
+    optparser = optparse.OptionParser()
+    optparser.add_option('--files', default='10,100,1000', help="[default: %default]")
+    optparser.add_option('--functions', type='int', default=2000, help="[default: %default]")
+    options, args = optparser.parse_args()
+
+    import pstats
+
+    workers = os.cpu_count() or 1
+    parser = gprof2dot.PstatsParser.__new__(gprof2dot.PstatsParser)
+
+    directory = tempfile.mkdtemp()
+    try:
+        sys.stdout.write('%u CPUs\n' % workers)
+        sys.stdout.write('%6s %12s %12s %12s %12s\n' % ('files', 'pstats', 'sequential', 'parallel', 'parse'))
+        for count in [int(count) for count in options.files.split(',')]:
+            filenames = []
+            for i in range(count):
+                filename = os.path.join(directory, '%u.prof' % i)
+                if not os.path.exists(filename):
+                    pstats_file(filename, options.functions, seed=i)
+                filenames.append(filename)
+
+            stats = measure(lambda: pstats.Stats(*filenames))
+            sequential = measure(lambda: gprof2dot.load_pstats(filenames))
+            parallel = measure(lambda: parser.load_parallel(filenames, min(workers, count)))
+            parse = measure(lambda: gprof2dot.PstatsParser(*filenames).parse())
+            sys.stdout.write('%6u %11.3fs %11.3fs %11.3fs %11.3fs\n' % (count, stats, sequential, parallel, parse))
+    finally:
+        shutil.rmtree(directory)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,94 @@
+#!/usr/bin/env python3
+"""Check that gprof2dot.render() matches the command line tool.
+
+    python3 benchmarks/render_api.py [--python /usr/bin/python2.7] [...]
+
+Small callgrind, json and perf profiles, with non-ASCII function names in
+the json one, are rendered with every given interpreter, and this one, both
+through render() and by running gprof2dot.py.  The exit status is 1 when
+the two differ, or either fails.
+"""
+
+import json
+import optparse
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+
+from generators import callgrind_out, json_profile, perf_script
+
+
+LIBRARY = os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir, 'library')
+
+# Python 2 and 3 alike
+RENDER = '''
+import sys
+sys.path.insert(0, sys.argv[1])
+import gprof2dot
+data = gprof2dot.render(sys.argv[3], sys.argv[2], gprof2dot.Options(node_thres=0, edge_thres=0))
+getattr(sys.stdout, 'buffer', sys.stdout).write(data)
+'''
+
+
+def unicode_profile(fp):
+    fp.write(json.dumps({
+        'version': 0,
+        'functions': [{'name': 'main'}, {'name': 'café'}, {'name': '日本'}],
+        'events': [{'callchain': [1, 0], 'cost': [3]}, {'callchain': [2, 1, 0], 'cost': [2]}],
+    }))
+
+
+PROFILES = [
+    ('cachegrind.out', 'callgrind', lambda fp: callgrind_out(fp, 50, 150)),
+    ('profile.json', 'json', lambda fp: json_profile(fp, 500, 50)),
+    ('unicode.json', 'json', unicode_profile),
+    ('perf.txt', 'perf', lambda fp: perf_script(fp, 500, 50)),
+]
+
+
+def run(command):
+    process = subprocess.run(command, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+    if process.returncode:
+        sys.stdout.write(process.stderr.decode('UTF-8', 'replace'))
+        return None
+    return process.stdout
+
+
+def main():
+    optparser = optparse.OptionParser()
+    optparser.add_option('--python', action='append', default=[], help="another interpreter to check")
+    optparser.add_option('--library', default=LIBRARY, help="directory holding gprof2dot.py [default: this tree]")
+    options, args = optparser.parse_args()
+    library = os.path.abspath(options.library)
+
+    failed = False
+    directory = tempfile.mkdtemp()
+    try:
+        for filename, format, write in PROFILES:
+            with open(os.path.join(directory, filename), 'wt', encoding='UTF-8') as fp:
+                write(fp)
+
+        for python in [sys.executable] + options.python:
+            for filename, format, write in PROFILES:
+                profile = os.path.join(directory, filename)
+                rendered = run([python, '-c', RENDER, library, format, profile])
+                expected = run([python, os.path.join(library, 'gprof2dot.py'), '-n0', '-e0', '-f', format, profile])
+                if rendered is None or expected is None:
+                    result = 'failed'
+                elif rendered != expected:
+                    result = 'differs'
+                else:
+                    result = 'ok'
+                failed = failed or result != 'ok'
+                sys.stdout.write('%s %s: %s\n' % (python, filename, result))
+    finally:
+        shutil.rmtree(directory)
+
+    if failed:
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,271 @@
+#!/usr/bin/env python3
+"""Run the end to end benchmarks, or compare two sets of results.
+
+    python3 benchmarks/run.py run [-o results.json] [--functions 500] [...] [format ...]
+    python3 benchmarks/run.py compare baseline.json results.json [--threshold 10]
+
+For every format, a synthetic profile is written to a temporary file and
+taken through the same steps as the command line tool: parsing, the
+derived data computed by the parser (validate, find_cycles, ratio,
+call_ratios, integrate), prune, and DotWriter.graph.  Each stage is timed
+separately, the time of nested stages being excluded from the enclosing
+one, so "parse" is the time spent reading the input proper.  The best time
+over --repeat runs is kept.  Memory is the tracemalloc peak of each stage
+above the memory in use when it started, measured in an extra run so that
+tracing does not skew the timings.
+
+compare prints the relative change of every stage and exits with status 1
+when a stage got slower, or took more memory, than the threshold allows.
+"""
+
+import json
+import optparse
+import os
+import platform
+import shutil
+import sys
+import tempfile
+import time
+import tracemalloc
+
+from generators import (gprof2dot, callgrind_out, perf_script, pstats_file, json_profile, xperf_csv,
+                        sleepy_zip, sysprof_xml, gprof_report, hprof_text)
+
+
+STAGES = ['parse', 'validate', 'find_cycles', 'ratio', 'call_ratios', 'integrate', 'prune', 'graph']
+
+
+def write_text(generator):
+    def write(filename, options):
+        with open(filename, 'wt', encoding='UTF-8') as fp:
+            generator(fp, options)
+    return write
+
+
+# Format name, input file suffix and generator
+CASES = [
+    ('callgrind', '.out', write_text(lambda fp, options: callgrind_out(
+        fp, options.functions, options.edges, options.cycles, options.cycle_length, not options.no_compress))),
+    ('perf', '.txt', write_text(lambda fp, options: perf_script(
+        fp, options.samples, options.functions, options.depth))),
+    ('pstats', '.prof', lambda filename, options: pstats_file(filename, options.functions)),
+    ('json', '.json', write_text(lambda fp, options: json_profile(
+        fp, options.samples, options.functions, options.depth))),
+    ('xperf', '.csv', write_text(lambda fp, options: xperf_csv(
+        fp, options.samples, options.functions, options.depth))),
+    ('sleepy', '.sleepy', lambda filename, options: sleepy_zip(
+        filename, options.samples, options.functions, options.depth)),
+    ('sysprof', '.xml', write_text(lambda fp, options: sysprof_xml(
+        fp, options.samples, options.functions))),
+    ('prof', '.txt', write_text(lambda fp, options: gprof_report(
+        fp, options.functions, max(options.edges // options.functions, 1)))),
+    ('hprof', '.txt', write_text(lambda fp, options: hprof_text(
+        fp, options.samples, options.functions, options.depth))),
+]
+
+
+class NullFile:
+    """Output file that discards what is written to it."""
+
+    def write(self, s):
+        pass
+
+
+class Stages:
+    """Record the time and memory of nested stages."""
+
+    def __init__(self, trace_memory):
+        self.trace_memory = trace_memory
+        self.stack = []
+        self.times = {}
+        self.memory = {}
+
+    def checkpoint(self):
+        """Fold the memory peak since the last checkpoint into the open
+        stages, and return the memory currently in use."""
+        if not self.trace_memory:
+            return 0
+        current, peak = tracemalloc.get_traced_memory()
+        for frame in self.stack:
+            frame[3] = max(frame[3], peak)
+        tracemalloc.reset_peak()
+        return current
+
+    def enter(self, name):
+        current = self.checkpoint()
+        # name, start time, time of nested stages, peak memory, memory at start
+        self.stack.append([name, time.perf_counter(), 0.0, current, current])
+
+    def leave(self):
+        end = time.perf_counter()
+        self.checkpoint()
+        name, start, nested, peak, base = self.stack.pop()
+        elapsed = end - start
+        if self.stack:
+            self.stack[-1][2] += elapsed
+        self.times[name] = self.times.get(name, 0.0) + elapsed - nested
+        self.memory[name] = max(self.memory.get(name, 0), peak - base)
+
+    def wrap(self, cls, name, stage):
+        """Instrument a method.  Return a function that undoes it."""
+        method = getattr(cls, name)
+
+        def wrapper(*args, **kwargs):
+            self.enter(stage)
+            try:
+                return method(*args, **kwargs)
+            finally:
+                self.leave()
+
+        setattr(cls, name, wrapper)
+        return lambda: setattr(cls, name, method)
+
+
+def run_once(format, filename, trace_memory):
+    stages = Stages(trace_memory)
+    undo = [stages.wrap(gprof2dot.Profile, name, name) for name in STAGES[1:-1]]
+    undo.append(stages.wrap(gprof2dot.DotWriter, 'graph', 'graph'))
+    Format = gprof2dot.formats[format]
+    fp = None
+    if trace_memory:
+        tracemalloc.start()
+    try:
+        if Format.stdinInput:
+            fp = open(filename, 'rt', encoding='UTF-8')
+            parser = Format(fp)
+        else:
+            parser = Format(filename)
+        stages.enter('parse')
+        try:
+            profile = parser.parse()
+        finally:
+            stages.leave()
+        # The default thresholds of the command line tool
+        profile.prune(0.005, 0.001, None, False)
+        gprof2dot.DotWriter(NullFile()).graph(profile, gprof2dot.TEMPERATURE_COLORMAP)
+    finally:
+        if fp is not None:
+            fp.close()
+        if trace_memory:
+            tracemalloc.stop()
+        for function in undo:
+            function()
+    return stages
+
+
+def run_case(format, suffix, generate, options):
+    directory = tempfile.mkdtemp()
+    try:
+        filename = os.path.join(directory, 'profile' + suffix)
+        generate(filename, options)
+        times = {}
+        for _ in range(options.repeat):
+            for stage, elapsed in run_once(format, filename, False).times.items():
+                times[stage] = min(times.get(stage, elapsed), elapsed)
+        memory = run_once(format, filename, True).memory
+        size = os.path.getsize(filename)
+    finally:
+        shutil.rmtree(directory)
+    return {
+        'input_size': size,
+        'stages': dict([(stage, {'time': times[stage], 'memory': memory[stage]}) for stage in times]),
+    }
+
+
+def run(argv):
+    optparser = optparse.OptionParser(usage="\n\t%prog run [options] [format ...]")
+    optparser.add_option('-o', '--output', metavar='FILE', help="save the results as JSON")
+    optparser.add_option('--functions', type='int', default=500, help="[default: %default]")
+    optparser.add_option('--edges', type='int', default=2000, help="call graph edges, for callgrind and gprof [default: %default]")
+    optparser.add_option('--cycles', type='int', default=10, help="recursion cycles, for callgrind [default: %default]")
+    optparser.add_option('--cycle-length', type='int', default=4, help="functions per cycle [default: %default]")
+    optparser.add_option('--no-compress', action='store_true', default=False, help="write callgrind names in full")
+    optparser.add_option('--samples', type='int', default=100000, help="samples, events or tree nodes, for the sampling formats [default: %default]")
+    optparser.add_option('--depth', type='int', default=16, help="maximum stack depth [default: %default]")
+    optparser.add_option('--repeat', type='int', default=3, help="[default: %default]")
+    options, args = optparser.parse_args(argv)
+
+    cases = [case for case in CASES if not args or case[0] in args]
+    unknown = set(args) - set([case[0] for case in CASES])
+    if unknown:
+        optparser.error('unknown formats: %s' % ', '.join(sorted(unknown)))
+
+    results = {}
+    sys.stdout.write('%-10s %-12s %10s %10s\n' % ('format', 'stage', 'seconds', 'MB'))
+    for format, suffix, generate in cases:
+        result = run_case(format, suffix, generate, options)
+        results[format] = result
+        for stage in STAGES:
+            if stage in result['stages']:
+                values = result['stages'][stage]
+                sys.stdout.write('%-10s %-12s %10.3f %10.1f\n' % (format, stage, values['time'], values['memory'] / 1e6))
+        sys.stdout.flush()
+
+    if options.output:
+        document = {
+            'python': platform.python_version(),
+            'platform': platform.platform(),
+            'options': options.__dict__,
+            'results': results,
+        }
+        with open(options.output, 'wt') as fp:
+            json.dump(document, fp, indent=2, sort_keys=True)
+            fp.write('\n')
+
+
+def compare(argv):
+    optparser = optparse.OptionParser(usage="\n\t%prog compare [options] baseline.json results.json")
+    optparser.add_option('--threshold', type='float', default=10.0, help="allowed increase, in percent [default: %default]")
+    optparser.add_option('--min-time', type='float', default=0.01, help="ignore time changes below this many seconds [default: %default]")
+    optparser.add_option('--min-memory', type='float', default=1.0, help="ignore memory changes below this many MB [default: %default]")
+    options, args = optparser.parse_args(argv)
+    if len(args) != 2:
+        optparser.error('incorrect number of arguments')
+
+    with open(args[0], 'rt') as fp:
+        baseline = json.load(fp)['results']
+    with open(args[1], 'rt') as fp:
+        results = json.load(fp)['results']
+
+    limit = 1.0 + options.threshold / 100.0
+    regressions = 0
+    sys.stdout.write('%-10s %-12s %10s %10s %8s %10s %10s %8s\n' % (
+        'format', 'stage', 'seconds', 'was', 'change', 'MB', 'was', 'change'))
+    for format in sorted(results):
+        if format not in baseline:
+            continue
+        for stage in STAGES:
+            try:
+                new = results[format]['stages'][stage]
+                old = baseline[format]['stages'][stage]
+            except KeyError:
+                continue
+            flags = []
+            changes = []
+            for key, scale, minimum in (('time', 1.0, options.min_time), ('memory', 1e-6, options.min_memory)):
+                value = new[key] * scale
+                previous = old[key] * scale
+                change = value / previous - 1.0 if previous else 0.0
+                changes.extend([value, previous, change * 100.0])
+                if value > previous * limit and value - previous >= minimum:
+                    flags.append(key)
+            sys.stdout.write('%-10s %-12s %10.3f %10.3f %+7.1f%% %10.1f %10.1f %+7.1f%%%s\n' % (
+                tuple([format, stage] + changes) + (flags and '  REGRESSION (%s)' % ', '.join(flags) or '',)))
+            if flags:
+                regressions += 1
+
+    if regressions:
+        sys.stdout.write('%u regression(s)\n' % regressions)
+        sys.exit(1)
+
+
+def main():
+    commands = {'run': run, 'compare': compare}
+    if len(sys.argv) < 2 or sys.argv[1] not in commands:
+        sys.stderr.write(__doc__)
+        sys.exit(2)
+    commands[sys.argv[1]](sys.argv[2:])
+
+
+if __name__ == '__main__':
+    main()
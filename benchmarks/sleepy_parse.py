@@ -0,0 +1,48 @@
+#!/usr/bin/env python3
+"""Measure SleepyParser throughput and peak memory on a synthetic capture.
+
+    python3 benchmarks/sleepy_parse.py [--samples 500000] [--functions 500] [--depth 16]
+
+Peak memory is the tracemalloc peak while parsing, measured in a second run
+so that tracing does not skew the timing.
+"""
+
+import optparse
+import os
+import sys
+import tempfile
+import time
+import tracemalloc
+
+from generators import gprof2dot, sleepy_zip
+
+
+def main():
+    optparser = optparse.OptionParser()
+    optparser.add_option('--samples', type='int', default=500000, help="[default: %default]")
+    optparser.add_option('--functions', type='int', default=500, help="[default: %default]")
+    optparser.add_option('--depth', type='int', default=16, help="[default: %default]")
+    options, args = optparser.parse_args()
+
+    fd, filename = tempfile.mkstemp(suffix='.sleepy')
+    os.close(fd)
+    try:
+        sleepy_zip(filename, options.samples, options.functions, options.depth)
+
+        start = time.perf_counter()
+        gprof2dot.SleepyParser(filename).parse()
+        elapsed = time.perf_counter() - start
+
+        tracemalloc.start()
+        gprof2dot.SleepyParser(filename).parse()
+        current, peak = tracemalloc.get_traced_memory()
+        tracemalloc.stop()
+    finally:
+        os.unlink(filename)
+
+    sys.stdout.write('%u callstacks in %.3f s: %.0f callstacks/s, peak %.1f MB\n' % (
+        options.samples, elapsed, options.samples / elapsed, peak / 1e6))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,122 @@
+#!/usr/bin/env python3
+"""Measure the start up cost of gprof2dot, against a time budget.
+
+    python3 benchmarks/startup.py [--repeat 10] [--budget 20] [--library DIR]
+
+Three numbers are reported, each the median over fresh interpreters:
+
+- the import time of the gprof2dot module, with its bytecode cached, as
+  told by `python -X importtime`, along with the modules it pulls in;
+- the wall time to render a small callgrind profile when gprof2dot.py is
+  run as a script, which compiles the whole source every time;
+- the same when the module is imported instead, as index.php does, so that
+  its cached bytecode is used.
+
+The exit status is 1 when the import time exceeds the budget, in
+milliseconds.  Bytecode is cached in a temporary directory, so that the
+library directory is left untouched.
+"""
+
+import optparse
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+
+from generators import callgrind_out
+
+
+LIBRARY = os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir, 'library')
+
+
+def median(values):
+    values = sorted(values)
+    return values[len(values) // 2]
+
+
+def import_time(env, library):
+    """Return the cumulative import time of gprof2dot, and the import times
+    of the modules imported on its behalf, in microseconds."""
+
+    output = subprocess.run(
+        [sys.executable, '-X', 'importtime', '-c', 'import gprof2dot'],
+        cwd=library, env=env, stderr=subprocess.PIPE, check=True, universal_newlines=True).stderr
+    # Modules are listed as they finish loading, dependencies first, and
+    # indented by their nesting level
+    modules = []
+    for line in output.splitlines():
+        if not line.startswith('import time:'):
+            continue
+        self_time, cumulative, name = line[len('import time:'):].split('|')
+        if not cumulative.strip().isdigit():
+            # The header
+            continue
+        modules.append((name.rstrip(), int(cumulative)))
+    total = None
+    nested = []
+    for name, cumulative in reversed(modules):
+        if name.strip() == 'gprof2dot':
+            total = cumulative
+        elif total is not None:
+            if name[:3] != '   ':
+                # Imported before gprof2dot, by site
+                break
+            nested.append((name.strip(), cumulative))
+    return total, nested
+
+
+def run_time(command, env, library):
+    start = time.perf_counter()
+    subprocess.run(command, cwd=library, env=env, stdout=subprocess.DEVNULL, check=True)
+    return time.perf_counter() - start
+
+
+def main():
+    optparser = optparse.OptionParser()
+    optparser.add_option('--repeat', type='int', default=10, help="[default: %default]")
+    optparser.add_option('--budget', type='float', default=20.0, help="import time budget, in milliseconds [default: %default]")
+    optparser.add_option('--library', default=LIBRARY, help="directory holding gprof2dot.py [default: this tree]")
+    options, args = optparser.parse_args()
+    library = os.path.abspath(options.library)
+
+    directory = tempfile.mkdtemp()
+    try:
+        env = dict(os.environ)
+        env.pop('PYTHONDONTWRITEBYTECODE', None)
+        env['PYTHONPYCACHEPREFIX'] = os.path.join(directory, 'pycache')
+
+        profile = os.path.join(directory, 'cachegrind.out')
+        with open(profile, 'wt') as fp:
+            callgrind_out(fp, 20, 40)
+
+        # Prime the bytecode cache
+        import_time(env, library)
+
+        times = []
+        for _ in range(options.repeat):
+            total, nested = import_time(env, library)
+            times.append(total)
+        imported = median(times) / 1000.0
+
+        script = [sys.executable, os.path.join(library, 'gprof2dot.py'), '-f', 'callgrind', profile]
+        module = [sys.executable, '-c', 'import gprof2dot; gprof2dot.main()', '-f', 'callgrind', profile]
+        script_time = median([run_time(script, env, library) for _ in range(options.repeat)])
+        module_time = median([run_time(module, env, library) for _ in range(options.repeat)])
+    finally:
+        shutil.rmtree(directory)
+
+    sys.stdout.write('import gprof2dot: %.1f ms (budget %.1f ms)\n' % (imported, options.budget))
+    for name, cumulative in sorted(nested, key=lambda item: -item[1])[:10]:
+        sys.stdout.write('    %-24s %6.1f ms\n' % (name, cumulative / 1000.0))
+    sys.stdout.write('render, run as a script: %.1f ms\n' % (script_time * 1000.0))
+    sys.stdout.write('render, imported:        %.1f ms\n' % (module_time * 1000.0))
+
+    if imported > options.budget:
+        sys.stdout.write('over budget\n')
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
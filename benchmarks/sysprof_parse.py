@@ -0,0 +1,54 @@
+#!/usr/bin/env python3
+"""Measure SysprofParser throughput and peak memory on a synthetic capture.
+
+    python3 benchmarks/sysprof_parse.py [--nodes 200000] [--functions 500]
+
+The capture is written to a temporary file and parsed from disk, as the
+command line tool does.  Peak memory is the tracemalloc peak while parsing,
+measured in a second run so that tracing does not skew the timing.
+"""
+
+import optparse
+import os
+import sys
+import tempfile
+import time
+import tracemalloc
+
+from generators import gprof2dot, sysprof_xml
+
+
+def parse(filename):
+    with open(filename, 'rt') as fp:
+        return gprof2dot.SysprofParser(fp).parse()
+
+
+def main():
+    optparser = optparse.OptionParser()
+    optparser.add_option('--nodes', type='int', default=200000, help="[default: %default]")
+    optparser.add_option('--functions', type='int', default=500, help="[default: %default]")
+    options, args = optparser.parse_args()
+
+    fd, filename = tempfile.mkstemp(suffix='.xml')
+    try:
+        with os.fdopen(fd, 'wt') as fp:
+            sysprof_xml(fp, options.nodes, options.functions)
+        size = os.path.getsize(filename)
+
+        start = time.perf_counter()
+        parse(filename)
+        elapsed = time.perf_counter() - start
+
+        tracemalloc.start()
+        parse(filename)
+        current, peak = tracemalloc.get_traced_memory()
+        tracemalloc.stop()
+    finally:
+        os.unlink(filename)
+
+    sys.stdout.write('%u nodes, %.1f MB in %.3f s: %.1f MB/s, %.0f nodes/s, peak %.1f MB\n' % (
+        options.nodes, size / 1e6, elapsed, size / 1e6 / elapsed, options.nodes / elapsed, peak / 1e6))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,76 @@
+#!/usr/bin/env python3
+"""Check the accuracy and speed of the quantized Theme style lookup.
+
+Every theme is evaluated on random weights, both exactly and through the
+lookup table, and the largest deviation of each style component is reported.
+The exit status is non-zero when a color channel is off by more than
+--max-color-error levels (out of 255) or a size by more than --max-size-error.
+
+    python3 benchmarks/theme_lookup.py [--resolutions 1024,4096] [--samples 100000]
+"""
+
+import optparse
+import random
+import sys
+import time
+
+from generators import gprof2dot
+
+
+def channels(color):
+    return [int(color[i:i + 2], 16) for i in (1, 3, 5)]
+
+
+def main():
+    optparser = optparse.OptionParser()
+    optparser.add_option('--resolutions', default='1024,4096', help="[default: %default]")
+    optparser.add_option('--samples', type='int', default=100000, help="[default: %default]")
+    optparser.add_option('--skew', type='float', default=1.0, help="[default: %default]")
+    optparser.add_option('--max-color-error', type='int', default=1, help="[default: %default]")
+    optparser.add_option('--max-size-error', type='float', default=0.05, help="[default: %default]")
+    options, args = optparser.parse_args()
+
+    rng = random.Random(0)
+    weights = [rng.random() for _ in range(options.samples)]
+    resolutions = [int(resolution) for resolution in options.resolutions.split(',')]
+
+    failed = False
+    sys.stdout.write('%-6s %6s %9s %9s %9s %9s %10s %10s\n' % (
+        'theme', 'steps', 'color', 'fontsize', 'penwidth', 'arrowsize', 'exact us', 'lookup us'))
+    for name, theme in sorted(gprof2dot.themes.items()):
+        theme.skew = options.skew
+
+        theme.resolution = 0
+        exact = theme.style_lookup()
+        start = time.perf_counter()
+        expected = [exact(weight) for weight in weights]
+        exact_time = time.perf_counter() - start
+
+        for resolution in resolutions:
+            theme.resolution = resolution
+            lookup = theme.style_lookup()
+            start = time.perf_counter()
+            actual = [lookup(weight) for weight in weights]
+            lookup_time = time.perf_counter() - start
+
+            errors = [0, 0.0, 0.0, 0.0]
+            for a, e in zip(actual, expected):
+                for x, y in zip(channels(a[0]), channels(e[0])):
+                    errors[0] = max(errors[0], abs(x - y))
+                for i in (1, 2, 3):
+                    errors[i] = max(errors[i], abs(a[i] - e[i]))
+
+            if errors[0] > options.max_color_error or max(errors[1:]) > options.max_size_error:
+                failed = True
+            sys.stdout.write('%-6s %6u %9u %9.4f %9.4f %9.4f %10.3f %10.3f\n' % (
+                name, resolution, errors[0], errors[1], errors[2], errors[3],
+                exact_time / len(weights) * 1e6, lookup_time / len(weights) * 1e6))
+        theme.resolution = 0
+
+    if failed:
+        sys.stdout.write('error: lookup deviates from the exact styles beyond the tolerance\n')
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,35 @@
+#!/usr/bin/env python3
+"""Measure XPerfParser throughput in rows per second.
+
+    python3 benchmarks/xperf_parse.py [--rows 200000] [--functions 5000] [--depth 16]
+"""
+
+import io
+import optparse
+import sys
+import time
+
+from generators import gprof2dot, xperf_csv
+
+
+def main():
+    optparser = optparse.OptionParser()
+    optparser.add_option('--rows', type='int', default=200000, help="[default: %default]")
+    optparser.add_option('--functions', type='int', default=5000, help="[default: %default]")
+    optparser.add_option('--depth', type='int', default=16, help="[default: %default]")
+    options, args = optparser.parse_args()
+
+    fp = io.StringIO()
+    xperf_csv(fp, options.rows, options.functions, options.depth)
+    data = fp.getvalue()
+
+    start = time.perf_counter()
+    gprof2dot.XPerfParser(io.StringIO(data, newline='')).parse()
+    elapsed = time.perf_counter() - start
+
+    sys.stdout.write('%u rows, %.1f MB in %.3f s: %.0f rows/s\n' % (
+        options.rows, len(data) / 1e6, elapsed, options.rows / elapsed))
+
+
+if __name__ == '__main__':
+    main()
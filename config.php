@@ -15,6 +15,10 @@ class Webgrind_Config extends Webgrind_MasterConfig {
     /**
      * Writable dir for information storage.
      * If empty, will use system tmp folder or xdebug tmp
+     * Call graphs are cached here, each with a '.lock' file that makes
+     * concurrent requests for the graph wait for a single render. The lock
+     * files are small and kept, as the graphs are; "clear files" removes
+     * both along with the profiles.
      */
     static $storageDir = '';
     static $profilerDir = '/tmp';
@@ -38,6 +42,9 @@ class Webgrind_Config extends Webgrind_MasterConfig {
 
     /**
      * Path to python executable
+     * Python caches the compiled library/gprof2dot.py in library/__pycache__,
+     * which takes write permission on library/ for the web server user;
+     * without it the script is compiled again on every graph.
      */
     static $pythonExecutable = '/usr/bin/python3';
 
@@ -46,6 +53,33 @@ class Webgrind_Config extends Webgrind_MasterConfig {
      */
     static $dotExecutable = '/usr/bin/dot';
 
+    /**
+     * Upper bounds on the call graph size. Graphviz layout time grows faster
+     * than linearly with the graph size, so large profiles can be trimmed to
+     * their heaviest nodes and edges, keeping every node reachable from the
+     * root. Use 0 for no limit. The limits are off by default, since no
+     * layout timings back a default: run benchmarks/dot_layout.py on the
+     * server to find the largest size dot lays out in an acceptable time,
+     * and set both here. Until then only the graph's node and edge
+     * thresholds bound its size, not its layout time.
+     */
+    static $graphMaxNodes = 0;
+    static $graphMaxEdges = 0;
+
+    /**
+     * Seconds to wait for graphviz to render the call graph. Use 0 for no limit.
+     */
+    static $graphTimeout = 60;
+
+    /**
+     * Group the functions of the call graph by 'class', 'file', 'namespace'
+     * or 'module' (the ob= object file, which Xdebug does not write), for a
+     * graph of very large profiles that is readable and quick to render.
+     * PHP internal functions are then folded into their callers. Use '' to
+     * show every function.
+     */
+    static $graphAggregate = '';
+
     /**
      * sprintf compatible format for generating links to source files.
      * %1$s will be replaced by the full path name of the file
@@ -145,23 +145,52 @@ try {
         case 'function_graph':
             $dataFile = get('dataFile');
             $showFraction = 100 - intval(get('showFraction') * 100);
+            $hideInternals = (int)get('hideInternals', 0);
             if ($dataFile == '0') {
                 $files = Webgrind_FileHandler::getInstance()->getTraceList();
                 $dataFile = $files[0]['filename'];
             }
 
-            $filename = Webgrind_Config::storageDir().$dataFile.'-'.$showFraction.Webgrind_Config::$preprocessedSuffix.'.'.Webgrind_Config::$graphImageType;
+            $aggregate = Webgrind_Config::$graphAggregate;
+            if ($aggregate) {
+                // As a group of their own, internal functions would call and
+                // be called by most other groups, making a cycle of nearly
+                // the whole graph
+                $hideInternals = 1;
+            }
+            $filename = Webgrind_Config::storageDir().$dataFile.'-'.$showFraction.($hideInternals ? '-hideinternals' : '')
+                       .($aggregate ? '-'.$aggregate : '')
+                       .Webgrind_Config::$preprocessedSuffix.'.'.Webgrind_Config::$graphImageType;
             if (!file_exists($filename)) {
                 // Add enclosing quotes if needed
-                foreach (array('pythonExecutable', 'dotExecutable') as $exe) {
-                    $item =& Webgrind_Config::$$exe;
-                    if (strpos($item, ' ') !== false && !preg_match('/^".+"$/', $item)) {
-                        $item = '"'.$item.'"';
-                    }
+                $python = Webgrind_Config::$pythonExecutable;
+                if (strpos($python, ' ') !== false && !preg_match('/^".+"$/', $python)) {
+                    $python = '"'.$python.'"';
+                }
+                // Import gprof2dot rather than run it as a script, so that
+                // Python can reuse its compiled bytecode. gprof2dot runs dot
+                // itself and only writes the image once complete; concurrent
+                // requests for the same graph wait for the first one and
+                // reuse its output. Proxy functions, and internal functions
+                // when hidden, are spliced out of the graph as it is parsed,
+                // and functions are grouped as configured.
+                $graphOptions = $hideInternals ? ' --fold-internal' : '';
+                foreach (Webgrind_Config::$proxyFunctions as $function) {
+                    $graphOptions .= ' --proxy '.escapeshellarg($function);
+                }
+                if ($aggregate) {
+                    $graphOptions .= ' --aggregate '.escapeshellarg($aggregate);
                 }
-                shell_exec(Webgrind_Config::$pythonExecutable.' library/gprof2dot.py -n '.$showFraction
-                           .' -f callgrind '.escapeshellarg(Webgrind_Config::xdebugOutputDir().$dataFile).' | '
-                           .Webgrind_Config::$dotExecutable.' -T'.Webgrind_Config::$graphImageType.' -o '.escapeshellarg($filename));
+                shell_exec($python.' -c '.escapeshellarg("import sys; sys.path.insert(0, 'library'); import gprof2dot; gprof2dot.main()")
+                           .' -n '.$showFraction
+                           .' --max-nodes '.intval(Webgrind_Config::$graphMaxNodes)
+                           .' --max-edges '.intval(Webgrind_Config::$graphMaxEdges)
+                           .' -T '.escapeshellarg(Webgrind_Config::$graphImageType)
+                           .' --dot '.escapeshellarg(trim(Webgrind_Config::$dotExecutable, '"'))
+                           .' --timeout '.floatval(Webgrind_Config::$graphTimeout)
+                           .$graphOptions
+                           .' --single-flight -o '.escapeshellarg($filename)
+                           .' -f callgrind '.escapeshellarg(Webgrind_Config::xdebugOutputDir().$dataFile));
             }
 
             if (!file_exists($filename)) {
@@ -25,13 +25,9 @@ import sys
 import math
 import os.path
 import re
-import textwrap
-import optparse
-import xml.parsers.expat
 import collections
-import locale
-import json
-import fnmatch
+import time
+import io
 
 # Python 2.x/3.x compatibility
 if sys.version_info[0] >= 3:
@@ -49,6 +45,29 @@ else:
     def compat_keys(x): return x.keys()
 
 
+class LazyRegex(object):
+    """Regular expression class attribute, compiled on first use.
+
+    Importing the module then does not compile the expressions of every
+    parser, when only one is used.  On first access the compiled expression
+    replaces the attribute, so later accesses cost nothing extra.
+    """
+
+    def __init__(self, pattern, flags=0):
+        self.pattern = pattern
+        self.flags = flags
+
+    def __get__(self, instance, owner):
+        regex = re.compile(self.pattern, self.flags)
+        for cls in getattr(owner, '__mro__', (owner,)):
+            names = [name for name, value in compat_iteritems(vars(cls)) if value is self]
+            if names:
+                for name in names:
+                    setattr(cls, name, regex)
+                break
+        return regex
+
+
 
 ########################################################################
 # Model
@@ -89,6 +108,21 @@ def ratio(numerator, denominator):
     return ratio
 
 
+def apportion(total, shares):
+    """Split a whole number in proportion to shares of at most one each,
+    into whole numbers that add up to the total times the sum of the shares,
+    rounded, by the largest remainder method."""
+
+    quotas = [total * share for share in shares]
+    counts = [int(quota) for quota in quotas]
+    remainder = int(round(sum(quotas))) - sum(counts)
+    if remainder > 0:
+        largest = sorted(range(len(quotas)), key=lambda i: counts[i] - quotas[i])
+        for i in largest[:remainder]:
+            counts[i] += 1
+    return counts
+
+
 class UndefinedEvent(Exception):
     """Raised when attempting to get an event which is undefined."""
 
@@ -141,7 +175,7 @@ SAMPLES2 = Event("Samples", 0, add, times)
 # "that recursion is a tricky confusing issue"), last edited 2012-08-30: it's
 # just the ratio of TOTAL_SAMPLES over the number of samples in the profile.
 #
-# Used only when totalMethod == callstacks
+# Used only when the total method is callstacks
 TOTAL_SAMPLES = Event("Samples", 0, add, times)
 
 TIME = Event("Time", 0.0, add, lambda x: '(' + str(x) + ')')
@@ -149,7 +183,163 @@ TIME_RATIO = Event("Time ratio", 0.0, add, lambda x: '(' + percentage(x) + ')')
 TOTAL_TIME = Event("Total time", 0.0, fail)
 TOTAL_TIME_RATIO = Event("Total time ratio", 0.0, fail, percentage)
 
-totalMethod = 'callratios'
+
+class Stats:
+    """Per-phase wall time, CPU time and memory peak, and profile counters,
+    as reported by --stats.
+
+    Phases nest, and the time of nested phases is excluded from the
+    enclosing one.  The memory peak of a phase is the tracemalloc peak above
+    the memory in use when the phase started, and includes nested phases.
+    """
+
+    if PYTHON_3:
+        wall_clock = staticmethod(time.perf_counter)
+        cpu_clock = staticmethod(time.process_time)
+    else:
+        wall_clock = staticmethod(time.time)
+        cpu_clock = staticmethod(time.clock)
+
+    def __init__(self):
+        self.phases = collections.OrderedDict()
+        self.counters = collections.OrderedDict()
+        self.stack = []
+        self.tracemalloc = None
+        self.peak_memory = None
+
+    def start(self):
+        """Start tracing memory allocations, where supported, and listen to
+        phases."""
+        try:
+            import tracemalloc
+        except ImportError:
+            pass
+        else:
+            # Per-phase peaks need reset_peak, new in Python 3.9
+            if hasattr(tracemalloc, 'reset_peak'):
+                tracemalloc.start()
+                self.tracemalloc = tracemalloc
+        phase_listeners.append(self)
+
+    def stop(self):
+        phase_listeners.remove(self)
+        if self.tracemalloc is not None:
+            self.peak_memory = self.tracemalloc.get_traced_memory()[1]
+            self.tracemalloc.stop()
+            self.tracemalloc = None
+
+    def checkpoint(self):
+        """Fold the memory peak since the last checkpoint into the open
+        phases, and return the memory currently in use."""
+        if self.tracemalloc is None:
+            return None
+        current, peak = self.tracemalloc.get_traced_memory()
+        for frame in self.stack:
+            frame[4] = max(frame[4], peak)
+        self.tracemalloc.reset_peak()
+        return current
+
+    def enter(self, name):
+        if name not in self.phases:
+            self.phases[name] = collections.OrderedDict([
+                ('count', 0), ('wall', 0.0), ('cpu', 0.0), ('peak_memory', None)])
+        current = self.checkpoint()
+        # name, wall and cpu start, wall and cpu time of nested phases, peak
+        # memory, memory at start
+        self.stack.append([name, self.wall_clock(), self.cpu_clock(), [0.0, 0.0], current, current])
+
+    def leave(self):
+        wall, cpu = self.wall_clock(), self.cpu_clock()
+        self.checkpoint()
+        name, wall_start, cpu_start, nested, peak, base = self.stack.pop()
+        wall -= wall_start
+        cpu -= cpu_start
+        if self.stack:
+            parent = self.stack[-1][3]
+            parent[0] += wall
+            parent[1] += cpu
+        phase = self.phases[name]
+        phase['count'] += 1
+        phase['wall'] += wall - nested[0]
+        phase['cpu'] += cpu - nested[1]
+        if peak is not None:
+            phase['peak_memory'] = max(phase['peak_memory'] or 0, peak - base)
+
+    def count_profile(self, profile, functions, calls):
+        """Record the number of functions and calls under the given names."""
+        self.counters[functions] = len(profile.functions)
+        self.counters[calls] = sum([len(function.calls) for function in compat_itervalues(profile.functions)])
+
+    def dump(self, fp):
+        import json
+        json.dump(collections.OrderedDict([
+            ('phases', self.phases),
+            ('peak_memory', self.peak_memory),
+            ('counters', self.counters),
+        ]), fp, indent=2)
+        fp.write('\n')
+
+
+try:
+    from _thread import _local as thread_local
+except ImportError:
+    from thread import _local as thread_local
+
+
+class PhaseListeners(thread_local):
+    """Objects told when a phase starts and ends, through their enter(name)
+    and leave() methods.
+
+    Listeners are per thread, so that profiles rendered concurrently do not
+    report to each other's listeners.
+    """
+
+    def __init__(self):
+        self.listeners = []
+
+    def __len__(self):
+        return len(self.listeners)
+
+    def __iter__(self):
+        return iter(self.listeners)
+
+    def append(self, listener):
+        self.listeners.append(listener)
+
+    def remove(self, listener):
+        self.listeners.remove(listener)
+
+
+phase_listeners = PhaseListeners()
+
+
+def enter_phase(name):
+    for listener in phase_listeners:
+        listener.enter(name)
+
+
+def leave_phase():
+    for listener in phase_listeners:
+        listener.leave()
+
+
+def phase(name):
+    """Decorator that reports each call of a method as a phase to the phase
+    listeners."""
+
+    def decorator(method):
+        def wrapper(*args, **kwargs):
+            if not phase_listeners:
+                return method(*args, **kwargs)
+            enter_phase(name)
+            try:
+                return method(*args, **kwargs)
+            finally:
+                leave_phase()
+        wrapper.__name__ = method.__name__
+        wrapper.__doc__ = method.__doc__
+        return wrapper
+    return decorator
 
 
 class Object(object):
@@ -229,9 +419,9 @@ class Function(Object):
             self.calls[callee_id] = call
         return self.calls[callee_id]
 
-    _parenthesis_re = re.compile(r'\([^()]*\)')
-    _angles_re = re.compile(r'<[^<>]*>')
-    _const_re = re.compile(r'\s+const$')
+    _parenthesis_re = LazyRegex(r'\([^()]*\)')
+    _angles_re = LazyRegex(r'<[^<>]*>')
+    _const_re = LazyRegex(r'\s+const$')
 
     def stripped_name(self):
         """Remove extraneous information from C++ demangled function names."""
@@ -294,6 +484,116 @@ class Profile(Object):
     def add_cycle(self, cycle):
         self.cycles.append(cycle)
 
+    def fold(self, function_ids, self_event, call_event):
+        """Remove functions, charging their cost to their callers.
+
+        Each caller gets a share of the removed function's self cost and
+        calls, in proportion to the cost of its call to the function out of
+        the function's inclusive cost, so that the cost of the caller's call
+        is preserved.  Call counts are shared out in whole numbers, and the
+        callees' counts of calls received adjusted to match.  The cost of
+        functions without callers is dropped from the graph, though not from
+        the profile total.
+        """
+
+        callers = {}
+        for function in compat_itervalues(self.functions):
+            for callee_id in function.calls:
+                callers.setdefault(callee_id, set()).add(function.id)
+
+        # In order, so that call counts are rounded alike on every run
+        for function_id in sorted(function_ids):
+            function = self.functions.pop(function_id)
+            calls = [call for call in compat_itervalues(function.calls) if call.callee_id != function_id]
+            for call in calls:
+                callers.get(call.callee_id, set()).discard(function_id)
+            inclusive = function[self_event] + sum([call[call_event] for call in calls])
+            shares = []
+            for caller_id in sorted(callers.pop(function_id, ())):
+                if caller_id == function_id:
+                    continue
+                caller = self.functions[caller_id]
+                call = caller.calls.pop(function_id)
+                if inclusive:
+                    shares.append((caller, min(call[call_event] / float(inclusive), 1.0)))
+            for caller, share in shares:
+                caller[self_event] += function[self_event] * share
+            for subcall in calls:
+                counts = None
+                if CALLS in subcall:
+                    counts = apportion(subcall[CALLS], [share for caller, share in shares])
+                    callee = self.functions[subcall.callee_id]
+                    if callee.called is not None:
+                        callee.called += sum(counts) - subcall[CALLS]
+                for i, (caller, share) in enumerate(shares):
+                    try:
+                        caller_call = caller.calls[subcall.callee_id]
+                    except KeyError:
+                        caller_call = Call(subcall.callee_id)
+                        caller_call[call_event] = 0
+                        caller_call[CALLS] = 0
+                        caller.add_call(caller_call)
+                        callers.setdefault(subcall.callee_id, set()).add(caller.id)
+                    caller_call[call_event] += subcall[call_event] * share
+                    if counts is not None:
+                        caller_call[CALLS] += counts[i]
+
+    @phase('aggregate')
+    def group(self, groups, self_event, call_event):
+        """Return a coarser profile, with a function for every group of
+        functions.
+
+        groups maps the id of every function to the name of its group.  Self
+        costs, and the cost and count of calls between groups, are summed.
+        Calls within a group are left out, their cost being part of the
+        group's self cost already.
+        """
+
+        profile = Profile()
+        profile.events = dict(self.events)
+        modules = {}
+        for function in compat_itervalues(self.functions):
+            name = groups[function.id]
+            try:
+                group = profile.functions[name]
+            except KeyError:
+                group = Function(name, name)
+                group[self_event] = 0
+                group.called = 0
+                profile.add_function(group)
+            group[self_event] += function[self_event]
+            if function.called is not None:
+                group.called += function.called
+            modules.setdefault(name, set()).add(function.module)
+
+        for function in compat_itervalues(self.functions):
+            group = profile.functions[groups[function.id]]
+            for call in compat_itervalues(function.calls):
+                callee = profile.functions[groups[call.callee_id]]
+                if callee is group:
+                    if CALLS in call:
+                        group.called -= call[CALLS]
+                    continue
+                try:
+                    group_call = group.calls[callee.id]
+                except KeyError:
+                    group_call = Call(callee.id)
+                    group_call[call_event] = 0
+                    group_call[CALLS] = 0
+                    group.add_call(group_call)
+                group_call[call_event] += call[call_event]
+                if CALLS in call:
+                    group_call[CALLS] += call[CALLS]
+
+        # Keep the module of groups within a single one
+        for name, group_modules in compat_iteritems(modules):
+            if len(group_modules) == 1:
+                module = group_modules.pop()
+                if module != name:
+                    profile.functions[name].module = module
+        return profile
+
+    @phase('validate')
     def validate(self):
         """Validate the edges."""
 
@@ -304,6 +604,7 @@ class Profile(Object):
                     sys.stderr.write('warning: call to undefined function %s from function %s\n' % (str(callee_id), function.name))
                     del function.calls[callee_id]
 
+    @phase('find_cycles')
     def find_cycles(self):
         """Find cycles using Tarjan's strongly connected components algorithm."""
 
@@ -324,6 +625,7 @@ class Profile(Object):
                 for member in cycle.functions:
                     sys.stderr.write("\tFunction %s\n" % member.name)
 
+    @phase('prune_root')
     def prune_root(self, roots, depth=-1):
         visited = set()
         frontier = set([(root_node, depth) for root_node in roots])
@@ -346,6 +648,7 @@ class Profile(Object):
             subtreeFunctions[n] = f
         self.functions = subtreeFunctions
 
+    @phase('prune_leaf')
     def prune_leaf(self, leafs, depth=-1):
         edgesUp = collections.defaultdict(set)
         for f in self.functions.keys():
@@ -376,6 +679,7 @@ class Profile(Object):
         self.functions = pathFunctions
 
     def getFunctionIds(self, funcName):
+        import fnmatch
         function_names = {v.name: k for (k, v) in self.functions.items()}
         return [function_names[name] for name in fnmatch.filter(function_names.keys(), funcName)]
 
@@ -432,6 +736,7 @@ class Profile(Object):
                     data[member.id].onstack = False
         return order
 
+    @phase('call_ratios')
     def call_ratios(self, event):
         # Aggregate for incoming calls
         cycle_totals = {}
@@ -473,6 +778,52 @@ class Profile(Object):
                         # Warnings here would only repeat those issued above.
                         call.ratio = 0.0
 
+    @phase('inclusive')
+    def inclusive(self, outevent, inevent, callevent):
+        """Compute the total ratio of functions and calls from the inclusive
+        cost of each call, in a single pass.
+
+        For formats like callgrind, whose call costs are exact inclusive
+        costs, this replaces call_ratios() and integrate().  The total of a
+        function is its self cost plus the cost of its calls to other
+        functions, which is exact unless the function is in a cycle of
+        mutually recursive functions: there, the cost of the calls within
+        the cycle overlaps with the self cost of nested activations, so the
+        sum overstates the total.  It is capped to the total of the cycle as
+        a whole, the self cost of its members plus the cost of the calls
+        leaving it, which is exact, but totals within cycles are only upper
+        bounds.
+
+        Must be called after finding the cycles.
+        """
+
+        assert outevent not in self
+        total = self[inevent]
+        subtotals = {}
+        cycle_totals = {}
+        for function in compat_itervalues(self.functions):
+            assert outevent not in function
+            cycle = function.cycle
+            subtotal = function[inevent]
+            # Self cost plus the calls leaving the cycle
+            leaving = function[inevent]
+            for call in compat_itervalues(function.calls):
+                assert outevent not in call
+                if call.callee_id != function.id:
+                    subtotal += call[callevent]
+                    if cycle is None or self.functions[call.callee_id].cycle is not cycle:
+                        leaving += call[callevent]
+                call[outevent] = ratio(min(call[callevent], total), total)
+            if cycle is None:
+                function[outevent] = ratio(subtotal, total)
+            else:
+                subtotals[function] = subtotal
+                cycle_totals[cycle] = cycle_totals.get(cycle, 0) + leaving
+        for function, subtotal in compat_iteritems(subtotals):
+            function[outevent] = ratio(min(subtotal, cycle_totals[function.cycle]), total)
+        self[outevent] = 1.0
+
+    @phase('integrate')
     def integrate(self, outevent, inevent):
         """Propagate function time ratio along the function calls.
 
@@ -668,6 +1019,7 @@ class Profile(Object):
                 return
         self[event] = total
 
+    @phase('ratio')
     def ratio(self, outevent, inevent):
         assert outevent not in self
         assert inevent in self
@@ -681,7 +1033,8 @@ class Profile(Object):
                     call[outevent] = ratio(call[inevent], self[inevent])
         self[outevent] = 1.0
 
-    def prune(self, node_thres, edge_thres, paths, color_nodes_by_selftime):
+    @phase('prune')
+    def prune(self, node_thres, edge_thres, paths, color_nodes_by_selftime, max_nodes=None, max_edges=None):
         """Prune the profile"""
 
         # compute the prune ratios
@@ -712,10 +1065,12 @@ class Profile(Object):
                     del self.functions[function_id]
 
         # prune file paths
-        for function_id in compat_keys(self.functions):
-            function = self.functions[function_id]
-            if paths and not any(function.filename.startswith(path) for path in paths):
-                del self.functions[function_id]
+        if paths:
+            trie = PathTrie(paths)
+            for function_id in compat_keys(self.functions):
+                function = self.functions[function_id]
+                if not trie.match(function.filename):
+                    del self.functions[function_id]
 
         # prune the egdes
         for function in compat_itervalues(self.functions):
@@ -724,6 +1079,10 @@ class Profile(Object):
                 if callee_id not in self.functions or call.weight is not None and call.weight < edge_thres:
                     del function.calls[callee_id]
 
+        # bound the graph size, as dot layout time grows super-linearly with it
+        if max_nodes or max_edges:
+            self.limit(max_nodes, max_edges)
+
         if color_nodes_by_selftime:
             weights = []
             for function in compat_itervalues(self.functions):
@@ -740,6 +1099,107 @@ class Profile(Object):
                 except (ZeroDivisionError, UndefinedEvent):
                     pass
 
+    def limit(self, max_nodes=None, max_edges=None):
+        """Bound the number of nodes and edges of the graph.
+
+        Nodes are admitted heaviest first, but only after one of their callers
+        was admitted, so that every kept node remains reachable from a root.
+        The edges through which nodes were reached are always kept, whichever
+        cap applies, and the rest of the edge budget goes to the heaviest
+        remaining edges.  Cycles that no root calls are entered at their
+        heaviest node.
+        """
+
+        import heapq
+
+        def weight(obj):
+            if obj.weight is None:
+                return 0.0
+            return obj.weight
+
+        num_nodes = len(self.functions)
+        num_edges = 0
+        for function in compat_itervalues(self.functions):
+            num_edges += len(function.calls)
+
+        # a connected graph with N nodes needs at least N - 1 edges
+        if max_edges and (not max_nodes or max_nodes > max_edges + 1):
+            max_nodes = max_edges + 1
+
+        # Spanning tree from the roots, as the parent of every admitted node
+        parents = {}
+        if max_nodes and num_nodes > max_nodes or max_edges and num_edges > max_edges:
+            if not max_nodes or max_nodes > num_nodes:
+                max_nodes = num_nodes
+            called = set()
+            for function in compat_itervalues(self.functions):
+                for callee_id in function.calls:
+                    if callee_id != function.id:
+                        called.add(callee_id)
+
+            ranked = sorted(compat_itervalues(self.functions), key=weight)
+
+            queue = []
+            order = 0
+            for function in compat_itervalues(self.functions):
+                if function.id not in called:
+                    queue.append((-weight(function), order, function.id, None))
+                    order += 1
+            heapq.heapify(queue)
+
+            while len(parents) < max_nodes:
+                if not queue:
+                    # seed components that are not reachable from any root
+                    while ranked[-1].id in parents:
+                        ranked.pop()
+                    function = ranked.pop()
+                    queue.append((-weight(function), order, function.id, None))
+                    order += 1
+                _, _, function_id, parent_id = heapq.heappop(queue)
+                if function_id in parents:
+                    continue
+                parents[function_id] = parent_id
+                for call in compat_itervalues(self.functions[function_id].calls):
+                    if call.callee_id not in parents:
+                        callee = self.functions[call.callee_id]
+                        heapq.heappush(queue, (-weight(callee), order, callee.id, function_id))
+                        order += 1
+
+            if len(parents) < num_nodes:
+                for function_id in compat_keys(self.functions):
+                    if function_id not in parents:
+                        del self.functions[function_id]
+                for function in compat_itervalues(self.functions):
+                    for callee_id in compat_keys(function.calls):
+                        if callee_id not in self.functions:
+                            del function.calls[callee_id]
+
+        kept_edges = 0
+        for function in compat_itervalues(self.functions):
+            kept_edges += len(function.calls)
+
+        if max_edges and kept_edges > max_edges:
+            budget = max_edges
+            edges = []
+            for function in compat_itervalues(self.functions):
+                for call in compat_itervalues(function.calls):
+                    if parents.get(call.callee_id) == function.id:
+                        budget -= 1
+                    else:
+                        edges.append((function, call))
+            edges.sort(key=lambda edge: weight(edge[1]), reverse=True)
+            for function, call in edges[max(budget, 0):]:
+                del function.calls[call.callee_id]
+            kept_edges = max_edges - min(budget, 0)
+
+        if len(self.functions) < num_nodes or kept_edges < num_edges:
+            node_thres = min([weight(function) for function in compat_itervalues(self.functions)] or [0.0])
+            edge_thres = min([weight(call) for function in compat_itervalues(self.functions) for call in compat_itervalues(function.calls)] or [0.0])
+            sys.stderr.write('warning: dropped %u of %u nodes and %u of %u edges (effective thresholds: node %s, edge %s)\n' % (
+                num_nodes - len(self.functions), num_nodes,
+                num_edges - kept_edges, num_edges,
+                percentage(node_thres), percentage(edge_thres)))
+
     def dump(self):
         for function in compat_itervalues(self.functions):
             sys.stderr.write('Function %s:\n' % (function.name,))
@@ -759,6 +1219,127 @@ class Profile(Object):
             sys.stderr.write('    %s: %s\n' % (event.name, event.format(value)))
 
 
+class PathTrie:
+    """A set of path prefixes, matched in a single walk of the path."""
+
+    def __init__(self, prefixes):
+        self.root = {}
+        for prefix in prefixes:
+            node = self.root
+            for char in prefix:
+                node = node.setdefault(char, {})
+            # End of a prefix
+            node[None] = True
+
+    def match(self, path):
+        """Tell whether one of the prefixes starts the path."""
+        if path is None:
+            return False
+        node = self.root
+        for char in path:
+            if None in node:
+                return True
+            node = node.get(char)
+            if node is None:
+                return False
+        return None in node
+
+
+class FilterRules:
+    """A compiled list of function filter rules.
+
+    A rule is a glob matched against the function name, or, with a prefix,
+    "re:" a regular expression searched in the name, "path:" a prefix of
+    the function's file path, or "module:" a glob matched against its
+    module.
+    """
+
+    def __init__(self, rules):
+        import fnmatch
+
+        names = []
+        paths = []
+        modules = []
+        for rule in rules:
+            kind, sep, pattern = rule.partition(':')
+            if sep and kind == 're':
+                names.append('(?:%s)' % pattern)
+            elif sep and kind == 'path':
+                paths.append(pattern)
+            elif sep and kind == 'module':
+                modules.append(fnmatch.translate(pattern))
+            else:
+                if sep and kind == 'name':
+                    rule = pattern
+                names.append('^' + fnmatch.translate(rule))
+        self.names = names and re.compile('|'.join(names)) or None
+        self.paths = paths and PathTrie(paths) or None
+        self.modules = modules and re.compile('|'.join(modules)) or None
+
+    def match(self, name, module, filename):
+        if self.names is not None and self.names.search(name):
+            return True
+        if self.paths is not None and self.paths.match(filename):
+            return True
+        if self.modules is not None and module is not None and self.modules.match(module):
+            return True
+        return False
+
+
+class FunctionFilter:
+    """Decide which functions to keep while parsing.
+
+    A function is kept when it matches one of the include rules, or there
+    are none, and none of the exclude rules; see FilterRules for the rule
+    syntax.  Decisions are cached, as parsers ask about the same functions
+    over and over.
+    """
+
+    def __init__(self, include=(), exclude=()):
+        self.include = include and FilterRules(include) or None
+        self.exclude = exclude and FilterRules(exclude) or None
+        self.cache = {}
+
+    def match(self, name, module=None, filename=None):
+        """Tell whether to keep the function with that name, module and
+        file."""
+        key = (name, module, filename)
+        try:
+            return self.cache[key]
+        except KeyError:
+            pass
+        keep = (self.include is None or self.include.match(name, module, filename)) and \
+            (self.exclude is None or not self.exclude.match(name, module, filename))
+        self.cache[key] = keep
+        return keep
+
+    def keep(self, function):
+        return self.match(function.name, function.module, function.filename)
+
+
+def php_class(name):
+    """Return the class of a PHP method name, Class->method or
+    Class::method, or the name itself for other functions.
+
+    Internal functions, named php::function, are grouped as php, and
+    include files, named require_once::file and alike, by the kind of
+    include.
+    """
+
+    for separator in ('->', '::'):
+        if separator in name:
+            return name.rsplit(separator, 1)[0]
+    return name
+
+
+def php_namespace(name):
+    """Return the namespace of a PHP class or function name, or the name
+    itself when in the global namespace."""
+
+    if '\\' in name:
+        return name.rsplit('\\', 1)[0]
+    return name
+
 
 ########################################################################
 # Parsers
@@ -791,92 +1372,435 @@ class Struct:
 class ParseError(Exception):
     """Raised when parsing to signal mismatches."""
 
-    def __init__(self, msg, line):
+    def __init__(self, msg, line = None):
         Exception.__init__(self)
         self.msg = msg
         # TODO: store more source line information
         self.line = line
 
     def __str__(self):
+        if self.line is None:
+            return self.msg
         return '%s: %r' % (self.msg, self.line)
 
 
+class Cancelled(Exception):
+    """Raised when a run is cancelled by a signal or a cancel file."""
+
+    def __str__(self):
+        return 'cancelled'
+
+
+def raise_cancelled(signum, frame):
+    """Signal handler that unwinds the main thread."""
+    raise Cancelled()
+
+
 class Parser:
     """Parser interface."""
 
     stdinInput = True
     multipleInput = False
 
+    # Preferred method of calculating total time, callratios, callstacks or
+    # inclusive, for the parsers that have a choice
+    totalMethod = 'callratios'
+
+    # Whether the parser applies a FunctionFilter, and the filter to apply
+    filterFunctions = False
+    functionFilter = None
+
     def __init__(self):
         pass
 
+    def inputs(self):
+        """Return the open files the parser reads, for progress reporting."""
+        return []
+
     def parse(self):
         raise NotImplementedError
 
 
-class JsonParser(Parser):
-    """Parser for a custom JSON representation of profile data.
+class ProgressMonitor:
+    """Report the progress of a run, and cancel it on request, from a
+    background thread.
 
-    See schema.json for details.
+    Every interval seconds, callback(phase, done, total) is called, from the
+    background thread, with the innermost current phase and the bytes
+    consumed out of the total size of the inputs, as told by the position of
+    their file descriptors.  done and total are None when unknown, as for
+    pipes.  When the cancel file exists, the main thread is interrupted,
+    with KeyboardInterrupt, and cancelled is set.
     """
 
+    def __init__(self, callback=None, interval=1.0, cancel_file=None):
+        import threading
+        self.callback = callback
+        self.interval = interval
+        self.cancel_file = cancel_file
+        self.cancelled = False
+        self.phases = []
+        self.fds = []
+        self.total = None
+        self.event = threading.Event()
+        self.thread = threading.Thread(target=self.run)
+        self.thread.daemon = True
+
+    def set_inputs(self, files):
+        """Measure progress by the position of the given files."""
+        import stat
+        fds = []
+        total = 0
+        for fp in files:
+            try:
+                fd = fp.fileno()
+                st = os.fstat(fd)
+            except (AttributeError, ValueError, OSError, IOError):
+                # Not a real file, such as a StringIO
+                total = None
+                break
+            if not stat.S_ISREG(st.st_mode):
+                total = None
+                break
+            fds.append(fd)
+            total += st.st_size
+        if total is None or not fds:
+            fds = []
+            total = None
+        self.fds = fds
+        self.total = total
+
+    def position(self):
+        try:
+            return sum([os.lseek(fd, 0, os.SEEK_CUR) for fd in self.fds])
+        except OSError:
+            # Closed already
+            return None
 
-    def __init__(self, stream):
-        Parser.__init__(self)
-        self.stream = stream
+    def enter(self, name):
+        self.phases.append(name)
 
-    def parse(self):
+    def leave(self):
+        self.phases.pop()
 
-        obj = json.load(self.stream)
+    def start(self):
+        phase_listeners.append(self)
+        self.thread.start()
 
-        assert obj['version'] == 0
+    def stop(self, phase):
+        """Stop the thread, and report the given final phase."""
+        self.event.set()
+        self.thread.join()
+        phase_listeners.remove(self)
+        if self.callback is not None:
+            if phase == 'done':
+                done = self.total
+            else:
+                done = self.fds and self.position() or None
+            self.callback(phase, done, self.total)
 
-        profile = Profile()
-        profile[SAMPLES] = 0
+    def run(self):
+        while not self.event.wait(self.interval):
+            if self.cancel_file is not None and os.path.exists(self.cancel_file):
+                self.cancelled = True
+                try:
+                    import _thread as thread
+                except ImportError:
+                    import thread
+                thread.interrupt_main()
+                return
+            if self.callback is not None:
+                try:
+                    phase = self.phases[-1]
+                except IndexError:
+                    phase = None
+                done = self.fds and self.position() or None
+                self.callback(phase, done, self.total)
 
-        fns = obj['functions']
 
-        for functionIndex in range(len(fns)):
-            fn = fns[functionIndex]
-            function = Function(functionIndex, fn['name'])
-            try:
-                function.module = fn['module']
-            except KeyError:
-                pass
-            try:
-                function.process = fn['process']
-            except KeyError:
-                pass
-            function[SAMPLES] = 0
-            profile.add_function(function)
+class ProgressWriter:
+    """Progress callback that writes a JSON object per line, such as
+    {"phase": "parse", "done": 1048576, "total": 8388608}, for another
+    process to poll."""
 
-        for event in obj['events']:
-            callchain = []
+    def __init__(self, fp):
+        self.fp = fp
 
-            for functionIndex in event['callchain']:
-                function = profile.functions[functionIndex]
-                callchain.append(function)
+    def __call__(self, phase, done, total):
+        import json
+        self.fp.write(json.dumps(collections.OrderedDict([('phase', phase), ('done', done), ('total', total)])) + '\n')
+        self.fp.flush()
+
+
+class StackAggregator:
+    """Accumulate sampled call stacks into a profile.
+
+    Identical stacks are merged as they are added, so a stack that repeats
+    costs a single dictionary update.  When done, the distinct stacks are
+    arranged in a calling context tree, which is walked once to charge the
+    self cost of the sampled functions, the cost of every call, and optionally
+    the inclusive cost of every function, counted once per stack even when the
+    function recurses.
+    """
+
+    def __init__(self, profile, self_event=SAMPLES, call_event=SAMPLES2, total_event=None):
+        self.profile = profile
+        self.self_event = self_event
+        self.call_event = call_event
+        self.total_event = total_event
+        self.stacks = {}
 
-            cost = event['cost'][0]
+    def add(self, callchain, cost=1):
+        """Add a tuple of functions, from the sampled function to the root."""
+        stacks = self.stacks
+        try:
+            stacks[callchain] += cost
+        except KeyError:
+            stacks[callchain] = cost
 
-            callee = callchain[0]
-            callee[SAMPLES] += cost
-            profile[SAMPLES] += cost
+    def flush(self, function_filter=None):
+        """Charge the accumulated stacks to the profile.
+
+        The functions the filter excludes are left out of the stacks, so
+        that their cost goes to the nearest caller that is kept, and removed
+        from the profile.
+        """
 
-            for caller in callchain[1:]:
+        profile = self.profile
+        self_event = self.self_event
+        call_event = self.call_event
+        total_event = self.total_event
+
+        # Build the calling context tree, from the roots down.  Each node is
+        # a [function, self cost, children] list.
+        root = [None, 0, {}]
+        for callchain, cost in compat_iteritems(self.stacks):
+            if function_filter is not None:
+                callchain = [function for function in callchain if function_filter.keep(function)]
+                if not callchain:
+                    # Still part of the total
+                    if self_event is not None:
+                        profile[self_event] += cost
+                    continue
+            node = root
+            for function in reversed(callchain):
+                children = node[2]
                 try:
-                    call = caller.calls[callee.id]
+                    node = children[function]
                 except KeyError:
-                    call = Call(callee.id)
-                    call[SAMPLES2] = cost
-                    caller.add_call(call)
-                else:
-                    call[SAMPLES2] += cost
+                    node = [function, 0, {}]
+                    children[function] = node
+            node[1] += cost
+        self.stacks = {}
+
+        # Walk the tree depth first, without recursion as stacks can be deep,
+        # and charge each subtree total when leaving its root node
+        on_path = {}
+        path = [[root, iter(compat_itervalues(root[2])), 0]]
+        while path:
+            frame = path[-1]
+            for child in frame[1]:
+                function = child[0]
+                on_path[function] = on_path.get(function, 0) + 1
+                path.append([child, iter(compat_itervalues(child[2])), child[1]])
+                break
+            else:
+                path.pop()
+                node, _, subtotal = frame
+                function = node[0]
+                if function is None:
+                    continue
+
+                if node[1] and self_event is not None:
+                    function[self_event] += node[1]
+                    profile[self_event] += node[1]
+
+                parent = path[-1]
+                parent[2] += subtotal
+                caller = parent[0][0]
+                if caller is not None:
+                    try:
+                        call = caller.calls[function.id]
+                    except KeyError:
+                        call = Call(function.id)
+                        call[call_event] = subtotal
+                        caller.add_call(call)
+                    else:
+                        call[call_event] += subtotal
+
+                on_path[function] -= 1
+                if total_event is not None and not on_path[function]:
+                    function[total_event] += subtotal
+
+        if function_filter is not None:
+            for function_id in compat_keys(profile.functions):
+                if not function_filter.keep(profile.functions[function_id]):
+                    del profile.functions[function_id]
+
+
+class JsonReader:
+    """Incremental JSON reader.
+
+    The stream is read in blocks and decoded one value at a time, so that
+    large objects and arrays can be walked member by member without holding
+    the whole document, or its decoded object tree, in memory.
+    """
+
+    block_size = 256*1024
 
-                callee = caller
+    _whitespace = LazyRegex(r'[ \t\n\r]*')
 
-        if False:
-            profile.dump()
+    def __init__(self, stream):
+        self.stream = stream
+        self.buffer = ''
+        self.pos = 0
+        self.eof = False
+        import json
+        self.decoder = json.JSONDecoder()
+
+    def read(self, size=0):
+        """Append at least size more characters to the buffer, discarding
+        what was already consumed."""
+        data = self.stream.read(max(size, self.block_size))
+        if not data:
+            self.eof = True
+        self.buffer = self.buffer[self.pos:] + data
+        self.pos = 0
+
+    def peek(self):
+        """Skip whitespace and return the next character, or '' at the end."""
+        while True:
+            self.pos = self._whitespace.match(self.buffer, self.pos).end()
+            if self.pos < len(self.buffer) or self.eof:
+                return self.buffer[self.pos:self.pos + 1]
+            self.read()
+
+    def expect(self, chars):
+        """Consume the next character, which must be one of chars."""
+        c = self.peek()
+        if not c or c not in chars:
+            raise ParseError('%s expected' % ' or '.join([repr(char) for char in chars]), self.context())
+        self.pos += 1
+        return c
+
+    def context(self):
+        return self.buffer[self.pos:self.pos + 32]
+
+    def value(self):
+        """Decode the next value."""
+        self.peek()
+        while True:
+            try:
+                value, end = self.decoder.raw_decode(self.buffer, self.pos)
+            except ValueError:
+                if self.eof:
+                    raise ParseError('invalid JSON value', self.context())
+            else:
+                # A number may continue in the next block
+                if end < len(self.buffer) or self.eof:
+                    self.pos = end
+                    return value
+            # Grow geometrically, so that large values are not decoded over
+            # and over again
+            self.read(len(self.buffer) - self.pos)
+
+    def members(self):
+        """Iterate over the keys of an object.  The caller must consume each
+        member value, with value(), members() or elements(), before
+        resuming."""
+        self.expect('{')
+        if self.peek() == '}':
+            self.pos += 1
+            return
+        while True:
+            key = self.value()
+            self.expect(':')
+            yield key
+            if self.expect(',}') == '}':
+                return
+
+    def elements(self):
+        """Iterate over the elements of an array.  The caller must consume
+        each element before resuming."""
+        self.expect('[')
+        if self.peek() == ']':
+            self.pos += 1
+            return
+        while True:
+            yield
+            if self.expect(',]') == ']':
+                return
+
+
+class JsonParser(Parser):
+    """Parser for a custom JSON representation of profile data.
+
+    See schema.json for details.
+
+    The document is read incrementally: functions are added as they are
+    decoded, and events are decoded one at a time and merged by callchain,
+    so memory grows with the number of distinct stacks rather than with the
+    number of events.
+    """
+
+    filterFunctions = True
+
+    def __init__(self, stream):
+        Parser.__init__(self)
+        self.stream = stream
+
+    def inputs(self):
+        return [self.stream]
+
+    def parse(self):
+
+        profile = Profile()
+        profile[SAMPLES] = 0
+
+        reader = JsonReader(self.stream)
+        version = None
+        stacks = {}
+        for key in reader.members():
+            if key == 'version':
+                version = reader.value()
+            elif key == 'functions':
+                functionIndex = 0
+                for _ in reader.elements():
+                    fn = reader.value()
+                    function = Function(functionIndex, fn['name'])
+                    try:
+                        function.module = fn['module']
+                    except KeyError:
+                        pass
+                    try:
+                        function.process = fn['process']
+                    except KeyError:
+                        pass
+                    function[SAMPLES] = 0
+                    profile.add_function(function)
+                    functionIndex += 1
+            elif key == 'events':
+                # Events may precede functions, so merge them by function
+                # index, and resolve the distinct callchains at the end.
+                value = reader.value
+                for _ in reader.elements():
+                    event = value()
+                    callchain = tuple(event['callchain'])
+                    cost = event['cost'][0]
+                    try:
+                        stacks[callchain] += cost
+                    except KeyError:
+                        stacks[callchain] = cost
+            else:
+                reader.value()
+
+        assert version == 0
+
+        functions = profile.functions
+        aggregator = StackAggregator(profile)
+        for callchain, cost in compat_iteritems(stacks):
+            aggregator.add(tuple([functions[functionIndex] for functionIndex in callchain]), cost)
+        aggregator.flush(self.functionFilter)
 
         # compute derived data
         profile.validate()
@@ -898,6 +1822,9 @@ class LineParser(Parser):
         self.__eof = False
         self.line_no = 0
 
+    def inputs(self):
+        return [self._stream]
+
     def readline(self):
         line = self._stream.readline()
         if not line:
@@ -907,8 +1834,9 @@ class LineParser(Parser):
             self.line_no += 1
         line = line.rstrip('\r\n')
         if not PYTHON_3:
-            encoding = self._stream.encoding
+            encoding = getattr(self._stream, 'encoding', None)
             if encoding is None:
+                import locale
                 encoding = locale.getpreferredencoding()
             line = line.decode(encoding)
         self.__line = line
@@ -956,29 +1884,41 @@ class XmlToken:
 class XmlTokenizer:
     """Expat based XML tokenizer."""
 
+    # The read size adapts so that each block yields about block_tokens
+    # tokens: it grows through long text runs, which would otherwise take
+    # many small reads, and shrinks back on dense markup, as keeping many
+    # tokens queued at once costs memory and garbage collector time.
+    min_block_size = 16*1024
+    max_block_size = 1024*1024
+    block_tokens = 1024
+
     def __init__(self, fp, skip_ws = True):
         self.fp = fp
-        self.tokens = []
-        self.index = 0
+        self.tokens = collections.deque()
         self.final = False
         self.skip_ws = skip_ws
+        self.block_size = self.min_block_size
 
         self.character_pos = 0, 0
-        self.character_data = ''
+        self.character_data = []
 
+        import xml.parsers.expat
         self.parser = xml.parsers.expat.ParserCreate()
+        self.parser.buffer_text = True
         self.parser.StartElementHandler  = self.handle_element_start
         self.parser.EndElementHandler    = self.handle_element_end
         self.parser.CharacterDataHandler = self.handle_character_data
 
     def handle_element_start(self, name, attributes):
-        self.finish_character_data()
+        if self.character_data:
+            self.finish_character_data()
         line, column = self.pos()
         token = XmlToken(XML_ELEMENT_START, name, attributes, line, column)
         self.tokens.append(token)
 
     def handle_element_end(self, name):
-        self.finish_character_data()
+        if self.character_data:
+            self.finish_character_data()
         line, column = self.pos()
         token = XmlToken(XML_ELEMENT_END, name, None, line, column)
         self.tokens.append(token)
@@ -986,30 +1926,33 @@ class XmlTokenizer:
     def handle_character_data(self, data):
         if not self.character_data:
             self.character_pos = self.pos()
-        self.character_data += data
+        self.character_data.append(data)
 
     def finish_character_data(self):
         if self.character_data:
-            if not self.skip_ws or not self.character_data.isspace():
+            data = ''.join(self.character_data)
+            if not self.skip_ws or not data.isspace():
                 line, column = self.character_pos
-                token = XmlToken(XML_CHARACTER_DATA, self.character_data, None, line, column)
+                token = XmlToken(XML_CHARACTER_DATA, data, None, line, column)
                 self.tokens.append(token)
-            self.character_data = ''
+            self.character_data = []
 
     def next(self):
-        size = 16*1024
-        while self.index >= len(self.tokens) and not self.final:
-            self.tokens = []
-            self.index = 0
+        while not self.tokens and not self.final:
+            size = self.block_size
             data = self.fp.read(size)
             self.final = len(data) < size
             self.parser.Parse(data, self.final)
-        if self.index >= len(self.tokens):
+            tokens = len(self.tokens)
+            if tokens < self.block_tokens//2 and size < self.max_block_size:
+                self.block_size = size*2
+            elif tokens > self.block_tokens*2 and size > self.min_block_size:
+                self.block_size = size//2
+        if not self.tokens:
             line, column = self.pos()
             token = XmlToken(XML_EOF, None, None, line, column)
         else:
-            token = self.tokens[self.index]
-            self.index += 1
+            token = self.tokens.popleft()
         return token
 
     def pos(self):
@@ -1035,6 +1978,9 @@ class XmlParser(Parser):
         self.tokenizer = XmlTokenizer(fp)
         self.consume()
 
+    def inputs(self):
+        return [self.tokenizer.fp]
+
     def consume(self):
         self.token = self.tokenizer.next()
 
@@ -1065,10 +2011,11 @@ class XmlParser(Parser):
         self.consume()
 
     def character_data(self, strip = True):
-        data = ''
+        chunks = []
         while self.token.type == XML_CHARACTER_DATA:
-            data += self.token.name_or_data
+            chunks.append(self.token.name_or_data)
             self.consume()
+        data = ''.join(chunks)
         if strip:
             data = data.strip()
         return data
@@ -1090,32 +2037,39 @@ class GprofParser(Parser):
         self.functions = {}
         self.cycles = {}
 
+    def inputs(self):
+        return [self.fp]
+
     def readline(self):
         line = self.fp.readline()
         if not line:
-            sys.stderr.write('error: unexpected end of file\n')
-            sys.exit(1)
+            raise ParseError('unexpected end of file')
         line = line.rstrip('\r\n')
         return line
 
-    _int_re = re.compile(r'^\d+$')
-    _float_re = re.compile(r'^\d+\.\d+$')
+    # Types of the call graph fields; the others, such as names, are strings
+    _field_types = {
+        'index': int,
+        'percentage_time': float,
+        'self': float,
+        'descendants': float,
+        'called': int,
+        'called_self': int,
+        'called_total': int,
+        'cycle': int,
+    }
 
     def translate(self, mo):
         """Extract a structure from a match object, while translating the types in the process."""
         attrs = {}
-        groupdict = mo.groupdict()
-        for name, value in compat_iteritems(groupdict):
-            if value is None:
-                value = None
-            elif self._int_re.match(value):
-                value = int(value)
-            elif self._float_re.match(value):
-                value = float(value)
-            attrs[name] = (value)
+        field_types = self._field_types
+        for name, value in compat_iteritems(mo.groupdict()):
+            if value is not None and name in field_types:
+                value = field_types[name](value)
+            attrs[name] = value
         return Struct(attrs)
 
-    _cg_header_re = re.compile(
+    _cg_header_re = LazyRegex(
         # original gprof header
         r'^\s+called/total\s+parents\s*$|' +
         r'^index\s+%time\s+self\s+descendents\s+called\+self\s+name\s+index\s*$|' +
@@ -1124,14 +2078,14 @@ class GprofParser(Parser):
         r'^index\s+%\s+time\s+self\s+children\s+called\s+name\s*$'
     )
 
-    _cg_ignore_re = re.compile(
+    _cg_ignore_re = LazyRegex(
         # spontaneous
         r'^\s+<spontaneous>\s*$|'
         # internal calls (such as "mcount")
         r'^.*\((\d+)\)$'
     )
 
-    _cg_primary_re = re.compile(
+    _cg_primary_re = LazyRegex(
         r'^\[(?P<index>\d+)\]?' +
         r'\s+(?P<percentage_time>\d+\.\d+)' +
         r'\s+(?P<self>\d+\.\d+)' +
@@ -1142,7 +2096,7 @@ class GprofParser(Parser):
         r'\s\[(\d+)\]$'
     )
 
-    _cg_parent_re = re.compile(
+    _cg_parent_re = LazyRegex(
         r'^\s+(?P<self>\d+\.\d+)?' +
         r'\s+(?P<descendants>\d+\.\d+)?' +
         r'\s+(?P<called>\d+)(?:/(?P<called_total>\d+))?' +
@@ -1153,7 +2107,7 @@ class GprofParser(Parser):
 
     _cg_child_re = _cg_parent_re
 
-    _cg_cycle_header_re = re.compile(
+    _cg_cycle_header_re = LazyRegex(
         r'^\[(?P<index>\d+)\]?' +
         r'\s+(?P<percentage_time>\d+\.\d+)' +
         r'\s+(?P<self>\d+\.\d+)' +
@@ -1163,7 +2117,7 @@ class GprofParser(Parser):
         r'\s\[(\d+)\]$'
     )
 
-    _cg_cycle_member_re = re.compile(
+    _cg_cycle_member_re = LazyRegex(
         r'^\s+(?P<self>\d+\.\d+)?' +
         r'\s+(?P<descendants>\d+\.\d+)?' +
         r'\s+(?P<called>\d+)(?:\+(?P<called_self>\d+))?' +
@@ -1172,85 +2126,121 @@ class GprofParser(Parser):
         r'\s\[(?P<index>\d+)\]$'
     )
 
-    _cg_sep_re = re.compile(r'^--+$')
+    _cg_sep_re = LazyRegex(r'^--+$')
 
-    def parse_function_entry(self, lines):
-        parents = []
-        children = []
-
-        while True:
-            if not lines:
-                sys.stderr.write('warning: unexpected end of entry\n')
-            line = lines.pop(0)
-            if line.startswith('['):
-                break
-
-            # read function parent line
-            mo = self._cg_parent_re.match(line)
-            if not mo:
-                if self._cg_ignore_re.match(line):
-                    continue
-                sys.stderr.write('warning: unrecognized call graph entry: %r\n' % line)
-            else:
-                parent = self.translate(mo)
-                parents.append(parent)
-
-        # read primary line
-        mo = self._cg_primary_re.match(line)
-        if not mo:
-            sys.stderr.write('warning: unrecognized call graph entry: %r\n' % line)
-            return
-        else:
-            function = self.translate(mo)
-
-        while lines:
-            line = lines.pop(0)
-
-            # read function subroutine line
-            mo = self._cg_child_re.match(line)
-            if not mo:
-                if self._cg_ignore_re.match(line):
-                    continue
-                sys.stderr.write('warning: unrecognized call graph entry: %r\n' % line)
+    def split_name(self, name):
+        """Split the trailing "<cycle n>" off a function name."""
+        if name.endswith('>'):
+            pos = name.rfind('<cycle ')
+            if pos > 0 and name[pos - 1].isspace():
+                try:
+                    return name[:pos].rstrip(), int(name[pos + 7:-1])
+                except ValueError:
+                    pass
+        return name, None
+
+    def split_called(self, called):
+        """Split a "called", "called/total" or "called+self" field."""
+        called_total = None
+        called_self = None
+        if '/' in called:
+            called, called_total = called.split('/', 1)
+            called_total = int(called_total)
+        elif '+' in called:
+            called, called_self = called.split('+', 1)
+            called_self = int(called_self)
+        return int(called), called_total, called_self
+
+    def split_call_line(self, line):
+        """Extract the fields of a parent, child, or cycle member line.
+
+        Fields are delimited by whitespace and converted according to their
+        position, which is much cheaper than matching the regular expressions
+        above.  Returns None for lines with an unexpected layout."""
+
+        if not line.endswith(']'):
+            return None
+        pos = line.rfind(' [')
+        if pos < 0:
+            return None
+        text = line[:pos]
+        try:
+            index = int(line[pos + 2:-1])
+            fields = text.split(None, 1)
+            if '.' in fields[0]:
+                self_, descendants, called, name = text.split(None, 3)
+                self_ = float(self_)
+                descendants = float(descendants)
             else:
-                child = self.translate(mo)
-                children.append(child)
-
-        function.parents = parents
-        function.children = children
-
-        self.functions[function.index] = function
-
-    def parse_cycle_entry(self, lines):
-
-        # read cycle header line
-        line = lines[0]
-        mo = self._cg_cycle_header_re.match(line)
-        if not mo:
-            sys.stderr.write('warning: unrecognized call graph entry: %r\n' % line)
-            return
-        cycle = self.translate(mo)
-
-        # read cycle member lines
-        cycle.functions = []
-        for line in lines[1:]:
-            mo = self._cg_cycle_member_re.match(line)
-            if not mo:
-                sys.stderr.write('warning: unrecognized call graph entry: %r\n' % line)
-                continue
-            call = self.translate(mo)
-            cycle.functions.append(call)
-
-        self.cycles[cycle.cycle] = cycle
-
-    def parse_cg_entry(self, lines):
-        if lines[0].startswith("["):
-            self.parse_cycle_entry(lines)
-        else:
-            self.parse_function_entry(lines)
+                self_ = None
+                descendants = None
+                called, name = fields
+            called, called_total, called_self = self.split_called(called)
+        except ValueError:
+            return None
+        name, cycle = self.split_name(name)
+        return Struct({
+            'self': self_,
+            'descendants': descendants,
+            'called': called,
+            'called_total': called_total,
+            'called_self': called_self,
+            'name': name,
+            'cycle': cycle,
+            'index': index,
+        })
+
+    def split_primary_line(self, line):
+        """Extract the fields of the primary line of a function or cycle
+        entry, as split_call_line does."""
+
+        end = line.find(']')
+        pos = line.rfind(' [')
+        if end < 0 or pos <= end or not line.endswith(']'):
+            return None
+        try:
+            index = int(line[1:end])
+            percentage_time, self_, descendants, name = line[end + 1:pos].split(None, 3)
+            percentage_time = float(percentage_time)
+            self_ = float(self_)
+            descendants = float(descendants)
+            called = None
+            called_self = None
+            if name[0].isdigit():
+                called, name = name.split(None, 1)
+                called, called_total, called_self = self.split_called(called)
+                if called_total is not None:
+                    return None
+        except ValueError:
+            return None
+        name, cycle = self.split_name(name)
+        return Struct({
+            'index': index,
+            'percentage_time': percentage_time,
+            'self': self_,
+            'descendants': descendants,
+            'called': called,
+            'called_self': called_self,
+            'name': name,
+            'cycle': cycle,
+        })
+
+    def match_line(self, line, split, regex):
+        attrs = split(line)
+        # All the regular expressions require a trailing index, and trying
+        # them on other lines, such as "<spontaneous>", is slow
+        if attrs is None and line.endswith(']'):
+            mo = regex.match(line)
+            if mo:
+                attrs = self.translate(mo)
+        return attrs
 
     def parse_cg(self):
-        """Parse the call graph."""
+        """Parse the call graph.
+
+        Entries are parsed as their lines are read: the parent lines until
+        the primary line, which registers the function or cycle, and then its
+        child or member lines, until the separator."""
 
         # skip call graph header
         while not self._cg_header_re.match(self.readline()):
@@ -1260,16 +2250,91 @@ class GprofParser(Parser):
             line = self.readline()
 
         # process call graph entries
-        entry_lines = []
+        parents = []
+        # Parent lines that did not parse, reported once the primary line
+        # confirms that they belong to an entry
+        unrecognized = []
+        first = True
+        # The function or cycle of the current entry, None before its
+        # primary line, or False when the entry is being skipped
+        entry = None
         while line != '\014': # form feed
             if line and not line.isspace():
-                if self._cg_sep_re.match(line):
-                    self.parse_cg_entry(entry_lines)
-                    entry_lines = []
-                else:
-                    entry_lines.append(line)
+                if line.startswith('--') and self._cg_sep_re.match(line):
+                    if entry is None and not first:
+                        sys.stderr.write('warning: unexpected end of entry\n')
+                    parents = []
+                    unrecognized = []
+                    first = True
+                    entry = None
+                elif entry is None:
+                    if line.startswith('['):
+                        for parent_line in unrecognized:
+                            sys.stderr.write('warning: unrecognized call graph entry: %r\n' % parent_line)
+                        # An entry starting with its primary line is a cycle
+                        if first:
+                            entry = self.parse_cg_cycle(line)
+                        else:
+                            entry = self.parse_cg_function(line, parents)
+                    else:
+                        # read function parent line
+                        parent = self.match_line(line, self.split_call_line, self._cg_parent_re)
+                        if parent is not None:
+                            parents.append(parent)
+                        elif not self._cg_ignore_re.match(line):
+                            unrecognized.append(line)
+                    first = False
+                elif entry is not False:
+                    self.parse_cg_child(line, entry)
             line = self.readline()
 
+    def parse_cg_function(self, line, parents):
+        # read primary line
+        function = self.match_line(line, self.split_primary_line, self._cg_primary_re)
+        if function is None:
+            sys.stderr.write('warning: unrecognized call graph entry: %r\n' % line)
+            return False
+        function.parents = parents
+        function.children = []
+        self.functions[function.index] = function
+        return function
+
+    def parse_cg_cycle(self, line):
+        # read cycle header line
+        cycle = self.split_primary_line(line)
+        try:
+            name = cycle.name
+            if not name.startswith('<cycle ') or not name.endswith(' as a whole>'):
+                raise ValueError
+            cycle.cycle = int(name[7:-12])
+        except (AttributeError, ValueError):
+            mo = self._cg_cycle_header_re.match(line)
+            if not mo:
+                sys.stderr.write('warning: unrecognized call graph entry: %r\n' % line)
+                return False
+            cycle = self.translate(mo)
+        cycle.functions = []
+        self.cycles[cycle.cycle] = cycle
+        return cycle
+
+    def parse_cg_child(self, line, entry):
+        try:
+            members = entry.functions
+        except AttributeError:
+            # read function subroutine line
+            child = self.match_line(line, self.split_call_line, self._cg_child_re)
+            if child is not None:
+                entry.children.append(child)
+            elif not self._cg_ignore_re.match(line):
+                sys.stderr.write('warning: unrecognized call graph entry: %r\n' % line)
+        else:
+            # read cycle member line
+            call = self.match_line(line, self.split_call_line, self._cg_cycle_member_re)
+            if call is not None:
+                members.append(call)
+            else:
+                sys.stderr.write('warning: unrecognized call graph entry: %r\n' % line)
+
     def parse(self):
         self.parse_cg()
         self.fp.close()
@@ -1363,16 +2428,18 @@ class AXEParser(Parser):
         self.functions = {}
         self.cycles = {}
 
+    def inputs(self):
+        return [self.fp]
+
     def readline(self):
         line = self.fp.readline()
         if not line:
-            sys.stderr.write('error: unexpected end of file\n')
-            sys.exit(1)
+            raise ParseError('unexpected end of file')
         line = line.rstrip('\r\n')
         return line
 
-    _int_re = re.compile(r'^\d+$')
-    _float_re = re.compile(r'^\d+\.\d+$')
+    _int_re = LazyRegex(r'^\d+$')
+    _float_re = LazyRegex(r'^\d+\.\d+$')
 
     def translate(self, mo):
         """Extract a structure from a match object, while translating the types in the process."""
@@ -1388,14 +2455,14 @@ class AXEParser(Parser):
             attrs[name] = (value)
         return Struct(attrs)
 
-    _cg_header_re = re.compile(
+    _cg_header_re = LazyRegex(
         '^Index |'
         '^-----+ '
     )
 
-    _cg_footer_re = re.compile(r'^Index\s+Function\s*$')
+    _cg_footer_re = LazyRegex(r'^Index\s+Function\s*$')
 
-    _cg_primary_re = re.compile(
+    _cg_primary_re = LazyRegex(
         r'^\[(?P<index>\d+)\]?' +
         r'\s+(?P<percentage_time>\d+\.\d+)' +
         r'\s+(?P<self>\d+\.\d+)' +
@@ -1406,7 +2473,7 @@ class AXEParser(Parser):
         r'\s*$'
     )
 
-    _cg_parent_re = re.compile(
+    _cg_parent_re = LazyRegex(
         r'^\s+(?P<self>\d+\.\d+)?' +
         r'\s+(?P<descendants>\d+\.\d+)?' +
         r'\s+(?P<name>\S.*?)' +
@@ -1417,7 +2484,7 @@ class AXEParser(Parser):
 
     _cg_child_re = _cg_parent_re
 
-    _cg_cycle_header_re = re.compile(
+    _cg_cycle_header_re = LazyRegex(
         r'^\[(?P<index>\d+)\]?' +
         r'\s+(?P<percentage_time>\d+\.\d+)' +
         r'\s+(?P<self>\d+\.\d+)' +
@@ -1427,7 +2494,7 @@ class AXEParser(Parser):
         r'\s*$'
     )
 
-    _cg_cycle_member_re = re.compile(
+    _cg_cycle_member_re = LazyRegex(
         r'^\s+(?P<self>\d+\.\d+)?' +
         r'\s+(?P<descendants>\d+\.\d+)?' +
         r'\s+(?P<name>\S.*?)' +
@@ -1538,7 +2605,7 @@ class AXEParser(Parser):
 
         # process call graph entries
         entry_lines = []
-        # An EOF in readline terminates the program without returning.
+        # An EOF in readline raises a ParseError.
         while not self._cg_footer_re.match(line):
             if line.isspace():
                 self.parse_cg_entry(entry_lines)
@@ -1615,6 +2682,31 @@ class AXEParser(Parser):
         return profile
 
 
+class CheckpointStream:
+    """Text stream over the lines of a binary file, up to a byte offset."""
+
+    encoding = 'UTF-8'
+
+    def __init__(self, fp, end):
+        self.fp = fp
+        self.remaining = end - fp.tell()
+
+    def fileno(self):
+        return self.fp.fileno()
+
+    def readline(self):
+        if self.remaining <= 0:
+            return ''
+        line = self.fp.readline(self.remaining)
+        self.remaining -= len(line)
+        if PYTHON_3:
+            line = line.decode('UTF-8')
+        return line
+
+    def close(self):
+        self.fp.close()
+
+
 class CallgrindParser(LineParser):
     """Parser for valgrind's callgrind tool.
 
@@ -1622,11 +2714,33 @@ class CallgrindParser(LineParser):
     - http://valgrind.org/docs/manual/cl-format.html
     """
 
-    _call_re = re.compile(r'^calls=\s*(\d+)\s+((\d+|\+\d+|-\d+|\*)\s+)+$')
+    filterFunctions = True
+
+    _call_re = LazyRegex(r'^calls=\s*(\d+)\s+((\d+|\+\d+|-\d+|\*)\s+)+$')
+
+    # Version of the checkpoint file format
+    checkpoint_version = 3
+
+    # Rules, as for FunctionFilter, of the functions spliced out of the call
+    # graph, or None
+    splicedFunctions = None
+
+    # What functions are grouped by, one of aggregateKeys, or None
+    aggregateBy = None
+    aggregateKeys = ('class', 'file', 'namespace', 'module')
+
+    # Bytes at the start of the input and before the checkpoint offset that
+    # identify the file the checkpoint was saved for
+    checkpoint_digest_size = 4096
 
     def __init__(self, infile):
         LineParser.__init__(self, infile)
 
+        # Checkpoint file, and the input offset it is saved at
+        self.checkpoint = None
+        self.checkpoint_offset = None
+        self.resumed = False
+
         # Textual positions
         self.position_ids = {}
         self.positions = {}
@@ -1643,27 +2757,243 @@ class CallgrindParser(LineParser):
         self.profile = Profile()
         self.profile[SAMPLES] = 0
 
+        # File of every function, for the function filter
+        self.files = {}
+
+        # Spliced functions, and their invocations not yet claimed by a
+        # caller, oldest first, as [self cost, [[callee, calls, cost], ...]]
+        self.splice = None
+        self.spliced = set()
+        self.pending = {}
+        # Invocation of the spliced function being read, if any, and whether
+        # a fn= line started a new block since
+        self.invocation = None
+        self.new_block = False
+
+    @classmethod
+    def resume(cls, filename, checkpoint, splicedFunctions=None):
+        """Create a parser that carries on from the state saved in the
+        checkpoint file, and saves its own state there once done.
+
+        The saved state is used only if it was saved for the same file, as
+        far as its first bytes and those before the saved offset tell, and
+        the file has not shrunk since, with the same functions spliced
+        out.  Only complete lines are read, and
+        never a calls= line without the cost line that follows it, so that
+        a file still being written is resumed where it was left.
+        """
+
+        import json
+
+        fp = open(filename, 'rb')
+        try:
+            end = cls.complete_end(fp)
+            state = None
+            try:
+                with open(checkpoint, 'rt') as checkpoint_fp:
+                    state = json.load(checkpoint_fp)
+            except (IOError, OSError, ValueError):
+                pass
+            start = 0
+            if state is not None and state.get('version') == cls.checkpoint_version and \
+               state['spliced'] == list(splicedFunctions or ()):
+                offset = state['offset']
+                if offset <= end and state['digests'] == cls.checkpoint_digests(fp, offset):
+                    start = offset
+            fp.seek(start)
+            parser = cls(CheckpointStream(fp, end))
+        except:
+            fp.close()
+            raise
+        parser.checkpoint = checkpoint
+        parser.checkpoint_offset = end
+        parser.splicedFunctions = splicedFunctions
+        if start:
+            parser.restore(state)
+        return parser
+
+    @staticmethod
+    def complete_end(fp):
+        """Return the offset past the last line of the file that can be
+        parsed without what follows."""
+
+        fp.seek(0, os.SEEK_END)
+        end = fp.tell()
+        block_size = 64*1024
+        tail = b''
+        position = end
+        # Find the last two line ends
+        while position > 0 and tail.count(b'\n') < 2:
+            size = min(block_size, position)
+            position -= size
+            fp.seek(position)
+            tail = fp.read(size) + tail
+        last = tail.rfind(b'\n')
+        if last < 0:
+            return 0
+        end = position + last + 1
+        start = tail.rfind(b'\n', 0, last) + 1
+        if tail.startswith(b'calls=', start):
+            # Wait for its cost line
+            end = position + start
+        return end
+
+    @classmethod
+    def checkpoint_digests(cls, fp, offset):
+        import hashlib
+
+        digests = []
+        for start in (0, max(offset - cls.checkpoint_digest_size, 0)):
+            fp.seek(start)
+            data = fp.read(min(cls.checkpoint_digest_size, offset - start))
+            digests.append(hashlib.sha1(data).hexdigest())
+        return digests
+
+    def save(self):
+        """Return the parser state, with the raw profile data, as an object
+        that JSON can represent."""
+
+        functions = []
+        for function in compat_itervalues(self.profile.functions):
+            calls = []
+            for call in compat_itervalues(function.calls):
+                calls.append([call.callee_id, call[CALLS], call[SAMPLES2]])
+            functions.append([function.id, function.name, function.module, self.files.get(function.id, ''), function[SAMPLES], function.called, calls])
+        return {
+            'version': self.checkpoint_version,
+            'line_no': self.line_no,
+            'position_ids': [[table, id, name] for (table, id), name in compat_iteritems(self.position_ids)],
+            'positions': self.positions,
+            'cost_positions': self.cost_positions,
+            'last_positions': self.last_positions,
+            'cost_events': self.cost_events,
+            'samples': self.profile[SAMPLES],
+            'functions': functions,
+            'spliced': list(self.splicedFunctions or ()),
+            'pending': [[function_id, list(queue)] for function_id, queue in compat_iteritems(self.pending)],
+            # The invocation being read is the last of its function's
+            'invocation': self.invocation is not None and not self.new_block and self.get_function().id or None,
+            'new_block': self.new_block,
+        }
+
+    def restore(self, state):
+        """Restore the state returned by save()."""
+
+        self.resumed = True
+        self.line_no = state['line_no']
+        self.position_ids = dict([((table, id), name) for table, id, name in state['position_ids']])
+        self.positions = state['positions']
+        self.cost_positions = state['cost_positions']
+        self.num_positions = len(self.cost_positions)
+        self.last_positions = state['last_positions']
+        self.cost_events = state['cost_events']
+        self.num_events = len(self.cost_events)
+        self.profile[SAMPLES] = state['samples']
+        for id, name, module, filename, samples, called, calls in state['functions']:
+            function = Function(id, name)
+            function.module = module
+            self.files[id] = filename
+            function[SAMPLES] = samples
+            function.called = called
+            for callee_id, count, samples2 in calls:
+                call = Call(callee_id)
+                call[CALLS] = count
+                call[SAMPLES2] = samples2
+                function.add_call(call)
+            self.profile.add_function(function)
+        self.pending = dict([(function_id, collections.deque(queue)) for function_id, queue in state['pending']])
+        if state['invocation'] is not None:
+            self.invocation = self.pending[state['invocation']][-1]
+        self.new_block = state['new_block']
+
+    def save_checkpoint(self):
+        import json
+
+        fp = self._stream.fp
+        state = self.save()
+        state['offset'] = self.checkpoint_offset
+        state['digests'] = self.checkpoint_digests(fp, self.checkpoint_offset)
+        output = AtomicOutput(self.checkpoint)
+        try:
+            # dumps() rather than dump(), which would use the slower pure
+            # Python encoder
+            output.fp.write(json.dumps(state, separators=(',', ':')))
+            output.commit()
+        finally:
+            output.discard()
+
     def parse(self):
+        if self.splicedFunctions:
+            self.splice = FilterRules(self.splicedFunctions)
+            for function in compat_itervalues(self.profile.functions):
+                if self.splice.match(function.name, function.module, self.files.get(function.id, '')):
+                    self.spliced.add(function.id)
+
         # read lookahead
         self.readline()
 
-        self.parse_key('version')
-        self.parse_key('creator')
+        if self.resumed:
+            # Carry on with the part being read
+            while self.parse_body_line():
+                pass
+        else:
+            self.parse_key('version')
+            self.parse_key('creator')
         while self.parse_part():
             pass
         if not self.eof():
             sys.stderr.write('warning: line %u: unexpected line\n' % self.line_no)
             sys.stderr.write('%s\n' % self.lookahead())
 
+        if self.checkpoint is not None:
+            if self.eof():
+                self.save_checkpoint()
+            self._stream.close()
+
+        if self.spliced:
+            self.fold_spliced()
+
+        if self.functionFilter is not None:
+            excluded = []
+            for function in compat_itervalues(self.profile.functions):
+                if not self.functionFilter.match(function.name, function.module, self.files.get(function.id, '')):
+                    excluded.append(function.id)
+            # The cost of calls is inclusive, so functions are folded into
+            # their callers in proportion to it
+            self.profile.fold(excluded, SAMPLES, SAMPLES2)
+
         # compute derived data
         self.profile.validate()
-        self.profile.find_cycles()
-        self.profile.ratio(TIME_RATIO, SAMPLES)
-        self.profile.call_ratios(SAMPLES2)
-        self.profile.integrate(TOTAL_TIME_RATIO, TIME_RATIO)
+        if self.aggregateBy is not None:
+            groups = {}
+            for function in compat_itervalues(self.profile.functions):
+                groups[function.id] = self.aggregate_key(function)
+            self.profile = self.profile.group(groups, SAMPLES, SAMPLES2)
+        if self.totalMethod == 'inclusive':
+            # The cost of each call is its inclusive cost
+            self.profile.find_cycles()
+            self.profile.ratio(TIME_RATIO, SAMPLES)
+            self.profile.inclusive(TOTAL_TIME_RATIO, SAMPLES, SAMPLES2)
+        else:
+            self.profile.find_cycles()
+            self.profile.ratio(TIME_RATIO, SAMPLES)
+            self.profile.call_ratios(SAMPLES2)
+            self.profile.integrate(TOTAL_TIME_RATIO, TIME_RATIO)
 
         return self.profile
 
+    def aggregate_key(self, function):
+        """Return the name of the group of a function."""
+
+        if self.aggregateBy == 'file':
+            return self.files.get(function.id) or function.name
+        if self.aggregateBy == 'module':
+            return function.module or function.name
+        key = php_class(function.name)
+        if self.aggregateBy == 'namespace':
+            key = php_namespace(key)
+        return key
+
     def parse_part(self):
         if not self.parse_header_line():
             return False
@@ -1729,7 +3059,7 @@ class CallgrindParser(LineParser):
             self.parse_association_spec()
 
     __subpos_re = r'(0x[0-9a-fA-F]+|\d+|\+\d+|-\d+|\*)'
-    _cost_re = re.compile(r'^' +
+    _cost_re = LazyRegex(r'^' +
         __subpos_re + r'( +' + __subpos_re + r')*' +
         r'( +\d+)*' +
     '$')
@@ -1773,26 +3103,106 @@ class CallgrindParser(LineParser):
         events = [float(event) for event in events]
 
         if calls is None:
-            function[SAMPLES] += events[0]
             self.profile[SAMPLES] += events[0]
+            if self.spliced and self.get_invocation(function) is not None:
+                self.invocation[0] += events[0]
+            else:
+                function[SAMPLES] += events[0]
         else:
             callee = self.get_callee()
-            callee.called += calls
-
-            try:
-                call = function.calls[callee.id]
-            except KeyError:
-                call = Call(callee.id)
-                call[CALLS] = calls
-                call[SAMPLES2] = events[0]
-                function.add_call(call)
-            else:
-                call[CALLS] += calls
-                call[SAMPLES2] += events[0]
+            if not self.spliced or not self.splice_call(function, callee, calls, events[0]):
+                callee.called += calls
+                self.add_call(function, callee.id, calls, events[0])
 
         self.consume()
         return True
 
+    def add_call(self, function, callee_id, calls, cost):
+        try:
+            call = function.calls[callee_id]
+        except KeyError:
+            call = Call(callee_id)
+            call[CALLS] = calls
+            call[SAMPLES2] = cost
+            function.add_call(call)
+        else:
+            call[CALLS] += calls
+            call[SAMPLES2] += cost
+
+    # Spliced functions, like call_user_func() or PHP internal functions, are
+    # left out of the call graph: their callers call what they call, and
+    # their self cost is the callers' own.  Xdebug writes a block for every
+    # invocation, when it returns, so before the block of its caller.  Their
+    # invocations are thus queued, and each call to a spliced function
+    # claims the oldest one, as webgrind's preprocessor does for proxies.
+
+    def get_invocation(self, function):
+        """Return the invocation being read, when the function is
+        spliced."""
+
+        if self.new_block:
+            self.new_block = False
+            if function.id in self.spliced:
+                self.invocation = [0.0, []]
+                try:
+                    queue = self.pending[function.id]
+                except KeyError:
+                    queue = self.pending[function.id] = collections.deque()
+                queue.append(self.invocation)
+            else:
+                self.invocation = None
+        return self.invocation
+
+    def splice_call(self, function, callee, calls, cost):
+        """Record a call from or to a spliced function.  Return False for
+        calls between functions that are kept."""
+
+        invocation = self.get_invocation(function)
+        if callee.id in self.spliced:
+            queue = self.pending.get(callee.id)
+            if queue and queue[0] is not invocation:
+                self_cost, subcalls = queue.popleft()
+                if invocation is None:
+                    function[SAMPLES] += self_cost
+                    for callee_id, subcall_calls, subcall_cost in subcalls:
+                        self.add_call(function, callee_id, subcall_calls, subcall_cost)
+                else:
+                    invocation[0] += self_cost
+                    invocation[1].extend(subcalls)
+                return True
+        if invocation is None:
+            return False
+        callee.called += calls
+        invocation[1].append([callee.id, calls, cost])
+        return True
+
+    def fold_spliced(self):
+        """Charge the invocations no caller claimed to the spliced functions,
+        and fold these into their callers, as in aggregated profiles, or when
+        a spliced function calls itself."""
+
+        for function_id, queue in compat_iteritems(self.pending):
+            function = self.profile.functions[function_id]
+            for self_cost, subcalls in queue:
+                function[SAMPLES] += self_cost
+                for callee_id, calls, cost in subcalls:
+                    self.add_call(function, callee_id, calls, cost)
+        self.pending = {}
+        self.invocation = None
+
+        called = set()
+        for function in compat_itervalues(self.profile.functions):
+            for callee_id in function.calls:
+                if callee_id != function.id:
+                    called.add(callee_id)
+        folded = []
+        for function_id in self.spliced:
+            function = self.profile.functions[function_id]
+            # Keep those at the root of the graph with a cost of their own
+            if function_id in called or not (function[SAMPLES] or function.calls):
+                folded.append(function_id)
+        self.profile.fold(folded, SAMPLES, SAMPLES2)
+
     def parse_association_spec(self):
         line = self.lookahead()
         if not line.startswith('calls='):
@@ -1808,7 +3218,7 @@ class CallgrindParser(LineParser):
 
         return True
 
-    _position_re = re.compile(r'^(?P<position>[cj]?(?:ob|fl|fi|fe|fn))=\s*(?:\((?P<id>\d+)\))?(?:\s*(?P<name>.+))?')
+    _position_re = LazyRegex(r'^(?P<position>[cj]?(?:ob|fl|fi|fe|fn))=\s*(?:\((?P<id>\d+)\))?(?:\s*(?P<name>.+))?')
 
     _position_table_map = {
         'ob': 'ob',
@@ -1857,6 +3267,8 @@ class CallgrindParser(LineParser):
             else:
                 name = self.position_ids.get((table, id), '')
         self.positions[self._position_map[position]] = name
+        if position == 'fn':
+            self.new_block = True
 
         self.consume()
         return True
@@ -1877,7 +3289,7 @@ class CallgrindParser(LineParser):
         self.consume()
         return True
 
-    _key_re = re.compile(r'^(\w+):')
+    _key_re = LazyRegex(r'^(\w+):')
 
     def parse_key(self, key):
         pair = self.parse_keys((key,))
@@ -1911,6 +3323,9 @@ class CallgrindParser(LineParser):
             function[SAMPLES] = 0
             function.called = 0
             self.profile.add_function(function)
+            self.files[id] = filename
+            if self.splice is not None and self.splice.match(name, function.module, filename):
+                self.spliced.add(id)
         return function
 
     def get_function(self):
@@ -1921,7 +3336,7 @@ class CallgrindParser(LineParser):
 
     def get_callee(self):
         module = self.positions.get('cob', '')
-        filename = self.positions.get('cfi', '')
+        filename = self.positions.get('cfl', '')
         function = self.positions.get('cfn', '')
         return self.make_function(module, filename, function)
 
@@ -1942,9 +3357,14 @@ class PerfParser(LineParser):
         perf script | gprof2dot.py --format=perf
     """
 
+    filterFunctions = True
+
     def __init__(self, infile):
         LineParser.__init__(self, infile)
         self.profile = Profile()
+        self.aggregator = StackAggregator(self.profile, total_event=TOTAL_SAMPLES)
+        self.symbols = {}
+        self.malformed = 0
 
     def readline(self):
         # Override LineParser.readline to ignore comment lines
@@ -1961,16 +3381,21 @@ class PerfParser(LineParser):
         profile[SAMPLES] = 0
         while not self.eof():
             self.parse_event()
+        # Functions were filtered as the call chains were read
+        self.aggregator.flush()
+
+        if self.malformed:
+            sys.stderr.write('warning: skipped %u malformed call lines\n' % self.malformed)
 
         # compute derived data
         profile.validate()
         profile.find_cycles()
         profile.ratio(TIME_RATIO, SAMPLES)
         profile.call_ratios(SAMPLES2)
-        if totalMethod == "callratios":
+        if self.totalMethod == "callratios":
             # Heuristic approach.  TOTAL_SAMPLES is unused.
             profile.integrate(TOTAL_TIME_RATIO, TIME_RATIO)
-        elif totalMethod == "callstacks":
+        elif self.totalMethod == "callstacks":
             # Use the actual call chains for functions.
             profile[TOTAL_SAMPLES] = profile[SAMPLES]
             profile.ratio(TOTAL_TIME_RATIO, TOTAL_SAMPLES)
@@ -1996,58 +3421,70 @@ class PerfParser(LineParser):
         if not callchain:
             return
 
-        callee = callchain[0]
-        callee[SAMPLES] += 1
-        self.profile[SAMPLES] += 1
-
-        for caller in callchain[1:]:
-            try:
-                call = caller.calls[callee.id]
-            except KeyError:
-                call = Call(callee.id)
-                call[SAMPLES2] = 1
-                caller.add_call(call)
-            else:
-                call[SAMPLES2] += 1
-
-            callee = caller
-
-        # Increment TOTAL_SAMPLES only once on each function.
-        stack = set(callchain)
-        for function in stack:
-            function[TOTAL_SAMPLES] += 1
+        self.aggregator.add(tuple(callchain))
 
     def parse_callchain(self):
         callchain = []
         while self.lookahead():
             function = self.parse_call()
-            if function is None:
-                break
-            callchain.append(function)
+            if function is not None:
+                callchain.append(function)
         if self.lookahead() == '':
             self.consume()
         return callchain
 
-    call_re = re.compile(r'^\s+(?P<address>[0-9a-fA-F]+)\s+(?P<symbol>.*)\s+\((?P<module>.*)\)$')
-    addr2_re = re.compile(r'\+0x[0-9a-fA-F]+$')
+    call_re = LazyRegex(r'^\s+(?P<address>[0-9a-fA-F]+)\s+(?P<symbol>.*)\s+\((?P<module>.*)\)$')
+    addr2_re = LazyRegex(r'\+0x[0-9a-fA-F]+$')
 
     def parse_call(self):
         line = self.consume()
+
+        # Call lines look like "\t    7f3b2c1d symbol+0x1f (/path/to/module)".
+        # Resolved functions are cached by the text after the address, which
+        # repeats a lot, so most lines cost only a split and a lookup.
+        fields = line.split(None, 1)
+        if len(fields) == 2 and line[:1].isspace():
+            address, rest = fields
+            try:
+                return self.symbols[rest]
+            except KeyError:
+                pass
+            i = rest.rfind(' (')
+            if i >= 0 and rest.endswith(')'):
+                return self.get_function(address, rest[:i].rstrip(), rest[i + 2:-1], rest)
+
+        # Unusual spacing
         mo = self.call_re.match(line)
-        assert mo
         if not mo:
+            self.malformed += 1
             return None
+        symbol = mo.group('symbol')
+        module = mo.group('module')
+        return self.get_function(mo.group('address'), symbol, module, symbol + ' (' + module + ')')
 
-        function_name = mo.group('symbol')
+    def get_function(self, address, symbol, module, key):
+        function_name = symbol
 
         # If present, amputate program counter from function name.
-        if function_name:
-            function_name = re.sub(self.addr2_re, '', function_name)
+        i = function_name.rfind('+0x')
+        if i >= 0 and self.addr2_re.match(function_name, i):
+            function_name = function_name[:i]
 
         if not function_name or function_name == '[unknown]':
-            function_name = mo.group('address')
+            # The function name depends on the address, so it can't be cached
+            # by the symbol text alone
+            function_name = address
+            key = address + ' ' + key
+            try:
+                return self.symbols[key]
+            except KeyError:
+                pass
 
-        module = mo.group('module')
+        # The shared object path stands in for the file, for path: rules
+        if self.functionFilter is not None and not self.functionFilter.match(function_name, os.path.basename(module), module):
+            # Left out of the call chains
+            self.symbols[key] = None
+            return None
 
         function_id = function_name + ':' + module
 
@@ -2060,6 +3497,7 @@ class PerfParser(LineParser):
             function[TOTAL_SAMPLES] = 0
             self.profile.add_function(function)
 
+        self.symbols[key] = function
         return function
 
 
@@ -2237,8 +3675,12 @@ class HProfParser(LineParser):
     - http://java.sun.com/developer/technicalArticles/Programming/HPROF.html
     """
 
-    trace_re = re.compile(r'\t(.*)\((.*):(.*)\)')
-    trace_id_re = re.compile(r'^TRACE (\d+):$')
+    filterFunctions = True
+
+    trace_id_re = LazyRegex(r'^TRACE (\d+):$')
+
+    # Size of the blocks read backwards when looking for the samples
+    block_size = 64*1024
 
     def __init__(self, infile):
         LineParser.__init__(self, infile)
@@ -2246,6 +3688,52 @@ class HProfParser(LineParser):
         self.samples = {}
 
     def parse(self):
+        self.profile = Profile()
+        self.profile[SAMPLES] = 0
+        self.functions = {}
+        self.aggregator = StackAggregator(self.profile)
+
+        # Seekable files are read in binary, samples first, so that only the
+        # sampled traces are ever built
+        stream = getattr(self._stream, 'buffer', None)
+        if stream is not None and stream.seekable():
+            self.parse_seekable(stream)
+            # Lines were skipped rather than counted
+            self.line_no = None
+        else:
+            self.parse_sequential()
+        self.aggregator.flush(self.functionFilter)
+
+        profile = self.profile
+
+        # compute derived data
+        profile.validate()
+        profile.find_cycles()
+        profile.ratio(TIME_RATIO, SAMPLES)
+        profile.call_ratios(SAMPLES2)
+        profile.integrate(TOTAL_TIME_RATIO, TIME_RATIO)
+
+        return profile
+
+    def get_function(self, name):
+        try:
+            return self.functions[name]
+        except KeyError:
+            function = Function(name, name)
+            function[SAMPLES] = 0
+            self.profile.add_function(function)
+            self.functions[name] = function
+            return function
+
+    def add_trace(self, id, callchain):
+        # time is allocated to the deepest method in the trace
+        if callchain:
+            self.aggregator.add(tuple(callchain), self.samples[id][0])
+
+    def parse_sequential(self):
+        """Parse traces and then samples in a single pass, keeping each trace
+        as a tuple of interned function names until the samples are known."""
+
         # read lookahead
         self.readline()
 
@@ -2259,50 +3747,18 @@ class HProfParser(LineParser):
 
         self.parse_samples()
 
-        # populate the profile
-        profile = Profile()
-        profile[SAMPLES] = 0
-
-        functions = {}
-
         # build up callgraph
         for id, trace in compat_iteritems(self.traces):
-            if not id in self.samples: continue
-            mtime = self.samples[id][0]
-            last = None
-
-            for func, file, line in trace:
-                if not func in functions:
-                    function = Function(func, func)
-                    function[SAMPLES] = 0
-                    profile.add_function(function)
-                    functions[func] = function
-
-                function = functions[func]
-                # allocate time to the deepest method in the trace
-                if not last:
-                    function[SAMPLES] += mtime
-                    profile[SAMPLES] += mtime
-                else:
-                    c = function.get_call(last)
-                    c[SAMPLES2] += mtime
-
-                last = func
-
-        # compute derived data
-        profile.validate()
-        profile.find_cycles()
-        profile.ratio(TIME_RATIO, SAMPLES)
-        profile.call_ratios(SAMPLES2)
-        profile.integrate(TOTAL_TIME_RATIO, TIME_RATIO)
-
-        return profile
+            if id in self.samples:
+                self.add_trace(id, [self.get_function(name) for name in trace])
+        self.traces = {}
 
     def parse_traces(self):
+        names = {}
         while self.lookahead().startswith('TRACE '):
-            self.parse_trace()
+            self.parse_trace(names)
 
-    def parse_trace(self):
+    def parse_trace(self, names):
         l = self.consume()
         mo = self.trace_id_re.match(l)
         tid = mo.group(1)
@@ -2311,15 +3767,15 @@ class HProfParser(LineParser):
 
         while self.lookahead().startswith('\t'):
             l = self.consume()
-            match = self.trace_re.search(l)
-            if not match:
-                #sys.stderr.write('Invalid line: %s\n' % l)
-                break
-            else:
-                function_name, file, line = match.groups()
-                trace += [(function_name, file, line)]
+            # As in parse_seekable(), the name is what precedes the last
+            # parenthesis, which holds the file and line, or "Native Method"
+            paren = l.rfind('(')
+            if paren < 0:
+                continue
+            function_name = l[1:paren]
+            trace.append(names.setdefault(function_name, function_name))
 
-        self.traces[int(tid)] = trace
+        self.traces[int(tid)] = tuple(trace)
 
     def parse_samples(self):
         self.consume()
@@ -2330,56 +3786,201 @@ class HProfParser(LineParser):
             self.samples[int(traceid)] = (int(count), method)
             self.consume()
 
+    def parse_seekable(self, fp):
+        """Read the samples at the end of the file, then build the sampled
+        traces in a single forward pass."""
 
-class SysprofParser(XmlParser):
+        end = self.find_samples(fp)
+        if end is None:
+            raise ParseError('CPU samples not found')
 
-    def __init__(self, stream):
-        XmlParser.__init__(self, stream)
+        fp.seek(end)
+        fp.readline()
+        fp.readline()
+        for line in fp:
+            if line.startswith(b'CPU'):
+                break
+            rank, percent_self, percent_accum, count, traceid, method = line.split()
+            self.samples[int(traceid)] = (int(count), method.decode('UTF-8'))
+
+        fp.seek(0)
+        pos = 0
+        for line in fp:
+            pos += len(line)
+            if line.startswith(b'------'):
+                break
+
+        samples = self.samples
+        functions = {}
+        id = None
+        callchain = None
+        for line in fp:
+            pos += len(line)
+            if pos > end:
+                break
+            if line.startswith(b'\t'):
+                if callchain is not None:
+                    # Frames look like "\tpackage.Class.method(File.java:123)"
+                    paren = line.rfind(b'(')
+                    if paren < 0:
+                        continue
+                    name = line[1:paren]
+                    try:
+                        function = functions[name]
+                    except KeyError:
+                        function = self.get_function(name.decode('UTF-8'))
+                        functions[name] = function
+                    callchain.append(function)
+                continue
+            if callchain is not None:
+                self.add_trace(id, callchain)
+                callchain = None
+            if line.startswith(b'TRACE '):
+                id = int(line[6:line.index(b':')])
+                if id in samples:
+                    callchain = []
+        if callchain is not None:
+            self.add_trace(id, callchain)
+
+    def find_samples(self, fp):
+        """Return the offset of the CPU samples section, searching backwards
+        from the end of the file."""
+
+        fp.seek(0, 2)
+        pos = fp.tell()
+        # The start of the previous block, up to its first line break
+        carry = b''
+        while pos > 0:
+            size = min(self.block_size, pos)
+            pos -= size
+            fp.seek(pos)
+            block = fp.read(size) + carry
+            start = len(block)
+            while True:
+                start = block.rfind(b'\nCPU ', 0, start)
+                if start < 0:
+                    break
+                end = block.find(b'\n', start + 1)
+                if end < 0:
+                    end = len(block)
+                if b'BEGIN' in block[start:end]:
+                    return pos + start + 1
+            carry = block[:block.find(b'\n') + 1] or block
+        if carry.startswith(b'CPU ') and b'BEGIN' in carry.split(b'\n', 1)[0]:
+            return 0
+        return None
+
+
+class SysprofParser(XmlParser):
+    """Parser for sysprof XML captures.
+
+    Functions and calls are created as each object and node element closes,
+    so only the id of the function its children are charged to is kept per
+    tree node.
+    """
+
+    def __init__(self, stream):
+        XmlParser.__init__(self, stream)
 
     def parse(self):
-        objects = {}
-        nodes = {}
+        self.profile = Profile()
+        self.profile[SAMPLES] = 0
+
+        # Object id -> self samples, which are zero for fake objects
+        self.objects = {}
+        # Node id -> id of the closest non-fake object on its path, or 0
+        self.nodes = {}
+        # Node id -> (object id, parent node id, self samples) for nodes seen
+        # before their parent or object
+        self.pending = {}
 
         self.element_start('profile')
         while self.token.type == XML_ELEMENT_START:
             if self.token.name_or_data == 'objects':
-                assert not objects
-                objects = self.parse_items('objects')
+                assert not self.objects
+                self.parse_items('objects', self.parse_object)
             elif self.token.name_or_data == 'nodes':
-                assert not nodes
-                nodes = self.parse_items('nodes')
+                assert not self.nodes
+                self.parse_items('nodes', self.parse_node)
             else:
                 self.parse_value(self.token.name_or_data)
         self.element_end('profile')
 
-        return self.build_profile(objects, nodes)
+        # Resolve pending nodes, ancestors first
+        pending = self.pending
+        for id in list(pending):
+            chain = []
+            while id in pending:
+                chain.append(id)
+                id = pending[id][1]
+            for id in reversed(chain):
+                object_id, parent_id, samples = pending.pop(id)
+                if not self.add_node(id, object_id, parent_id, samples):
+                    raise ParseError('unresolved node', id)
+
+        profile = self.profile
+
+        # Compute derived events
+        profile.validate()
+        profile.find_cycles()
+        profile.ratio(TIME_RATIO, SAMPLES)
+        profile.call_ratios(SAMPLES2)
+        profile.integrate(TOTAL_TIME_RATIO, TIME_RATIO)
+
+        return profile
 
-    def parse_items(self, name):
-        assert name[-1] == 's'
-        items = {}
+    def parse_items(self, name, parse_item):
         self.element_start(name)
         while self.token.type == XML_ELEMENT_START:
-            id, values = self.parse_item(name[:-1])
-            assert id not in items
-            items[id] = values
+            parse_item()
         self.element_end(name)
-        return items
 
-    def parse_item(self, name):
-        attrs = self.element_start(name)
+    def parse_object(self):
+        attrs = self.element_start('object')
         id = int(attrs['id'])
-        values = self.parse_values()
-        self.element_end(name)
-        return id, values
+        name = None
+        samples = 0
+        while self.token.type == XML_ELEMENT_START:
+            tag = self.token.name_or_data
+            value = self.parse_value(tag)
+            if tag == 'name':
+                name = value
+            elif tag == 'self':
+                samples = value
+        self.element_end('object')
+
+        assert id not in self.objects
+        self.objects[id] = samples
+
+        # Ignore fake objects (process names, modules, "Everything", "kernel", etc.)
+        if samples == 0:
+            return
+
+        function = Function(id, name)
+        function[SAMPLES] = samples
+        self.profile.add_function(function)
+        self.profile[SAMPLES] += samples
 
-    def parse_values(self):
-        values = {}
+    def parse_node(self):
+        attrs = self.element_start('node')
+        id = int(attrs['id'])
+        object_id = 0
+        parent_id = 0
+        samples = 0
         while self.token.type == XML_ELEMENT_START:
-            name = self.token.name_or_data
-            value = self.parse_value(name)
-            assert name not in values
-            values[name] = value
-        return values
+            tag = self.token.name_or_data
+            value = self.parse_value(tag)
+            if tag == 'object':
+                object_id = value
+            elif tag == 'parent':
+                parent_id = value
+            elif tag == 'self':
+                samples = value
+        self.element_end('node')
+
+        assert id not in self.nodes and id not in self.pending
+        if not self.add_node(id, object_id, parent_id, samples):
+            self.pending[id] = (object_id, parent_id, samples)
 
     def parse_value(self, tag):
         self.element_start(tag)
@@ -2391,73 +3992,66 @@ class SysprofParser(XmlParser):
             return value[1:-1]
         return value
 
-    def build_profile(self, objects, nodes):
-        profile = Profile()
-
-        profile[SAMPLES] = 0
-        for id, object in compat_iteritems(objects):
-            # Ignore fake objects (process names, modules, "Everything", "kernel", etc.)
-            if object['self'] == 0:
-                continue
-
-            function = Function(id, object['name'])
-            function[SAMPLES] = object['self']
-            profile.add_function(function)
-            profile[SAMPLES] += function[SAMPLES]
-
-        for id, node in compat_iteritems(nodes):
-            # Ignore fake calls
-            if node['self'] == 0:
-                continue
+    def add_node(self, id, object_id, parent_id, samples):
+        """Record a node and charge its samples to the call from the closest
+        non-fake ancestor.
 
-            # Find a non-ignored parent
-            parent_id = node['parent']
-            while parent_id != 0:
-                parent = nodes[parent_id]
-                caller_id = parent['object']
-                if objects[caller_id]['self'] != 0:
-                    break
-                parent_id = parent['parent']
-            if parent_id == 0:
-                continue
+        Returns False when the parent or the object is not known yet."""
 
-            callee_id = node['object']
+        objects = self.objects
+        nodes = self.nodes
 
-            assert objects[caller_id]['self']
-            assert objects[callee_id]['self']
-
-            function = profile.functions[caller_id]
-
-            samples = node['self']
+        if parent_id == 0:
+            caller_id = 0
+        else:
             try:
-                call = function.calls[callee_id]
+                caller_id = nodes[parent_id]
             except KeyError:
-                call = Call(callee_id)
-                call[SAMPLES2] = samples
-                function.add_call(call)
-            else:
-                call[SAMPLES2] += samples
+                return False
+        try:
+            callee_samples = objects[object_id]
+        except KeyError:
+            return False
 
-        # Compute derived events
-        profile.validate()
-        profile.find_cycles()
-        profile.ratio(TIME_RATIO, SAMPLES)
-        profile.call_ratios(SAMPLES2)
-        profile.integrate(TOTAL_TIME_RATIO, TIME_RATIO)
+        # Ignore fake objects along the path
+        nodes[id] = object_id if callee_samples != 0 else caller_id
 
-        return profile
+        # Ignore fake calls
+        if samples == 0 or caller_id == 0:
+            return True
+
+        assert callee_samples
+
+        function = self.profile.functions[caller_id]
+        try:
+            call = function.calls[object_id]
+        except KeyError:
+            call = Call(object_id)
+            call[SAMPLES2] = samples
+            function.add_call(call)
+        else:
+            call[SAMPLES2] += samples
+        return True
 
 
 class XPerfParser(Parser):
     """Parser for CSVs generted by XPerf, from Microsoft Windows Performance Tools.
     """
 
+    filterFunctions = True
+
     def __init__(self, stream):
         Parser.__init__(self)
         self.stream = stream
         self.profile = Profile()
         self.profile[SAMPLES] = 0
+        self.aggregator = StackAggregator(self.profile, self_event=None)
         self.column = {}
+        self.columns = None
+        self.callchains = {}
+
+    def inputs(self):
+        return [self.stream]
 
     def parse(self):
         import csv
@@ -2477,6 +4071,7 @@ class XPerfParser(Parser):
                 header = False
             else:
                 self.parse_row(row)
+        self.aggregator.flush(self.functionFilter)
 
         # compute derived data
         self.profile.validate()
@@ -2487,57 +4082,96 @@ class XPerfParser(Parser):
 
         return self.profile
 
+    # Only these columns are read
+    _columns = ('Process Name', 'Module', 'Function', 'Weight', 'Count', 'Stack')
+
     def parse_header(self, row):
         for column in range(len(row)):
             name = row[column]
             assert name not in self.column
             self.column[name] = column
+        self.columns = [self.column[name] for name in self._columns]
 
-    def parse_row(self, row):
-        fields = {}
-        for name, column in compat_iteritems(self.column):
-            value = row[column]
-            for factory in int, float:
-                try:
-                    value = factory(value)
-                except ValueError:
-                    pass
-                else:
-                    break
-            fields[name] = value
+    @staticmethod
+    def number(value):
+        try:
+            return int(value)
+        except ValueError:
+            return float(value)
 
-        process = fields['Process Name']
-        symbol = fields['Module'] + '!' + fields['Function']
-        weight = fields['Weight']
-        count = fields['Count']
+    def parse_row(self, row):
+        process_column, module_column, function_column, weight_column, count_column, stack_column = self.columns
 
+        process = row[process_column]
         if process == 'Idle':
             return
 
+        symbol = row[module_column] + '!' + row[function_column]
+        weight = self.number(row[weight_column])
+        count = self.number(row[count_column])
+
         function = self.get_function(process, symbol)
-        function[SAMPLES] += weight * count
         self.profile[SAMPLES] += weight * count
 
-        stack = fields['Stack']
+        stack = row[stack_column]
+        callchain = ()
         if stack != '?':
-            stack = stack.split('/')
-            assert stack[0] == '[Root]'
-            if stack[-1] != symbol:
+            callchain = self.get_callchain(process, stack)
+            if not callchain or callchain[0] is not function:
                 # XXX: some cases the sampled function does not appear in the stack
-                stack.append(symbol)
-            caller = None
-            for symbol in stack[1:]:
-                callee = self.get_function(process, symbol)
-                if caller is not None:
-                    try:
-                        call = caller.calls[callee.id]
-                    except KeyError:
-                        call = Call(callee.id)
-                        call[SAMPLES2] = count
-                        caller.add_call(call)
-                    else:
-                        call[SAMPLES2] += count
-                caller = callee
+                callchain = (function,) + callchain
+            self.aggregator.add(callchain, count)
+
+        if self.functionFilter is not None and not self.functionFilter.keep(function):
+            # Charge the nearest caller that is kept, if any
+            function = None
+            for caller in callchain:
+                if self.functionFilter.keep(caller):
+                    function = caller
+                    break
+            if function is None:
+                return
+        function[SAMPLES] += weight * count
+
+    def get_callchain(self, process, stack):
+        """Resolve a '[Root]/module!function/...' stack into a tuple of
+        functions, from the last frame to the first.
+
+        The resolved chain of every stack prefix is cached, so that a stack
+        only costs the resolution of the frames it doesn't share with stacks
+        seen before."""
+
+        try:
+            callchains = self.callchains[process]
+        except KeyError:
+            callchains = self.callchains[process] = {}
+        try:
+            return callchains[stack]
+        except KeyError:
+            pass
+
+        # Walk up to the longest known prefix
+        unresolved = []
+        prefix = stack
+        while True:
+            i = prefix.rfind('/')
+            if i < 0:
+                assert prefix == '[Root]'
+                callchain = ()
+                break
+            unresolved.append((prefix, prefix[i + 1:]))
+            prefix = prefix[:i]
+            try:
+                callchain = callchains[prefix]
+            except KeyError:
+                continue
+            break
+
+        # And back down
+        for prefix, symbol in reversed(unresolved):
+            callchain = (self.get_function(process, symbol),) + callchain
+            callchains[prefix] = callchain
+        return callchain
 
     def get_function(self, process, symbol):
         function_id = process + '!' + symbol
@@ -2564,6 +4198,7 @@ class SleepyParser(Parser):
     """
 
     stdinInput = False
+    filterFunctions = True
 
     def __init__(self, filename):
         Parser.__init__(self)
@@ -2576,8 +4211,12 @@ class SleepyParser(Parser):
         self.calls = {}
 
         self.profile = Profile()
+        self.aggregator = StackAggregator(self.profile)
+
+    def inputs(self):
+        return [self.database.fp]
 
-    _symbol_re = re.compile(
+    _symbol_re = LazyRegex(
         r'^(?P<id>\w+)' +
         r'\s+"(?P<module>[^"]*)"' +
         r'\s+"(?P<procname>[^"]*)"' +
@@ -2594,9 +4233,31 @@ class SleepyParser(Parser):
 
         return self.database.open(name, 'r')
 
+    def readEntryLines(self, name, size = 256*1024):
+        """Yield the lines of an entry, decoding it in large chunks."""
+
+        import codecs
+
+        decoder = codecs.getincrementaldecoder('UTF-8')()
+        entry = self.openEntry(name)
+        try:
+            rest = ''
+            while True:
+                data = entry.read(size)
+                lines = (rest + decoder.decode(data, not data)).split('\n')
+                rest = lines.pop()
+                for line in lines:
+                    yield line
+                if not data:
+                    break
+            if rest:
+                yield rest
+        finally:
+            entry.close()
+
     def parse_symbols(self):
-        for line in self.openEntry('Symbols.txt'):
-            line = line.decode('UTF-8').rstrip('\r\n')
+        for line in self.readEntryLines('Symbols.txt'):
+            line = line.rstrip('\r')
 
             mo = self._symbol_re.match(line)
             if mo:
@@ -2615,31 +4276,28 @@ class SleepyParser(Parser):
                 self.symbols[symbol_id] = function
 
     def parse_callstacks(self):
-        for line in self.openEntry('Callstacks.txt'):
-            line = line.decode('UTF-8').rstrip('\r\n')
-
-            fields = line.split()
-            samples = float(fields[0])
-            callstack = fields[1:]
-
-            callstack = [self.symbols[symbol_id] for symbol_id in callstack]
-
-            callee = callstack[0]
-
-            callee[SAMPLES] += samples
-            self.profile[SAMPLES] += samples
-
-            for caller in callstack[1:]:
-                try:
-                    call = caller.calls[callee.id]
-                except KeyError:
-                    call = Call(callee.id)
-                    call[SAMPLES2] = samples
-                    caller.add_call(call)
-                else:
-                    call[SAMPLES2] += samples
+        # Merge identical stacks by their text first, so that the symbols of
+        # a stack are only split and looked up once
+        stacks = {}
+        for line in self.readEntryLines('Callstacks.txt'):
+            fields = line.split(None, 1)
+            if len(fields) < 2:
+                continue
+            samples, callstack = fields
+            try:
+                samples = int(samples)
+            except ValueError:
+                samples = float(samples)
+            try:
+                stacks[callstack] += samples
+            except KeyError:
+                stacks[callstack] = samples
 
-                callee = caller
+        symbols = self.symbols
+        for callstack, samples in compat_iteritems(stacks):
+            callstack = tuple([symbols[symbol_id] for symbol_id in callstack.split()])
+            self.aggregator.add(callstack, samples)
+        self.aggregator.flush(self.functionFilter)
 
     def parse(self):
         profile = self.profile
@@ -2658,25 +4316,131 @@ class SleepyParser(Parser):
         return profile
 
 
-class PstatsParser:
+def add_pstats(target, source):
+    """Merge a (cc, nc, tt, ct, callers) stats table into another, as
+    pstats.Stats.add does.  The source table is consumed."""
+
+    for func, stat in compat_iteritems(source):
+        try:
+            old = target[func]
+        except KeyError:
+            target[func] = stat
+            continue
+        cc, nc, tt, ct, callers = stat
+        old_cc, old_nc, old_tt, old_ct, old_callers = old
+        for caller, value in compat_iteritems(callers):
+            try:
+                old_value = old_callers[caller]
+            except KeyError:
+                old_callers[caller] = value
+            else:
+                if isinstance(value, tuple):
+                    # format used by cProfile
+                    old_callers[caller] = tuple([i + j for i, j in zip(value, old_value)])
+                else:
+                    # format used by profile
+                    old_callers[caller] = value + old_value
+        target[func] = cc + old_cc, nc + old_nc, tt + old_tt, ct + old_ct, old_callers
+    return target
+
+
+def reduce_pstats(tables):
+    """Merge stats tables pairwise, in a balanced tree."""
+
+    while len(tables) > 1:
+        merged = [add_pstats(tables[i], tables[i + 1]) for i in range(0, len(tables) - 1, 2)]
+        if len(tables) % 2:
+            merged.append(tables[-1])
+        tables = merged
+    return tables[0]
+
+
+def load_pstats(filenames):
+    """Load and merge pstats files.
+
+    This runs in the worker processes of PstatsParser, so it must remain a
+    module level function."""
+
+    import gc
+    import marshal
+
+    # The tables hold no reference cycles, but allocating so many containers
+    # would trigger the cyclic garbage collector over and over
+    enabled = gc.isenabled()
+    gc.disable()
+    try:
+        merged = None
+        for filename in filenames:
+            # Reading the whole file first is much faster than letting
+            # marshal.load read it piecemeal
+            with open(filename, 'rb') as fp:
+                data = fp.read()
+            try:
+                stats = marshal.loads(data)
+            except EOFError:
+                stats = None
+            if not isinstance(stats, dict):
+                raise ValueError('%s is not a pstats file' % filename)
+            if merged is None:
+                merged = stats
+            else:
+                add_pstats(merged, stats)
+        return merged
+    finally:
+        if enabled:
+            gc.enable()
+
+
+class PstatsParser(Parser):
     """Parser python profiling statistics saved with te pstats module."""
 
     stdinInput = False
     multipleInput = True
 
+    # Minimum number of files to load them in a process pool
+    parallelThreshold = 8
+
     def __init__(self, *filename):
-        import pstats
+        Parser.__init__(self)
+        # Merge in the same order as pstats.Stats, which adds the files after
+        # the first one in reverse order
+        filenames = filename[:1] + filename[:0:-1]
         try:
-            self.stats = pstats.Stats(*filename)
+            self.stats = self.load(filenames)
         except ValueError:
             if PYTHON_3:
-                sys.stderr.write('error: failed to load %s\n' % ', '.join(filename))
-                sys.exit(1)
+                raise ParseError('failed to load %s' % ', '.join(filename))
             import hotshot.stats
-            self.stats = hotshot.stats.load(filename[0])
+            self.stats = hotshot.stats.load(filename[0]).stats
         self.profile = Profile()
         self.function_ids = {}
 
+    def load(self, filenames):
+        try:
+            workers = min(os.cpu_count() or 1, len(filenames))
+        except AttributeError:
+            # Python 2
+            workers = 1
+        if len(filenames) >= self.parallelThreshold and workers > 1:
+            try:
+                return self.load_parallel(filenames, workers)
+            except (ImportError, NotImplementedError, OSError):
+                # No usable process pool on this platform
+                pass
+        return load_pstats(filenames)
+
+    def load_parallel(self, filenames, workers):
+        """Load contiguous batches of files in worker processes, and merge
+        the partial tables from the workers in file order."""
+
+        from concurrent.futures import ProcessPoolExecutor
+
+        size = (len(filenames) + workers - 1) // workers
+        batches = [filenames[i:i + size] for i in range(0, len(filenames), size)]
+        with ProcessPoolExecutor(len(batches)) as executor:
+            tables = list(executor.map(load_pstats, batches))
+        return reduce_pstats(tables)
+
     def get_function_name(self, key):
         filename, line, name = key
         module = os.path.splitext(filename)[0]
@@ -2699,8 +4463,8 @@ class PstatsParser:
 
     def parse(self):
         self.profile[TIME] = 0.0
-        self.profile[TOTAL_TIME] = self.stats.total_tt
-        for fn, (cc, nc, tt, ct, callers) in compat_iteritems(self.stats.stats):
+        self.profile[TOTAL_TIME] = sum([stat[2] for stat in compat_itervalues(self.stats)])
+        for fn, (cc, nc, tt, ct, callers) in compat_iteritems(self.stats):
             callee = self.get_function(fn)
             callee.called = nc
             callee[TOTAL_TIME] = ct
@@ -2711,7 +4475,7 @@ class PstatsParser:
                 caller = self.get_function(fn)
                 call = Call(callee.id)
                 if isinstance(value, tuple):
-                    for i in xrange(0, len(value), 4):
+                    for i in range(0, len(value), 4):
                         nc, cc, tt, ct = value[i:i+4]
                         if CALLS in call:
                             call[CALLS] += cc
@@ -2729,10 +4493,6 @@ class PstatsParser:
 
                 caller.add_call(call)
 
-        if False:
-            self.stats.print_stats()
-            self.stats.print_callees()
-
         # Compute derived events
         self.profile.validate()
         self.profile.ratio(TIME_RATIO, TIME)
@@ -2760,6 +4520,21 @@ formats = {
 # Output
 
 
+def rgb_to_hex(rgb):
+    """Format a color as a #rrggbb string."""
+
+    r, g, b = rgb
+
+    def float2int(f):
+        if f <= 0.0:
+            return 0
+        if f >= 1.0:
+            return 255
+        return int(255.0*f + 0.5)
+
+    return "#" + "".join(["%02x" % float2int(c) for c in (r, g, b)])
+
+
 class Theme:
 
     def __init__(self,
@@ -2774,7 +4549,8 @@ class Theme:
             minpenwidth = 0.5,
             maxpenwidth = 4.0,
             gamma = 2.2,
-            skew = 1.0):
+            skew = 1.0,
+            resolution = 0):
         self.bgcolor = bgcolor
         self.mincolor = mincolor
         self.maxcolor = maxcolor
@@ -2787,6 +4563,9 @@ class Theme:
         self.maxpenwidth = maxpenwidth
         self.gamma = gamma
         self.skew = skew
+        self.resolution = resolution
+        self._table = None
+        self._table_key = None
 
     def graph_bgcolor(self):
         return self.hsl_to_rgb(*self.bgcolor)
@@ -2877,6 +4656,46 @@ class Theme:
 
         return (r, g, b)
 
+    def weight_style(self, weight):
+        """Return the color, font size, pen width and arrow size for a weight.
+
+        The color is formatted as a #rrggbb string.
+        """
+        return (
+            rgb_to_hex(self.color(weight)),
+            self.fontsize(weight),
+            self.edge_penwidth(weight),
+            self.edge_arrowsize(weight),
+        )
+
+    def style_lookup(self):
+        """Return a function mapping weights to weight_style() tuples.
+
+        When the theme has a resolution, weights in [0, 1] are quantized to
+        that many steps, and the styles are looked up in a table that is
+        precomputed once, instead of being recomputed for every node and edge.
+        """
+
+        resolution = self.resolution
+        if not resolution:
+            return self.weight_style
+
+        key = (resolution, self.mincolor, self.maxcolor, self.gamma, self.skew,
+               self.minfontsize, self.maxfontsize, self.minpenwidth, self.maxpenwidth)
+        if self._table_key != key:
+            self._table = [self.weight_style(float(i)/resolution) for i in range(resolution + 1)]
+            self._table_key = key
+        table = self._table
+
+        def lookup(weight):
+            if weight <= 0.0:
+                return table[0]
+            if weight >= 1.0:
+                return table[resolution]
+            return table[int(weight*resolution + 0.5)]
+
+        return lookup
+
     def _hue_to_rgb(self, m1, m2, h):
         if h < 0.0:
             h += 1.0
@@ -2958,8 +4777,19 @@ class DotWriter:
     strip = False
     wrap = False
 
+    # Identify nodes by short generated names (n0, n1, ...) instead of the
+    # function ids, which for some formats are long function names that would
+    # otherwise be repeated on both ends of every edge.
+    short_ids = True
+
+    # Number of chunks buffered before they are handed to the output file
+    buffer_size = 1024
+
     def __init__(self, fp):
         self.fp = fp
+        self.chunks = []
+        self.ids = {}
+        self.show_function_events = [TOTAL_TIME_RATIO, TIME_RATIO]
 
     def wrap_function_name(self, name):
         """Split the function name on multiple lines."""
@@ -2969,6 +4799,7 @@ class DotWriter:
             height = max(int(len(name)/(1.0 - ratio) + 0.5), 1)
             width = max(len(name)/height, 32)
             # TODO: break lines in symbols
+            import textwrap
             name = textwrap.fill(name, width, break_long_words=False)
 
         # Take away spaces
@@ -2978,9 +4809,9 @@ class DotWriter:
 
         return name
 
-    show_function_events = [TOTAL_TIME_RATIO, TIME_RATIO]
-    show_edge_events = [TOTAL_TIME_RATIO, CALLS]
+    show_edge_events = (TOTAL_TIME_RATIO, CALLS)
 
+    @phase('dot')
     def graph(self, profile, theme):
         self.begin_graph()
 
@@ -2992,6 +4823,18 @@ class DotWriter:
         self.attr('node', fontname=fontname, shape="box", style=nodestyle, fontcolor=fontcolor, width=0, height=0)
         self.attr('edge', fontname=fontname)
 
+        # Nodes and edges are written directly with the attributes in the
+        # same (alphabetical) order attr_list would use.
+        write = self.write
+        quote = self.quote
+        node_id = self.node_id
+
+        style = theme.style_lookup()
+        if nodestyle == "filled":
+            node_fgcolor = self.color(theme.graph_bgcolor())
+        else:
+            node_fgcolor = None
+
         for _, function in sorted_iteritems(profile.functions):
             labels = []
             if function.process is not None:
@@ -3028,14 +4871,24 @@ class DotWriter:
             else:
                 weight = 0.0
 
-            label = '\n'.join(labels)
-            self.node(function.id,
-                label = label,
-                color = self.color(theme.node_bgcolor(weight)),
-                fontcolor = self.color(theme.node_fgcolor(weight)),
-                fontsize = "%.2f" % theme.node_fontsize(weight),
-                tooltip = function.filename,
-            )
+            if function.filename is not None:
+                tooltip = ', tooltip=' + quote(function.filename)
+            elif self.short_ids:
+                # otherwise the SVG title would be the generated node id
+                tooltip = ', tooltip=' + quote(function.name[:MAX_FUNCTION_NAME])
+            else:
+                tooltip = ''
+
+            color, fontsize, _, _ = style(weight)
+            source_id = node_id(function.id)
+            write('\t%s [color="%s", fontcolor="%s", fontsize="%.2f", label=%s%s];\n' % (
+                source_id,
+                color,
+                node_fgcolor or color,
+                fontsize,
+                quote('\n'.join(labels)),
+                tooltip,
+            ))
 
             for _, call in sorted_iteritems(function.calls):
                 callee = profile.functions[call.callee_id]
@@ -3053,17 +4906,18 @@ class DotWriter:
                 else:
                     weight = 0.0
 
-                label = '\n'.join(labels)
-
-                self.edge(function.id, call.callee_id,
-                    label = label,
-                    color = self.color(theme.edge_color(weight)),
-                    fontcolor = self.color(theme.edge_color(weight)),
-                    fontsize = "%.2f" % theme.edge_fontsize(weight),
-                    penwidth = "%.2f" % theme.edge_penwidth(weight),
-                    labeldistance = "%.2f" % theme.edge_penwidth(weight),
-                    arrowsize = "%.2f" % theme.edge_arrowsize(weight),
-                )
+                color, fontsize, penwidth, arrowsize = style(weight)
+                write('\t%s -> %s [arrowsize="%.2f", color="%s", fontcolor="%s", fontsize="%.2f", label=%s, labeldistance="%.2f", penwidth="%.2f"];\n' % (
+                    source_id,
+                    node_id(call.callee_id),
+                    arrowsize,
+                    color,
+                    color,
+                    fontsize,
+                    quote('\n'.join(labels)),
+                    penwidth,
+                    penwidth,
+                ))
 
         self.end_graph()
 
@@ -3072,6 +4926,7 @@ class DotWriter:
 
     def end_graph(self):
         self.write('}\n')
+        self.flush()
 
     def attr(self, what, **attrs):
         self.write("\t")
@@ -3111,28 +4966,36 @@ class DotWriter:
         self.write(']')
 
     def id(self, id):
+        self.write(self.quote(id))
+
+    def node_id(self, id):
+        """Return the DOT identifier of a node, escaping it only once."""
+        try:
+            return self.ids[id]
+        except KeyError:
+            if self.short_ids:
+                s = 'n%u' % len(self.ids)
+            else:
+                s = self.quote(id)
+            self.ids[id] = s
+            return s
+
+    def quote(self, id):
         if isinstance(id, (int, float)):
-            s = str(id)
+            return str(id)
         elif isinstance(id, basestring):
             if id.isalnum() and not id.startswith('0x'):
-                s = id
+                if not PYTHON_3:
+                    # Like escape(), so that it mixes with escaped strings
+                    id = id.encode('utf-8')
+                return id
             else:
-                s = self.escape(id)
+                return self.escape(id)
         else:
             raise TypeError
-        self.write(s)
 
     def color(self, rgb):
-        r, g, b = rgb
-
-        def float2int(f):
-            if f <= 0.0:
-                return 0
-            if f >= 1.0:
-                return 255
-            return int(255.0*f + 0.5)
-
-        return "#" + "".join(["%02x" % float2int(c) for c in (r, g, b)])
+        return rgb_to_hex(rgb)
 
     def escape(self, s):
         if not PYTHON_3:
@@ -3144,10 +5007,249 @@ class DotWriter:
         return '"' + s + '"'
 
     def write(self, s):
-        self.fp.write(s)
+        chunks = self.chunks
+        chunks.append(s)
+        if len(chunks) >= self.buffer_size:
+            self.flush()
+
+    def flush(self):
+        if self.chunks:
+            self.fp.write(''.join(self.chunks))
+            self.chunks = []
 
 
 
+########################################################################
+# Programmatic interface
+#
+# gprof2dot can be imported and used without running main():
+#
+#     import gprof2dot
+#
+#     options = gprof2dot.Options(node_thres=1.0, max_nodes=200)
+#     try:
+#         dot = gprof2dot.render('cachegrind.out', 'callgrind', options)
+#     except (gprof2dot.ParseError, gprof2dot.RenderError) as ex:
+#         ...
+#
+# render() returns the dot graph as UTF-8 bytes.  For more control,
+# load_profile() returns the parsed Profile, which prune_profile() and
+# write_dot() take in turn.  The options are those of the command line,
+# named as its destinations: Options(totalMethod='inclusive', aggregate=
+# 'class', include=['App\\*']).  Errors are raised rather than printed,
+# and nothing is written to stdout or stderr but warnings.  Calls share no
+# state, so they can run in several threads at once.
+
+
+class RenderError(Exception):
+    """Raised when a profile cannot be rendered with the given options."""
+
+    pass
+
+
+class Options(object):
+    """Rendering options.
+
+    The attributes and their defaults are those of the command line options,
+    so the options parsed by main() can be used in place of this class.
+    """
+
+    node_thres = 0.5
+    edge_thres = 0.1
+    max_nodes = 0
+    max_edges = 0
+    totalMethod = Parser.totalMethod
+    theme = 'color'
+    color_resolution = 0
+    strip = False
+    color_nodes_by_selftime = False
+    wrap = False
+    show_samples = False
+    root = ''
+    leaf = ''
+    depth = -1
+    theme_skew = 1.0
+    filter_paths = None
+    checkpoint = None
+    include = None
+    exclude = None
+    fold_internal = False
+    proxy_functions = None
+    aggregate = None
+
+    def __init__(self, **kwargs):
+        for name, value in compat_iteritems(kwargs):
+            if not hasattr(Options, name) or name.startswith('_'):
+                raise TypeError('unknown option %r' % name)
+            setattr(self, name, value)
+
+
+def create_function_filter(options):
+    """Return the FunctionFilter for the include and exclude options, if
+    any."""
+
+    if not options.include and not options.exclude:
+        return None
+    return FunctionFilter(options.include or (), options.exclude or ())
+
+
+def spliced_functions(options):
+    """Return the rules of the functions to splice out of callgrind graphs,
+    if any."""
+
+    rules = []
+    if options.fold_internal:
+        rules.append('php::*')
+    for name in options.proxy_functions or ():
+        rules.append('name:' + name)
+    return rules or None
+
+
+def create_parser(input, format='prof', options=None):
+    """Create a parser for the given input.
+
+    input is an open file for the formats read as a stream, and a filename,
+    or a list of filenames for the formats that accept several, otherwise.
+    Of the options, an Options instance, the parser uses totalMethod, and
+    include and exclude, which leave functions out as the profile is read.
+    For callgrind only, it also uses checkpoint, a file to resume from
+    along with a filename input, fold_internal and proxy_functions, which
+    splice functions out of the call graph, and aggregate.
+    """
+
+    if options is None:
+        options = Options()
+
+    try:
+        Format = formats[format]
+    except KeyError:
+        raise RenderError('invalid format \'%s\'' % format)
+
+    if options.totalMethod == 'inclusive' and Format is not CallgrindParser:
+        raise RenderError('inclusive totals are only supported for callgrind input')
+
+    functionFilter = create_function_filter(options)
+    if functionFilter is not None and not Format.filterFunctions:
+        raise RenderError('function filters are not supported for %s input' % format)
+
+    if options.aggregate is not None:
+        if Format is not CallgrindParser:
+            raise RenderError('aggregation is only supported for callgrind input')
+        if options.aggregate not in CallgrindParser.aggregateKeys:
+            raise RenderError('invalid aggregation \'%s\'' % options.aggregate)
+
+    splicedFunctions = spliced_functions(options)
+    if splicedFunctions and Format is not CallgrindParser:
+        raise RenderError('splicing functions is only supported for callgrind input')
+
+    if options.checkpoint is not None:
+        if Format is not CallgrindParser:
+            raise RenderError('checkpoints are only supported for callgrind input')
+        if not isinstance(input, basestring):
+            raise RenderError('checkpoints require a file name')
+        parser = CallgrindParser.resume(input, options.checkpoint, splicedFunctions)
+    elif Format.stdinInput:
+        parser = Format(input)
+    else:
+        if isinstance(input, basestring):
+            input = [input]
+        if Format.multipleInput:
+            if not input:
+                raise RenderError('at least a file must be specified for %s input' % format)
+        elif len(input) != 1:
+            raise RenderError('exactly one file must be specified for %s input' % format)
+        parser = Format(*input)
+    parser.totalMethod = options.totalMethod
+    parser.functionFilter = functionFilter
+    if splicedFunctions:
+        parser.splicedFunctions = splicedFunctions
+    if options.aggregate is not None:
+        parser.aggregateBy = options.aggregate
+    return parser
+
+
+def load_profile(input, format='prof', options=None):
+    """Parse a profile.
+
+    input is a filename, or a list of filenames for the formats that accept
+    several.  The formats read as a stream also accept an open file.  The
+    options are as for create_parser().
+    """
+
+    Format = formats.get(format)
+    if (options is None or options.checkpoint is None) and \
+       Format is not None and Format.stdinInput and isinstance(input, basestring):
+        if PYTHON_3:
+            fp = open(input, 'rt', encoding='UTF-8')
+        else:
+            fp = open(input, 'rt')
+        try:
+            return create_parser(fp, format, options).parse()
+        finally:
+            fp.close()
+    return create_parser(input, format, options).parse()
+
+
+def prune_profile(profile, options):
+    """Prune a profile in place, as told by the options."""
+
+    profile.prune(options.node_thres/100.0, options.edge_thres/100.0, options.filter_paths, options.color_nodes_by_selftime, options.max_nodes, options.max_edges)
+
+    if options.root:
+        rootIds = profile.getFunctionIds(options.root)
+        if not rootIds:
+            raise RenderError('root node ' + options.root + ' not found (might already be pruned : try -e0 -n0 flags)')
+        profile.prune_root(rootIds, options.depth)
+    if options.leaf:
+        leafIds = profile.getFunctionIds(options.leaf)
+        if not leafIds:
+            raise RenderError('leaf node ' + options.leaf + ' not found (maybe already pruned : try -e0 -n0 flags)')
+        profile.prune_leaf(leafIds, options.depth)
+
+
+def write_dot(profile, output, options):
+    """Write a pruned profile to the output file as a dot graph."""
+
+    import copy
+
+    try:
+        theme = copy.copy(themes[options.theme])
+    except KeyError:
+        raise RenderError('invalid colormap \'%s\'' % options.theme)
+    if options.theme_skew:
+        theme.skew = options.theme_skew
+    theme.resolution = options.color_resolution
+
+    dot = DotWriter(output)
+    dot.strip = options.strip
+    dot.wrap = options.wrap
+    if options.show_samples:
+        dot.show_function_events.append(SAMPLES)
+    dot.graph(profile, theme)
+
+
+def render(input, format='prof', options=None):
+    """Parse a profile, prune it and return its dot graph, as UTF-8 bytes.
+
+    input is as for load_profile(), and options an Options instance.  All
+    state is local to the call, so it is safe to call from several threads.
+    """
+
+    if options is None:
+        options = Options()
+    profile = load_profile(input, format, options)
+    prune_profile(profile, options)
+    if PYTHON_3:
+        output = io.StringIO()
+        write_dot(profile, output, options)
+        return output.getvalue().encode('UTF-8')
+    else:
+        # DotWriter writes UTF-8 encoded strings already
+        output = io.BytesIO()
+        write_dot(profile, output, options)
+        return output.getvalue()
+
+
 ########################################################################
 # Main program
 
@@ -3160,20 +5262,462 @@ def naturalJoin(values):
         return ''.join(values)
 
 
+def stats_argv(argv):
+    """Give a bare --stats option its default value.
+
+    optparse has no notion of options with an optional value, so --stats
+    alone is rewritten as --stats=-.
+    """
+
+    result = []
+    for i, arg in enumerate(argv):
+        if arg == '--':
+            return result + argv[i:]
+        if arg == '--stats':
+            arg = '--stats=-'
+        result.append(arg)
+    return result
+
+
+class InputCounter(io.RawIOBase):
+    """Binary input file wrapper that counts the bytes and lines read
+    through it, so that inputs need not be read again to measure them."""
+
+    def __init__(self, fp):
+        io.RawIOBase.__init__(self)
+        self.fp = fp
+        self.size = 0
+        self.lines = 0
+
+    def readable(self):
+        return True
+
+    def readinto(self, b):
+        data = self.fp.read(len(b))
+        n = len(data)
+        b[:n] = data
+        self.size += n
+        self.lines += data.count(b'\n')
+        return n
+
+    def fileno(self):
+        return self.fp.fileno()
+
+    def close(self):
+        self.fp.close()
+        io.RawIOBase.close(self)
+
+
+def open_counted(fp, encoding):
+    """Return a stream that reads the binary file through an InputCounter,
+    and the counter."""
+
+    counter = InputCounter(fp)
+    stream = io.BufferedReader(counter)
+    if PYTHON_3:
+        stream = io.TextIOWrapper(stream, encoding=encoding)
+    return stream, counter
+
+
+class ByteCounter:
+    """Output file wrapper that counts the UTF-8 encoded size of what is
+    written through it."""
+
+    def __init__(self, fp):
+        self.fp = fp
+        self.size = 0
+
+    def write(self, s):
+        if PYTHON_3:
+            self.size += len(s.encode('UTF-8'))
+        else:
+            # DotWriter writes UTF-8 encoded str already
+            self.size += len(s)
+        self.fp.write(s)
+
+    def flush(self):
+        self.fp.flush()
+
+
+class AtomicOutput:
+    """Output file that only appears, under its final name, once complete.
+
+    What is written goes to a temporary file in the same directory, renamed
+    over the output file by commit().  Readers thus see either the previous
+    output or the new one, never a partial file.
+    """
+
+    def __init__(self, filename, binary=False):
+        import tempfile
+
+        self.filename = filename
+        directory, basename = os.path.split(os.path.abspath(filename))
+        fd, self.temp = tempfile.mkstemp(prefix='.' + basename + '.', suffix='.tmp', dir=directory)
+        # mkstemp creates the file readable by its owner only
+        umask = os.umask(0)
+        os.umask(umask)
+        os.chmod(self.temp, 0o666 & ~umask)
+        if binary:
+            self.fp = os.fdopen(fd, 'wb')
+        elif PYTHON_3:
+            self.fp = open(fd, 'wt', encoding='UTF-8')
+        else:
+            self.fp = os.fdopen(fd, 'wt')
+
+    def commit(self):
+        self.fp.close()
+        if PYTHON_3:
+            os.replace(self.temp, self.filename)
+        else:
+            if os.name == 'nt' and os.path.exists(self.filename):
+                os.remove(self.filename)
+            os.rename(self.temp, self.filename)
+        self.temp = None
+
+    def discard(self):
+        if self.temp is not None:
+            self.fp.close()
+            os.remove(self.temp)
+            self.temp = None
+
+
+class GraphvizProtocol:
+    """asyncio subprocess protocol of a Graphviz process, which copies its
+    output to a file and keeps its error messages.
+
+    Its events are read from the main thread, while the event loop runs in
+    another one.
+    """
+
+    def __init__(self, fp):
+        import threading
+
+        self.fp = fp
+        self.errors = []
+        self.write_error = None
+        self.writable = threading.Event()
+        self.writable.set()
+        self.done = threading.Event()
+
+    def connection_made(self, transport):
+        pass
+
+    def pipe_data_received(self, fd, data):
+        if fd == 1:
+            if self.write_error is None:
+                try:
+                    self.fp.write(data)
+                except (IOError, OSError) as ex:
+                    self.write_error = ex
+        else:
+            self.errors.append(data)
+
+    def pipe_connection_lost(self, fd, exc):
+        if fd == 0:
+            # Exited before reading all its input
+            self.writable.set()
+
+    def pause_writing(self):
+        self.writable.clear()
+
+    def resume_writing(self):
+        self.writable.set()
+
+    def process_exited(self):
+        pass
+
+    def connection_lost(self, exc):
+        # The process exited and all its pipes are closed
+        self.writable.set()
+        self.done.set()
+
+
+class GraphvizPipeline:
+    """Output file that streams the dot graph written to it into Graphviz,
+    which renders it to several formats at once.
+
+    One Graphviz process is started per format, as an asyncio subprocess,
+    and fed the graph as it is generated.  The event loop runs in a
+    background thread, so that generating the graph, and handling signals,
+    stay in the main thread.  Images are written atomically, and only if
+    every process succeeds, which close() reports through RenderError.
+    """
+
+    def __init__(self, program, outputs, timeout=None):
+        """outputs is a list of (format, filename) pairs, a filename of None
+        standing for the standard output."""
+
+        import asyncio
+        import threading
+
+        self.program = program
+        self.timeout = timeout
+        self.deadline = None
+        if timeout:
+            self.deadline = time.time() + timeout
+        self.formats = []
+        self.outputs = []
+        for format, filename in outputs:
+            self.formats.append(format)
+            if filename is None:
+                self.outputs.append(None)
+            else:
+                self.outputs.append(AtomicOutput(filename, binary=True))
+        self.transports = []
+        self.protocols = []
+
+        self.loop = asyncio.new_event_loop()
+        self.thread = threading.Thread(target=self.loop.run_forever)
+        self.thread.daemon = True
+        self.thread.start()
+        try:
+            for format, output in zip(self.formats, self.outputs):
+                if output is None:
+                    fp = sys.stdout.buffer
+                else:
+                    fp = output.fp
+                coroutine = self.loop.subprocess_exec(
+                    lambda fp=fp: GraphvizProtocol(fp),
+                    self.program, '-T' + format,
+                    stdin=asyncio.subprocess.PIPE,
+                    stdout=asyncio.subprocess.PIPE,
+                    stderr=asyncio.subprocess.PIPE)
+                try:
+                    transport, protocol = asyncio.run_coroutine_threadsafe(coroutine, self.loop).result()
+                except OSError as ex:
+                    raise RenderError('could not run %s: %s' % (self.program, ex))
+                self.transports.append(transport)
+                self.protocols.append(protocol)
+        except:
+            self.abort()
+            raise
+
+    def write(self, s):
+        self._call(self._feed, s.encode('UTF-8'))
+        # Wait for the processes to catch up
+        for protocol in self.protocols:
+            self._wait(protocol.writable)
+
+    def flush(self):
+        pass
+
+    def close(self):
+        """Wait for Graphviz to finish, and put the images in place."""
+        try:
+            self._call(self._close_input)
+            for protocol in self.protocols:
+                self._wait(protocol.done)
+            for format, transport, protocol in zip(self.formats, self.transports, self.protocols):
+                if protocol.write_error is not None:
+                    raise RenderError('could not write the %s output: %s' % (format, protocol.write_error))
+                status = transport.get_returncode()
+                if status != 0:
+                    message = '%s -T%s failed with status %d' % (self.program, format, status)
+                    errors = b''.join(protocol.errors).decode('UTF-8', 'replace').strip()
+                    if errors:
+                        message += ': ' + errors
+                    raise RenderError(message)
+            for output in self.outputs:
+                if output is not None:
+                    output.commit()
+        finally:
+            self.abort()
+
+    def abort(self):
+        """Kill the processes still running and discard their output."""
+        if self.loop is None:
+            return
+        try:
+            self._call(self._kill)
+            for protocol in self.protocols:
+                protocol.done.wait()
+        finally:
+            self.loop.call_soon_threadsafe(self.loop.stop)
+            self.thread.join()
+            self.loop.close()
+            self.loop = None
+            for output in self.outputs:
+                if output is not None:
+                    output.discard()
+
+    def _call(self, function, *args):
+        """Run a function in the event loop thread, and wait for it."""
+
+        import concurrent.futures
+
+        future = concurrent.futures.Future()
+
+        def call():
+            try:
+                future.set_result(function(*args))
+            except Exception as ex:
+                future.set_exception(ex)
+
+        self.loop.call_soon_threadsafe(call)
+        return future.result()
+
+    def _wait(self, event):
+        remaining = None
+        if self.deadline is not None:
+            remaining = max(self.deadline - time.time(), 0)
+        if not event.wait(remaining):
+            raise RenderError('%s did not finish within %g seconds' % (self.program, self.timeout))
+
+    def _feed(self, data):
+        for transport in self.transports:
+            stdin = transport.get_pipe_transport(0)
+            if stdin is not None and not stdin.is_closing():
+                stdin.write(data)
+
+    def _close_input(self):
+        for transport in self.transports:
+            stdin = transport.get_pipe_transport(0)
+            if stdin is not None:
+                stdin.close()
+
+    def _kill(self):
+        for transport in self.transports:
+            if transport.get_returncode() is None:
+                try:
+                    transport.kill()
+                except ProcessLookupError:
+                    pass
+
+
+class FileLock:
+    """Exclusive advisory lock on a file, shared between processes.
+
+    The lock file also holds a short note from the last holder, which
+    main() uses to record the fingerprint of the output it wrote.  The file
+    is never removed, as that would let two processes lock different files
+    under the same name.
+    """
+
+    def __init__(self, filename):
+        self.filename = filename
+        self.fd = None
+
+    def acquire(self):
+        self.fd = os.open(self.filename, os.O_RDWR | os.O_CREAT, 0o666)
+        try:
+            import fcntl
+        except ImportError:
+            import msvcrt
+            while True:
+                try:
+                    # Retries for ten seconds before giving up
+                    msvcrt.locking(self.fd, msvcrt.LK_LOCK, 1)
+                    break
+                except IOError:
+                    pass
+        else:
+            fcntl.flock(self.fd, fcntl.LOCK_EX)
+
+    def release(self):
+        if self.fd is None:
+            return
+        try:
+            import msvcrt
+        except ImportError:
+            # flock() locks are released on close
+            pass
+        else:
+            os.lseek(self.fd, 0, os.SEEK_SET)
+            msvcrt.locking(self.fd, msvcrt.LK_UNLCK, 1)
+        os.close(self.fd)
+        self.fd = None
+
+    def read(self):
+        os.lseek(self.fd, 0, os.SEEK_SET)
+        chunks = []
+        while True:
+            chunk = os.read(self.fd, 4096)
+            if not chunk:
+                break
+            chunks.append(chunk)
+        return b''.join(chunks).decode('UTF-8', 'replace')
+
+    def write(self, note):
+        os.lseek(self.fd, 0, os.SEEK_SET)
+        os.ftruncate(self.fd, 0)
+        os.write(self.fd, note.encode('UTF-8'))
+
+
+# Options that do not change the output
+UNRENDERED_OPTIONS = ('output', 'single_flight', 'timeout', 'checkpoint', 'stats', 'progress', 'progress_fd', 'progress_interval', 'cancel_file')
+
+
+def render_fingerprint(options, args):
+    """Return a digest of everything the output depends on: the options, and
+    the name, size and modification time of the input files."""
+
+    import hashlib
+
+    values = sorted([(name, value) for name, value in compat_iteritems(vars(options)) if name not in UNRENDERED_OPTIONS])
+    inputs = []
+    for filename in args:
+        st = os.stat(filename)
+        inputs.append((os.path.abspath(filename), st.st_size, st.st_mtime))
+    digest = hashlib.sha1(repr((values, inputs)).encode('UTF-8'))
+    return digest.hexdigest()
+
+
+def output_filenames(options):
+    """Return the names of the files written for the -o option."""
+
+    if options.image_formats and len(options.image_formats) > 1:
+        return [options.output + '.' + format for format in options.image_formats]
+    return [options.output]
+
+
+def output_note(fingerprint, filenames):
+    """Return the fingerprint along with the size and modification time of
+    the output files, so that an output replaced by other means, or removed,
+    is not mistaken for the one rendered."""
+
+    note = [fingerprint]
+    for filename in filenames:
+        try:
+            st = os.stat(filename)
+        except OSError:
+            return None
+        note.append('%u %r' % (st.st_size, st.st_mtime))
+    return ' '.join(note) + '\n'
+
+
 def main():
     """Main program."""
 
-    global totalMethod
+    import optparse
 
     formatNames = list(formats.keys())
     formatNames.sort()
 
+    # Named explicitly, as webgrind runs main() through python -c
     optparser = optparse.OptionParser(
+        prog='gprof2dot.py',
         usage="\n\t%prog [options] [file] ...")
     optparser.add_option(
         '-o', '--output', metavar='FILE',
         type="string", dest="output",
-        help="output filename [stdout]")
+        help="output filename [stdout]; the file is replaced only once complete")
+    optparser.add_option(
+        '--single-flight',
+        action="store_true",
+        dest="single_flight", default=False,
+        help="lock the output file while rendering, so that identical runs started meanwhile wait and reuse its output rather than render it again")
+    optparser.add_option(
+        '-T', metavar='FORMAT',
+        type="string", action="append", dest="image_formats",
+        help="render the graph with Graphviz to FORMAT, such as svg or png, instead of writing it in dot format; given several times, the formats are rendered concurrently, each to the output filename with the format appended")
+    optparser.add_option(
+        '--dot', metavar='PROGRAM',
+        type="string", dest="dot", default="dot",
+        help="Graphviz program used by -T [default: %default]")
+    optparser.add_option(
+        '--timeout', metavar='SECONDS',
+        type="float", dest="timeout", default=0,
+        help="give up if Graphviz has not finished after this long (0 means no limit) [default: %default]")
     optparser.add_option(
         '-n', '--node-thres', metavar='PERCENTAGE',
         type="float", dest="node_thres", default=0.5,
@@ -3182,6 +5726,14 @@ def main():
         '-e', '--edge-thres', metavar='PERCENTAGE',
         type="float", dest="edge_thres", default=0.1,
         help="eliminate edges below this threshold [default: %default]")
+    optparser.add_option(
+        '--max-nodes', metavar='COUNT',
+        type="int", dest="max_nodes", default=0,
+        help="keep at most this many nodes, raising the node threshold as needed; off by default, as layout time depends on the dot version and machine: measure it with benchmarks/dot_layout.py (0 means unlimited) [default: %default]")
+    optparser.add_option(
+        '--max-edges', metavar='COUNT',
+        type="int", dest="max_edges", default=0,
+        help="keep at most this many edges, raising the edge threshold as needed; off by default, as for --max-nodes (0 means unlimited) [default: %default]")
     optparser.add_option(
         '-f', '--format',
         type="choice", choices=formatNames,
@@ -3189,14 +5741,18 @@ def main():
         help="profile format: %s [default: %%default]" % naturalJoin(formatNames))
     optparser.add_option(
         '--total',
-        type="choice", choices=('callratios', 'callstacks'),
-        dest="totalMethod", default=totalMethod,
-        help="preferred method of calculating total time: callratios or callstacks (currently affects only perf format) [default: %default]")
+        type="choice", choices=('callratios', 'callstacks', 'inclusive'),
+        dest="totalMethod", default=Options.totalMethod,
+        help="preferred method of calculating total time: callratios, callstacks (perf format only) or inclusive (callgrind format only, from the inclusive cost of calls; exact outside cycles of mutually recursive functions, upper bounds within them) [default: %default]")
     optparser.add_option(
         '-c', '--colormap',
         type="choice", choices=('color', 'pink', 'gray', 'bw', 'print'),
         dest="theme", default="color",
         help="color map: color, pink, gray, bw, or print [default: %default]")
+    optparser.add_option(
+        '--color-resolution', metavar='STEPS',
+        type="int", dest="color_resolution", default=0,
+        help="quantize node and edge weights to this many steps and look their colors and sizes up in a precomputed table (0 computes them exactly) [default: %default]")
     optparser.add_option(
         '-s', '--strip',
         action="store_true",
@@ -3248,81 +5804,258 @@ def main():
         '-p', '--path', action="append",
         type="string", dest="filter_paths",
         help="Filter all modules not in a specified path")
-    (options, args) = optparser.parse_args(sys.argv[1:])
+    optparser.add_option(
+        '--include', metavar='RULE', action="append",
+        type="string", dest="include",
+        help="keep only the functions matching a rule, while parsing, or for callgrind once the file is read: a name glob, or re:REGEX, path:PREFIX (the shared object for perf) or module:GLOB; the cost of the functions left out goes to their callers (callgrind, json, perf, hprof, xperf and sleepy formats)")
+    optparser.add_option(
+        '--exclude', metavar='RULE', action="append",
+        type="string", dest="exclude",
+        help="leave out the functions matching a rule, as for --include")
+    optparser.add_option(
+        '--fold-internal',
+        action="store_true",
+        dest="fold_internal", default=False,
+        help="splice PHP internal functions (php::*) out of callgrind graphs: their self cost goes to their callers, which call what they call")
+    optparser.add_option(
+        '--proxy', metavar='NAME', action="append",
+        type="string", dest="proxy_functions",
+        help="splice a proxy function, such as php::call_user_func, out of callgrind graphs, so that its callers call what it calls")
+    optparser.add_option(
+        '--aggregate',
+        type="choice", choices=CallgrindParser.aggregateKeys,
+        dest="aggregate", default=None,
+        help="group functions by " + naturalJoin(CallgrindParser.aggregateKeys) + ", summing their costs, for a smaller graph (callgrind format only); groups that call each other form cycles, whose totals are approximate, and PHP internal functions form a php group that most others call and are called by, unless --fold-internal is given")
+    optparser.add_option(
+        '--checkpoint', metavar='FILE',
+        type="string", dest="checkpoint",
+        help="save the callgrind parser state to FILE, and resume from it on the next run if the input only grew since, so that a profile still being appended to is not read again from the start")
+    optparser.add_option(
+        '--stats', metavar='FILE',
+        type="string", dest="stats",
+        help="write the wall time, CPU time and memory peak of each phase, and profile size counters, as JSON to FILE, or to stderr with a bare --stats; memory is traced, which slows the run down")
+    optparser.add_option(
+        '--progress', metavar='FILE',
+        type="string", dest="progress",
+        help="periodically append the current phase, and the input bytes consumed out of the total, to FILE, as one JSON object per line")
+    optparser.add_option(
+        '--progress-fd', metavar='FD',
+        type="int", dest="progress_fd",
+        help="write progress to the open file descriptor FD instead")
+    optparser.add_option(
+        '--progress-interval', metavar='SECONDS',
+        type="float", dest="progress_interval", default=1.0,
+        help="progress reporting interval [default: %default]")
+    optparser.add_option(
+        '--cancel-file', metavar='FILE',
+        type="string", dest="cancel_file",
+        help="give up as soon as FILE exists; SIGTERM also cancels the run")
+    (options, args) = optparser.parse_args(stats_argv(sys.argv[1:]))
 
     if len(args) > 1 and options.format != 'pstats':
         optparser.error('incorrect number of arguments')
 
-    try:
-        theme = themes[options.theme]
-    except KeyError:
+    if options.theme not in themes:
         optparser.error('invalid colormap \'%s\'' % options.theme)
 
-    # set skew on the theme now that it has been picked.
-    if options.theme_skew:
-        theme.skew = options.theme_skew
-
-    totalMethod = options.totalMethod
-
     try:
         Format = formats[options.format]
     except KeyError:
         optparser.error('invalid format \'%s\'' % options.format)
 
-    if Format.stdinInput:
-        if not args:
-            fp = sys.stdin
-        elif PYTHON_3:
-            fp = open(args[0], 'rt', encoding='UTF-8')
-        else:
-            fp = open(args[0], 'rt')
-        parser = Format(fp)
-    elif Format.multipleInput:
-        if not args:
-            optparser.error('at least a file must be specified for %s input' % options.format)
-        parser = Format(*args)
-    else:
-        if len(args) != 1:
+    if not Format.stdinInput:
+        if Format.multipleInput:
+            if not args:
+                optparser.error('at least a file must be specified for %s input' % options.format)
+        elif len(args) != 1:
             optparser.error('exactly one file must be specified for %s input' % options.format)
-        parser = Format(args[0])
 
-    profile = parser.parse()
+    if options.totalMethod == 'inclusive' and Format is not CallgrindParser:
+        optparser.error('--total=inclusive is only supported for callgrind input')
 
-    if options.output is None:
-        if PYTHON_3:
-            output = open(sys.stdout.fileno(), mode='wt', encoding='UTF-8', closefd=False)
-        else:
-            output = sys.stdout
-    else:
-        if PYTHON_3:
-            output = open(options.output, 'wt', encoding='UTF-8')
-        else:
-            output = open(options.output, 'wt')
+    if (options.include or options.exclude) and not Format.filterFunctions:
+        optparser.error('--include and --exclude are not supported for %s input' % options.format)
 
-    dot = DotWriter(output)
-    dot.strip = options.strip
-    dot.wrap = options.wrap
-    if options.show_samples:
-        dot.show_function_events.append(SAMPLES)
+    if (options.fold_internal or options.proxy_functions) and Format is not CallgrindParser:
+        optparser.error('--fold-internal and --proxy are only supported for callgrind input')
 
-    profile = profile
-    profile.prune(options.node_thres/100.0, options.edge_thres/100.0, options.filter_paths, options.color_nodes_by_selftime)
+    if options.aggregate is not None and Format is not CallgrindParser:
+        optparser.error('--aggregate is only supported for callgrind input')
 
-    if options.root:
-        rootIds = profile.getFunctionIds(options.root)
-        if not rootIds:
-            sys.stderr.write('root node ' + options.root + ' not found (might already be pruned : try -e0 -n0 flags)\n')
+    if options.checkpoint is not None:
+        if Format is not CallgrindParser:
+            optparser.error('--checkpoint is only supported for callgrind input')
+        if len(args) != 1:
+            optparser.error('--checkpoint requires an input file')
+
+    if options.single_flight and options.output is None:
+        optparser.error('--single-flight requires --output')
+
+    if options.image_formats:
+        if not PYTHON_3:
+            optparser.error('-T requires Python 3')
+        if len(options.image_formats) > 1 and options.output is None:
+            optparser.error('several -T formats require --output')
+
+    stats = None
+    if options.stats is not None:
+        stats = Stats()
+        stats.start()
+
+    monitor = None
+    progress_file = None
+    if options.progress is not None or options.progress_fd is not None or options.cancel_file is not None:
+        callback = None
+        if options.progress is not None:
+            progress_file = open(options.progress, 'wt')
+            callback = ProgressWriter(progress_file)
+        elif options.progress_fd is not None:
+            callback = ProgressWriter(os.fdopen(options.progress_fd, 'wt'))
+        monitor = ProgressMonitor(callback, options.progress_interval, options.cancel_file)
+        monitor.start()
+
+        # Let a terminated run unwind, rather than die at an arbitrary point
+        import signal
+        signal.signal(signal.SIGTERM, raise_cancelled)
+
+    status = 'failed'
+    lock = None
+    atomic = None
+    pipeline = None
+    try:
+        if options.single_flight:
+            if Format.stdinInput and not args:
+                # Standard input cannot be told apart from an earlier one
+                fingerprint = ''
+            else:
+                fingerprint = render_fingerprint(options, args)
+            lock = FileLock(options.output + '.lock')
+            lock.acquire()
+            if fingerprint and lock.read() == output_note(fingerprint, output_filenames(options)):
+                # Rendered while we waited, or earlier
+                status = 'done'
+                return
+
+        counter = None
+        if options.checkpoint is not None:
+            input = args[0]
+        elif Format.stdinInput and stats is not None and not args:
+            # Standard input can only be measured as it is read; named files
+            # are opened as usual, so that parsers can still seek them
+            input, counter = open_counted(getattr(sys.stdin, 'buffer', sys.stdin), sys.stdin.encoding)
+        elif Format.stdinInput:
+            if not args:
+                input = sys.stdin
+            elif PYTHON_3:
+                input = open(args[0], 'rt', encoding='UTF-8')
+            else:
+                input = open(args[0], 'rt')
+        else:
+            input = args
+        try:
+            parser = create_parser(input, options.format, options)
+        except ParseError as ex:
+            sys.stderr.write('error: %s\n' % ex)
             sys.exit(1)
-        profile.prune_root(rootIds, options.depth)
-    if options.leaf:
-        leafIds = profile.getFunctionIds(options.leaf)
-        if not leafIds:
-            sys.stderr.write('leaf node ' + options.leaf + ' not found (maybe already pruned : try -e0 -n0 flags)\n')
+
+        if monitor is not None:
+            monitor.set_inputs(parser.inputs())
+
+        enter_phase('parse')
+        try:
+            profile = parser.parse()
+        except ParseError as ex:
+            sys.stderr.write('error: %s\n' % ex)
             sys.exit(1)
-        profile.prune_leaf(leafIds, options.depth)
+        finally:
+            leave_phase()
 
-    dot.graph(profile, theme)
+        if stats is not None:
+            stats.count_profile(profile, 'functions', 'calls')
+            stats.counters['cycles'] = len(profile.cycles)
+            stats.counters['largest_cycle'] = max([len(cycle.functions) for cycle in profile.cycles] or [0])
 
+        try:
+            prune_profile(profile, options)
+        except RenderError as ex:
+            sys.stderr.write('%s\n' % ex)
+            sys.exit(1)
+
+        try:
+            if options.image_formats:
+                filenames = [None]
+                if options.output is not None:
+                    filenames = output_filenames(options)
+                pipeline = GraphvizPipeline(options.dot, list(zip(options.image_formats, filenames)), options.timeout)
+                output = pipeline
+            elif options.output is None:
+                if PYTHON_3:
+                    output = open(sys.stdout.fileno(), mode='wt', encoding='UTF-8', closefd=False)
+                else:
+                    output = sys.stdout
+            else:
+                atomic = AtomicOutput(options.output)
+                output = atomic.fp
+
+            if stats is not None:
+                stats.count_profile(profile, 'nodes', 'edges')
+                output = ByteCounter(output)
+
+            write_dot(profile, output, options)
+
+            if pipeline is not None:
+                enter_phase('graphviz')
+                try:
+                    pipeline.close()
+                finally:
+                    leave_phase()
+        except RenderError as ex:
+            sys.stderr.write('error: %s\n' % ex)
+            sys.exit(1)
+
+        if stats is not None:
+            stats.stop()
+            output.flush()
+            stats.counters['output_bytes'] = output.size
+            if counter is not None:
+                stats.counters['input_bytes'] = counter.size
+                stats.counters['input_lines'] = counter.lines
+            else:
+                stats.counters['input_bytes'] = sum([os.path.getsize(filename) for filename in args])
+                # Lines are only counted as read, and not by parsers that
+                # seek past them
+                stats.counters['input_lines'] = None
+                if isinstance(parser, LineParser):
+                    stats.counters['input_lines'] = parser.line_no
+            if options.stats == '-':
+                stats.dump(sys.stderr)
+            else:
+                with open(options.stats, 'wt') as fp:
+                    stats.dump(fp)
+
+        if atomic is not None:
+            atomic.commit()
+        if lock is not None:
+            lock.write(output_note(fingerprint, output_filenames(options)))
+
+        status = 'done'
+    except (Cancelled, KeyboardInterrupt):
+        if sys.exc_info()[0] is KeyboardInterrupt and (monitor is None or not monitor.cancelled):
+            raise
+        status = 'cancelled'
+        sys.stderr.write('error: cancelled\n')
+        sys.exit(1)
+    finally:
+        if pipeline is not None:
+            pipeline.abort()
+        if atomic is not None:
+            atomic.discard()
+        if lock is not None:
+            lock.release()
+        if monitor is not None:
+            monitor.stop(status)
+        if progress_file is not None:
+            progress_file.close()
 
 if __name__ == '__main__':
     main()